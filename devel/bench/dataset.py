@@ -0,0 +1,88 @@
+"""Generate synthetic FAS users and groups for benchmarking."""
+import random
+import string
+
+# Groups which the agreement of the benchmark configuration is about
+AGREEMENT_GROUPS = ("cla_done", "cla_fpca")
+
+ROLE_TYPES = ("user", "user", "user", "sponsor", "administrator")
+
+
+def make_groups(count, seed=0):
+    """Make FAS groups, each of the first ones being the prerequisite of others."""
+    rnd = random.Random(seed)
+    groups = []
+    for index, name in enumerate(AGREEMENT_GROUPS + tuple(range(count))):
+        if not isinstance(name, str):
+            name = f"group{name:05d}"
+        irc_channel = f"#{name}" if rnd.random() < 0.3 else ""
+        groups.append(
+            {
+                "id": index + 1,
+                "name": name,
+                "display_name": f"Group {name}",
+                # Most groups require signing the agreement
+                "prerequisite_id": 1 if index >= len(AGREEMENT_GROUPS) else None,
+                "irc_channel": irc_channel,
+                # FAS has a network only for some of the groups with a channel
+                "irc_network": "freenode" if irc_channel else "",
+                "url": f"https://example.org/{name}" if rnd.random() < 0.5 else None,
+                "mailing_list": f"{name}@lists.example.org"
+                if rnd.random() < 0.5
+                else None,
+            }
+        )
+    return groups
+
+
+def make_people(count, groups, memberships=3, seed=0):
+    """Make FAS users, each member of about as many groups as memberships."""
+    rnd = random.Random(seed)
+    group_ids = {group["name"]: group["id"] for group in groups}
+    other_groups = [g["name"] for g in groups if g["name"] not in AGREEMENT_GROUPS]
+    people = []
+    for index in range(count):
+        # Spread names over all the prefixes which FAS is searched for
+        username = "".join(rnd.choices(string.ascii_lowercase, k=3)) + str(index)
+        names = set(rnd.sample(other_groups, min(len(other_groups), memberships)))
+        if rnd.random() < 0.8:
+            names.update(AGREEMENT_GROUPS)
+        group_roles = {
+            name: {
+                "group_id": group_ids[name],
+                "role_status": "approved" if rnd.random() < 0.95 else "unapproved",
+                "role_type": rnd.choice(ROLE_TYPES),
+            }
+            for name in sorted(names)
+        }
+        status = rnd.choices(
+            ("active", "inactive", "spamcheck_denied"), weights=(90, 8, 2)
+        )[0]
+        people.append(
+            {
+                "id": index + 1,
+                "username": username,
+                "human_name": f"Given{index} Family{index}",
+                "email": f"{username}@example.org",
+                "ircnick": username if rnd.random() < 0.3 else None,
+                "locale": "en_US",
+                "timezone": "UTC",
+                "gpg_keyid": f"{rnd.getrandbits(64):016X}"
+                if rnd.random() < 0.2
+                else None,
+                "ssh_key": f"ssh-ed25519 AAAA{username} {username}@example.org"
+                if rnd.random() < 0.4
+                else None,
+                "status": status,
+                "creation": "2012-03-04 05:06:07.123456+00:00",
+                "privacy": rnd.random() < 0.1,
+                "affiliation": None,
+                "group_roles": group_roles,
+                "memberships": [
+                    {"name": name}
+                    for name, role in group_roles.items()
+                    if role["role_status"] == "approved"
+                ],
+            }
+        )
+    return people
@@ -0,0 +1,318 @@
+"""Benchmark pulling from FAS and pushing to IPA against local stand-ins.
+
+Run from the top of the repository, e.g.::
+
+    python devel/bench/run.py --users 10000 --ipa-latency 0.005 --replicas 2
+"""
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import click
+import toml
+
+from dataset import make_groups, make_people
+from stubs import IPAState, make_fas_server, make_ipa_server
+
+TOP_DIR = pathlib.Path(__file__).resolve().parents[2]
+
+PHASES = {
+    "pull": ["--pull", "--no-push"],
+    "push": ["--no-pull", "--push"],
+    "pipeline": ["--pull", "--push", "--pipeline", "--no-check"],
+    "plan": ["--no-pull", "--push", "--plan", "plan.jsonl"],
+    "execute": ["--execute", "plan.jsonl"],
+}
+
+# Phases which are run unless asked otherwise
+DEFAULT_PHASES = ["pull", "push"]
+
+
+def make_certificate(workdir):
+    """Make a self-signed certificate for the IPA stubs."""
+    certfile = workdir / "ipa.crt"
+    keyfile = workdir / "ipa.key"
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost",
+            "-keyout",
+            str(keyfile),
+            "-out",
+            str(certfile),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def write_config(
+    workdir, fas_server, ipa_servers, certfile, workers, transform_processes
+):
+    description_file = workdir / "agreement.txt"
+    description_file.write_text("The benchmark agreement.\n")
+    config = {
+        "workers": workers,
+        "transform_processes": transform_processes,
+        "retries": 2,
+        "session_cache_file": str(workdir / "fas2ipa-sessions.json"),
+        "state_file": str(workdir / "fas2ipa-state.json"),
+        "journal_file": str(workdir / "fas2ipa-journal.jsonl"),
+        "pattern_cache_file": str(workdir / "fas2ipa-patterns.json"),
+        "metrics_json_file": str(workdir / "fas2ipa-metrics.json"),
+        "fas": {
+            "bench": {
+                "url": f"http://{fas_server.address}/accounts",
+                "username": "bench",
+                "password": "bench",
+                "email_domain": "bench.test",
+                "groups": {
+                    "ignore": ["cla_fpca"],
+                    "umbrella": {"name": "contributors", "description": "Everybody"},
+                },
+                "agreement": [
+                    {
+                        "name": "Benchmark Agreement",
+                        "group_prerequisite": "cla_done",
+                        "signed_groups": ["cla_fpca", "cla_done"],
+                        "description_file": str(description_file),
+                        "signer_group": "signed_agreement",
+                    }
+                ],
+            },
+        },
+        "ipa": {
+            "instances": [server.address for server in ipa_servers],
+            "cert_path": str(certfile),
+            "username": "admin",
+            "password": "bench",
+        },
+    }
+    config_file = workdir / "config.toml"
+    with config_file.open("w") as fobj:
+        toml.dump(config, fobj)
+    return config_file
+
+
+def run_cli(workdir, phase, args):
+    """Run fas2ipa in a subprocess, return its exit code, duration and peak RSS."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [str(TOP_DIR), env.get("PYTHONPATH")])
+    )
+    # python-fedora caches FAS sessions in the home directory
+    env["HOME"] = str(workdir)
+    with (workdir / f"{phase}.log").open("w") as log:
+        start = time.monotonic()
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "from fas2ipa.cli import cli; cli(prog_name='fas2ipa')",
+                *args,
+            ],
+            cwd=workdir,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        _pid, status, rusage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    # ru_maxrss is in KiB on Linux
+    return process.returncode, seconds, rusage.ru_maxrss / 1024
+
+
+@click.command(context_settings={"help_option_names": ("-h", "--help")})
+@click.option("--users", type=click.IntRange(min=1), default=10000, show_default=True)
+@click.option("--groups", type=click.IntRange(min=1), default=500, show_default=True)
+@click.option(
+    "--memberships",
+    type=click.IntRange(min=0),
+    default=3,
+    show_default=True,
+    help="How many groups each user is a member of, besides the agreement's.",
+)
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option(
+    "--phase",
+    "phases",
+    type=click.Choice(sorted(PHASES)),
+    multiple=True,
+    help="Which phases to run, pull and push by default.",
+)
+@click.option(
+    "--dataset-format",
+    type=click.Choice(["json", "jsonl", "pack"]),
+    default="jsonl",
+    show_default=True,
+)
+@click.option("--replicas", type=click.IntRange(min=1), default=1, show_default=True)
+@click.option("--workers", type=click.IntRange(min=1), default=1, show_default=True)
+@click.option(
+    "--transform-processes", type=click.IntRange(min=0), default=0, show_default=True
+)
+@click.option("--fas-latency", type=float, default=0.0, help="Seconds per FAS request.")
+@click.option("--ipa-latency", type=float, default=0.0, help="Seconds per IPA request.")
+@click.option(
+    "--ipa-command-latency",
+    type=float,
+    default=0.0,
+    help="Additional seconds per IPA command, batched or not.",
+)
+@click.option(
+    "--ipa-error-rate",
+    type=click.FloatRange(min=0, max=1),
+    default=0.0,
+    help="Fraction of IPA requests failing with HTTP status 503.",
+)
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Keep the configuration, dataset and logs in this directory.",
+)
+@click.option("--report-file", default=None, help="Also write the report as JSON.")
+@click.argument("cli_args", nargs=-1, type=click.UNPROCESSED)
+def bench(
+    users,
+    groups,
+    memberships,
+    seed,
+    phases,
+    dataset_format,
+    replicas,
+    workers,
+    transform_processes,
+    fas_latency,
+    ipa_latency,
+    ipa_command_latency,
+    ipa_error_rate,
+    workdir,
+    report_file,
+    cli_args,
+):
+    """Pull synthetic users from a FAS stub and push them to IPA stubs.
+
+    Additional CLI_ARGS are passed to fas2ipa.
+    """
+    phases = [phase for phase in PHASES if phase in phases] or DEFAULT_PHASES
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="fas2ipa-bench-")
+    workdir = pathlib.Path(workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    click.echo(f"Working in {workdir}")
+
+    click.echo(f"Generating {users} users and {groups} groups")
+    fas_groups = make_groups(groups, seed=seed)
+    fas_people = make_people(users, fas_groups, memberships=memberships, seed=seed)
+
+    certfile, keyfile = make_certificate(workdir)
+    fas_server = make_fas_server(fas_people, fas_groups, latency=fas_latency)
+    state = IPAState()
+    ipa_servers = [
+        make_ipa_server(
+            state,
+            certfile,
+            keyfile,
+            latency=ipa_latency,
+            command_latency=ipa_command_latency,
+            error_rate=ipa_error_rate,
+        )
+        for _replica in range(replicas)
+    ]
+    servers = [fas_server, *ipa_servers]
+    for server in servers:
+        server.start()
+
+    config_file = write_config(
+        workdir, fas_server, ipa_servers, certfile, workers, transform_processes
+    )
+    dataset_file = workdir / f"dataset.{dataset_format}"
+    reads_dataset = {"push", "plan"} & set(phases)
+    if reads_dataset and "pull" not in phases and not dataset_file.exists():
+        raise click.ClickException(f"Pushing needs {dataset_file} from a pull")
+
+    report = []
+    try:
+        for phase in phases:
+            fas_before = fas_server.counts.copy()
+            ipa_before = sum((server.counts for server in ipa_servers), Counter())
+            args = [
+                *PHASES[phase],
+                "--config",
+                str(config_file),
+                "--dataset-file",
+                str(dataset_file),
+                "--force-overwrite",
+                *cli_args,
+            ]
+            click.echo(f"Running the {phase} phase")
+            returncode, seconds, max_rss = run_cli(workdir, phase, args)
+            fas_counts = fas_server.counts - fas_before
+            ipa_counts = (
+                sum((server.counts for server in ipa_servers), Counter()) - ipa_before
+            )
+            report.append(
+                {
+                    "phase": phase,
+                    "exit_code": returncode,
+                    "users": users,
+                    "seconds": seconds,
+                    "users_per_second": users / seconds,
+                    "fas_requests": sum(fas_counts.values()),
+                    "ipa_requests": ipa_counts["json"] + ipa_counts["login"],
+                    "ipa_commands": sum(
+                        count
+                        for name, count in ipa_counts.items()
+                        if name not in ("json", "login", "injected_errors")
+                    ),
+                    "ipa_logins": ipa_counts["login"],
+                    "ipa_injected_errors": ipa_counts["injected_errors"],
+                    "peak_rss_mib": max_rss,
+                }
+            )
+            if returncode:
+                click.echo(
+                    f"fas2ipa failed with exit code {returncode},"
+                    f" see {workdir / phase}.log"
+                )
+                break
+    finally:
+        for server in servers:
+            server.stop()
+
+    for entry in report:
+        requests = entry["fas_requests"] + entry["ipa_requests"]
+        click.echo(
+            f"{entry['phase']:>5}: {entry['seconds']:9.2f}s"
+            f" {entry['users_per_second']:10.1f} users/s"
+            f" {requests / users:8.3f} requests/user"
+            f" ({entry['fas_requests']} FAS, {entry['ipa_requests']} IPA"
+            f" with {entry['ipa_commands']} commands)"
+            f" {entry['peak_rss_mib']:8.1f} MiB peak RSS"
+        )
+
+    if report_file:
+        with open(report_file, "w") as fobj:
+            json.dump(report, fobj, indent=2)
+
+
+if __name__ == "__main__":
+    bench()
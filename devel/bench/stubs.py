@@ -0,0 +1,520 @@
+"""Local stand-ins for FAS and FreeIPA, serving synthetic data over HTTP(S).
+
+They implement just enough of the FAS JSON API and of the FreeIPA JSON-RPC API for
+fas2ipa to pull and push, and count the requests and commands they serve.
+"""
+import bisect
+import json
+import random
+import ssl
+import threading
+import time
+from collections import Counter
+from fnmatch import fnmatchcase
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Options of IPA commands which aren't stored as attributes
+IGNORED_OPTIONS = {
+    "all",
+    "external",
+    "no_members",
+    "nonposix",
+    "pkey_only",
+    "random",
+    "raw",
+    "rights",
+    "sizelimit",
+    "timelimit",
+    "version",
+}
+
+# Attributes of groups and agreements listing their members
+MEMBER_ATTRIBUTES = {
+    "member_user",
+    "member_group",
+    "membermanager_user",
+    "memberuser_user",
+}
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _search(names, pattern):
+    """Get the names in a sorted list which match a FAS search pattern."""
+    prefix = pattern[:-1]
+    if pattern.endswith("*") and not any(c in prefix for c in "*?["):
+        # Prefix searches are looked up in the sorted list
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+    return [name for name in names if fnmatchcase(name, pattern)]
+
+
+class IPAError(Exception):
+    def __init__(self, code, name, message):
+        super().__init__(message)
+        self.code = code
+        self.name = name
+        self.message = message
+
+
+def _not_found(name, kind):
+    return IPAError(4001, "NotFound", f"{name}: {kind} not found")
+
+
+def _duplicate(name, kind):
+    return IPAError(4002, "DuplicateEntry", f'{kind} with name "{name}" already exists')
+
+
+class IPAState:
+    """The users, groups and agreements of a stub IPA, shared between replicas."""
+
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+        self.agreements = {}
+        self.automember_rules = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _attributes(params):
+        attributes = {}
+        for key, value in params.items():
+            if key in IGNORED_OPTIONS or value is None:
+                continue
+            if key in ("setattr", "addattr"):
+                for item in _as_list(value):
+                    name, _sep, item_value = item.partition("=")
+                    attributes.setdefault(name, []).append(item_value)
+                continue
+            attributes[key] = _as_list(value)
+        return attributes
+
+    @staticmethod
+    def _result(entry, params=None):
+        no_members = bool(params and params.get("no_members"))
+        return {
+            key: sorted(value) if key in MEMBER_ATTRIBUTES else list(value)
+            for key, value in entry.items()
+            if not (no_members and key in MEMBER_ATTRIBUTES)
+        }
+
+    @staticmethod
+    def _modify(entry, attributes):
+        if all(entry.get(key) == value for key, value in attributes.items()):
+            raise IPAError(4202, "EmptyModlist", "no modifications to be performed")
+        entry.update(attributes)
+
+    def execute(self, method, args, params):
+        """Execute an IPA command and return its result."""
+        command = getattr(self, "_" + method.split("/")[0], None)
+        if command is None:
+            raise IPAError(905, "CommandError", f"unknown command '{method}'")
+        with self._lock:
+            return command(_as_list(args), params)
+
+    def _find(self, entries, args, params):
+        criteria = args[0] if args else ""
+        sizelimit = params.get("sizelimit", 100)
+        names = [name for name in sorted(entries) if criteria in name]
+        truncated = bool(sizelimit) and len(names) > sizelimit
+        if truncated:
+            names = names[:sizelimit]
+        return {
+            "result": [self._result(entries[name], params) for name in names],
+            "count": len(names),
+            "truncated": truncated,
+        }
+
+    def _user_add(self, args, params):
+        name = args[0]
+        if name in self.users:
+            raise _duplicate(name, "user")
+        entry = self._attributes(params)
+        entry["uid"] = [name]
+        entry.setdefault("nsaccountlock", [False])
+        self.users[name] = entry
+        return {"result": self._result(entry), "value": name}
+
+    def _user_mod(self, args, params):
+        name = args[0]
+        if name not in self.users:
+            raise _not_found(name, "user")
+        self._modify(self.users[name], self._attributes(params))
+        return {"result": self._result(self.users[name]), "value": name}
+
+    def _user_show(self, args, params):
+        name = args[0]
+        if name not in self.users:
+            raise _not_found(name, "user")
+        return {"result": self._result(self.users[name], params), "value": name}
+
+    def _user_find(self, args, params):
+        return self._find(self.users, args, params)
+
+    def _group_add(self, args, params):
+        name = args[0]
+        if name in self.groups:
+            raise _duplicate(name, "group")
+        entry = self._attributes(params)
+        entry["cn"] = [name]
+        for attribute in ("member_user", "membermanager_user", "member_group"):
+            entry[attribute] = set()
+        self.groups[name] = entry
+        return {"result": self._result(entry), "value": name}
+
+    def _group_mod(self, args, params):
+        name = args[0]
+        if name not in self.groups:
+            raise _not_found(name, "group")
+        self._modify(self.groups[name], self._attributes(params))
+        return {"result": self._result(self.groups[name]), "value": name}
+
+    def _group_show(self, args, params):
+        name = args[0]
+        if name not in self.groups:
+            raise _not_found(name, "group")
+        return {"result": self._result(self.groups[name], params), "value": name}
+
+    def _group_find(self, args, params):
+        return self._find(self.groups, args, params)
+
+    def _change_members(self, entries, kind, args, params, section, add):
+        name = args[0]
+        if name not in entries:
+            raise _not_found(name, kind)
+        entry = entries[name]
+        failed = {section: {"user": [], "group": []}}
+        completed = 0
+        for member_kind, existing in (("user", self.users), ("group", self.groups)):
+            attribute = f"{section}_{member_kind}"
+            members = entry.setdefault(attribute, set())
+            for member in _as_list(params.get(member_kind)):
+                if add and member not in existing:
+                    failed[section][member_kind].append([member, "no such entry"])
+                elif add and member in members:
+                    failed[section][member_kind].append(
+                        [member, "This entry is already a member"]
+                    )
+                elif not add and member not in members:
+                    failed[section][member_kind].append(
+                        [member, "This entry is not a member"]
+                    )
+                else:
+                    if add:
+                        members.add(member)
+                    else:
+                        members.remove(member)
+                    completed += 1
+        return {"result": self._result(entry), "failed": failed, "completed": completed}
+
+    def _group_add_member(self, args, params):
+        return self._change_members(self.groups, "group", args, params, "member", True)
+
+    def _group_remove_member(self, args, params):
+        return self._change_members(self.groups, "group", args, params, "member", False)
+
+    def _group_add_member_manager(self, args, params):
+        return self._change_members(
+            self.groups, "group", args, params, "membermanager", True
+        )
+
+    def _group_remove_member_manager(self, args, params):
+        return self._change_members(
+            self.groups, "group", args, params, "membermanager", False
+        )
+
+    def _fasagreement_add(self, args, params):
+        name = args[0]
+        if name in self.agreements:
+            raise _duplicate(name, "agreement")
+        entry = self._attributes(params)
+        entry["cn"] = [name]
+        entry["member_group"] = set()
+        entry["memberuser_user"] = set()
+        self.agreements[name] = entry
+        return {"result": self._result(entry), "value": name}
+
+    def _fasagreement_show(self, args, params):
+        name = args[0]
+        if name not in self.agreements:
+            raise _not_found(name, "agreement")
+        return {"result": self._result(self.agreements[name]), "value": name}
+
+    def _fasagreement_add_group(self, args, params):
+        return self._change_members(
+            self.agreements, "agreement", args, params, "member", True
+        )
+
+    def _fasagreement_add_user(self, args, params):
+        return self._change_members(
+            self.agreements, "agreement", args, params, "memberuser", True
+        )
+
+    def _fasagreement_remove_user(self, args, params):
+        return self._change_members(
+            self.agreements, "agreement", args, params, "memberuser", False
+        )
+
+    def _automember_add(self, args, params):
+        name = args[0]
+        if name in self.automember_rules:
+            raise _duplicate(name, "auto member rule")
+        self.automember_rules.add(name)
+        return {"result": {"cn": [name]}, "value": name}
+
+    def _automember_add_condition(self, args, params):
+        return {"result": {"cn": [args[0]]}, "completed": 1, "value": args[0]}
+
+    def _session_logout(self, args, params):
+        return {"result": None}
+
+    def _ping(self, args, params):
+        return {"summary": "IPA server version 4.8.10. API version 2.237"}
+
+
+class StubServer(ThreadingHTTPServer):
+    """A threaded HTTP server, optionally speaking TLS, which counts requests."""
+
+    daemon_threads = True
+
+    def __init__(self, handler_class, certfile=None, keyfile=None):
+        super().__init__(("localhost", 0), handler_class)
+        if certfile is not None:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        else:
+            self.ssl_context = None
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        return f"localhost:{self.server_address[1]}"
+
+    def count(self, *names):
+        with self._counts_lock:
+            self.counts.update(names)
+
+    def finish_request(self, request, client_address):
+        # The TLS handshake happens in the thread handling the connection
+        if self.ssl_context is not None:
+            request = self.ssl_context.wrap_socket(request, server_side=True)
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            if self.ssl_context is not None:
+                request.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive, like FAS and IPA behind Apache
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _cookies(self):
+        return SimpleCookie(self.headers.get("Cookie", ""))
+
+    def _respond(self, status, body, content_type="application/json", headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FASHandler(_Handler):
+    """Serve /user/list and /group/list of the FAS JSON API."""
+
+    # Set by make_fas_server()
+    people = None
+    usernames = None
+    groups = None
+    group_names = None
+    latency = 0.0
+
+    def do_POST(self):
+        params = parse_qs(self._read_body().decode("utf-8"))
+        if "user_name" not in params and "tg-visit" not in self._cookies():
+            self.server.count("unauthorized")
+            self._respond(401, {"exc": "AuthError"})
+            return
+
+        path = urlsplit(self.path).path.rstrip("/")
+        search = params.get("search", ["*"])[0]
+        if path.endswith("/user/list"):
+            body = {
+                "people": [
+                    self.people[name] for name in _search(self.usernames, search)
+                ],
+                "unapproved_people": [],
+            }
+        elif path.endswith("/group/list"):
+            body = {
+                "groups": [
+                    self.groups[name] for name in _search(self.group_names, search)
+                ]
+            }
+        else:
+            self.server.count("not_found")
+            self._respond(404, {"exc": "NotFound"})
+            return
+
+        self.server.count(path.rsplit("/", 2)[-2])
+        time.sleep(self.latency)
+        self._respond(200, body, headers=[("Set-Cookie", "tg-visit=bench; Path=/")])
+
+
+def make_fas_server(people, groups, latency=0.0):
+    """Make a FAS stub serving people and groups, as FAS returns them."""
+    handler_class = type(
+        "FASHandler",
+        (FASHandler,),
+        {
+            "people": {person["username"]: person for person in people},
+            "usernames": sorted(person["username"] for person in people),
+            "groups": {group["name"]: group for group in groups},
+            "group_names": sorted(group["name"] for group in groups),
+            "latency": latency,
+        },
+    )
+    return StubServer(handler_class)
+
+
+class IPAHandler(_Handler):
+    """Serve the login and JSON-RPC endpoints of FreeIPA."""
+
+    # Set by make_ipa_server()
+    state = None
+    latency = 0.0
+    command_latency = 0.0
+    error_rate = 0.0
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self._read_body()
+
+        if path == "/ipa/session/login_password":
+            self.server.count("login")
+            time.sleep(self.latency)
+            session = f"MagBearerToken={random.getrandbits(64):016x}"
+            self._respond(
+                200,
+                b"",
+                content_type="text/plain",
+                headers=[("Set-Cookie", f"ipa_session={session}; Path=/ipa; Secure")],
+            )
+            return
+
+        if path != "/ipa/session/json":
+            self.server.count("not_found")
+            self._respond(404, b"Not Found", content_type="text/plain")
+            return
+
+        if "ipa_session" not in self._cookies():
+            self.server.count("unauthorized")
+            self._respond(401, b"Unauthorized", content_type="text/plain")
+            return
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.server.count("injected_errors")
+            time.sleep(self.latency)
+            self._respond(503, b"Service Unavailable", content_type="text/plain")
+            return
+
+        request = json.loads(body)
+        method = request["method"]
+        args, params = request["params"]
+        if method == "batch":
+            commands = [(command["method"], *command["params"]) for command in args]
+        else:
+            commands = [(method, args, params)]
+        self.server.count("json", *(command[0] for command in commands))
+        time.sleep(self.latency + self.command_latency * len(commands))
+
+        if method == "batch":
+            results = []
+            for command_method, command_args, command_params in commands:
+                try:
+                    result = self.state.execute(
+                        command_method, command_args, command_params
+                    )
+                except IPAError as e:
+                    results.append(
+                        {
+                            "error": e.message,
+                            "error_code": e.code,
+                            "error_name": e.name,
+                            "error_kw": {},
+                        }
+                    )
+                else:
+                    results.append(dict(result, error=None))
+            response = {
+                "result": {"count": len(results), "results": results},
+                "error": None,
+            }
+        else:
+            try:
+                response = {
+                    "result": self.state.execute(method, args, params),
+                    "error": None,
+                }
+            except IPAError as e:
+                response = {
+                    "result": None,
+                    "error": {"code": e.code, "name": e.name, "message": e.message},
+                }
+        response.update(id=request.get("id"), principal="admin@BENCH.TEST")
+        self._respond(200, response)
+
+
+def make_ipa_server(
+    state, certfile, keyfile, latency=0.0, command_latency=0.0, error_rate=0.0
+):
+    """Make an IPA stub replica serving state over HTTPS.
+
+    Every request takes latency seconds, plus command_latency seconds for each
+    command it contains. A fraction error_rate of JSON-RPC requests fail with HTTP
+    status 503.
+    """
+    handler_class = type(
+        "IPAHandler",
+        (IPAHandler,),
+        {
+            "state": state,
+            "latency": latency,
+            "command_latency": command_latency,
+            "error_rate": error_rate,
+        },
+    )
+    return StubServer(handler_class, certfile=certfile, keyfile=keyfile)
@@ -1,20 +1,36 @@
-from typing import Any, Dict, List, Sequence
+from collections import defaultdict
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-import click
-import progressbar
 import python_freeipa
 
-from .status import Status, print_status
+from .records import Group
+from .status import OUTPUT, Status, echo, print_status
 from .utils import ObjectManager
 
 
-def find_requirements(groups: Sequence[dict], prereq_id: int) -> List[str]:
-    dependent_groups = []
+def index_prerequisites(groups: Iterable[Group]) -> Dict[int, List[Group]]:
+    """Index groups by the id of their prerequisite group."""
+    dependents = defaultdict(list)
     for group in groups:
-        if group["prerequisite_id"] == prereq_id:
-            dependent_groups.append(group["name"])
-            subdeps = find_requirements(groups, group["id"])
-            dependent_groups.extend(subdeps)
+        if group.prerequisite_id is not None:
+            dependents[group.prerequisite_id].append(group)
+    return dependents
+
+
+def find_requirements(dependents: Dict[int, List[Group]], prereq_id: int) -> List[str]:
+    """List the groups requiring a group, directly or not, depth first."""
+    dependent_groups = []
+    seen = {prereq_id}
+    stack = [iter(dependents.get(prereq_id, ()))]
+    while stack:
+        group = next(stack[-1], None)
+        if group is None:
+            stack.pop()
+        elif group.id not in seen:
+            seen.add(group.id)
+            dependent_groups.append(group.name)
+            stack.append(iter(dependents.get(group.id, ())))
     return dependent_groups
 
 
@@ -22,25 +38,36 @@ class Agreements(ObjectManager):
     def _create_agreement(self, name, description, group_name):
         # Create agreement
         try:
-            self.ipa._request(
-                "fasagreement_add", name, {"description": description},
+            self.ipa_call(
+                name,
+                "_request",
+                "fasagreement_add",
+                name,
+                {"description": description},
             )
         except python_freeipa.exceptions.DuplicateEntry as e:
             print_status(Status.SKIPPED, str(e))
         # Create the corresponding group
         try:
-            self.ipa.group_add(group_name, description=f"Signers of the {name}")
+            self.ipa_call(
+                group_name,
+                "group_add",
+                group_name,
+                description=f"Signers of the {name}",
+            )
         except python_freeipa.exceptions.DuplicateEntry:
             pass
         # Add the automember rule
         try:
-            self.ipa._request(
-                "automember_add", group_name, {"type": "group"},
+            self.ipa_call(
+                group_name, "_request", "automember_add", group_name, {"type": "group"},
             )
         except python_freeipa.exceptions.DuplicateEntry:
             pass
         else:
-            self.ipa._request(
+            self.ipa_call(
+                group_name,
+                "_request",
                 "automember_add_condition",
                 group_name,
                 {
@@ -50,8 +77,20 @@ class Agreements(ObjectManager):
                 },
             )
 
+    def _agreement_members(self, name: str) -> Tuple[Set[str], Set[str]]:
+        """Get the groups requiring an agreement in IPA, and the users who signed it."""
+        try:
+            agreement = self.ipa_call(name, "_request", "fasagreement_show", name)
+        except python_freeipa.exceptions.NotFound:
+            return set(), set()
+        agreement = agreement["result"]
+        return (
+            {group.lower() for group in agreement.get("member_group", ())},
+            {user.lower() for user in agreement.get("memberuser_user", ())},
+        )
+
     def push_to_ipa(self):
-        click.echo("Creating Agreements")
+        echo("Creating Agreements")
         for fas_name, fas_config in self.config["fas"].items():
             for agreement in fas_config.get("agreement", ()):
                 with open(agreement["description_file"], "r") as f:
@@ -61,69 +100,146 @@ class Agreements(ObjectManager):
                     agreement["name"], agreement_description, group_name
                 )
 
-    def record_user_signatures(self, agreements_to_usernames: Dict[str, List[str]]):
+    def record_user_signatures(
+        self, agreements_to_usernames: Dict[str, List[str]]
+    ) -> Optional[Set[str]]:
+        """Record agreement signatures, return the agreements with failures."""
         if self.config["skip_user_signature"]:
-            return
+            return None
+
+        failed = set()
+        agreements_to_usernames = self.not_journaled("signers", agreements_to_usernames)
 
         for fas_name, fas_conf in self.config["fas"].items():
             for agreement in fas_conf.get("agreement", ()):
-                click.echo(f"Recording signers of the {agreement['name']} agreement")
+                echo(f"Recording signers of the {agreement['name']} agreement")
                 signers = agreements_to_usernames.get(agreement["name"], [])
+                if signers:
+                    # Only record signatures missing in IPA
+                    _, existing_signers = self._agreement_members(agreement["name"])
+                    already_signed = [
+                        u for u in signers if u.lower() in existing_signers
+                    ]
+                    self.journal.record_users(
+                        "signers", agreement["name"], already_signed
+                    )
+                    if already_signed:
+                        signers = [
+                            u for u in signers if u.lower() not in existing_signers
+                        ]
                 if not signers:
-                    click.echo("Nothing to do.")
+                    echo("Nothing to do.")
                     continue
                 counter = 0
-                with progressbar.ProgressBar(
-                    max_value=len(signers), redirect_stdout=True
-                ) as bar:
-                    for chunk in self.chunks(signers):
+                with OUTPUT.progress_bar(len(signers)) as bar:
+
+                    chunker = self.chunker("fasagreement_add_user")
+
+                    def signatures_recorded(chunk, result, error):
+                        nonlocal counter
+
                         counter += len(chunk)
-                        self.check_reauth(counter)
-                        response = self.ipa._request(
-                            "fasagreement_add_user", agreement["name"], {"user": chunk},
+                        bar.update(counter)
+                        chunker.observe(
+                            len(chunk), self.batch.command_seconds, error is not None
                         )
-                        for msg in response["failed"]["memberuser"]["user"]:
+                        if error is not None:
+                            failed.add(agreement["name"])
+                            print_status(
+                                Status.FAILED,
+                                f"Could not mark {chunk} as having signed "
+                                f"{agreement['name']}: {error}",
+                            )
+                            return
+                        done = set(chunk)
+                        for msg in result["failed"]["memberuser"]["user"]:
                             if msg[1] != "This entry is already a member":
+                                done.discard(msg[0])
+                                failed.add(agreement["name"])
                                 print_status(
                                     Status.FAILED,
                                     f"Could not mark {msg[0]} as having signed "
                                     f"{agreement['name']}: {msg[1]}",
                                 )
-                        bar.update(counter)
+                        self.journal.record_users("signers", agreement["name"], done)
+
+                    for chunk in chunker.chunks(signers):
+                        self.batch.add(
+                            "fasagreement_add_user",
+                            agreement["name"],
+                            {"user": chunk},
+                            callback=partial(signatures_recorded, chunk),
+                        )
+                    self.batch.flush()
 
-    def record_group_requirements(self, groups: Dict[str, List[Dict[str, Any]]]):
+        return failed
+
+    def record_group_requirements(self, groups: Dict[str, List[Group]]):
         for fas_name, fas_conf in self.config["fas"].items():
-            for agreement in fas_conf.get("agreement", ()):
-                for group in groups[fas_name]:
-                    if group["name"] == agreement["group_prerequisite"]:
-                        toplevel_prereq = group["id"]
-                        break
-                else:
+            agreements = fas_conf.get("agreement", ())
+            if not agreements:
+                continue
+            prefix = fas_conf["groups"].get("prefix", "")
+            groups_by_name = {group.name: group for group in groups[fas_name]}
+            dependents = index_prerequisites(groups[fas_name])
+
+            for agreement in agreements:
+                toplevel_prereq = groups_by_name.get(agreement["group_prerequisite"])
+                if toplevel_prereq is None:
                     raise RuntimeError(
                         f"Toplevel prerequisite {agreement['group_prerequisite']} for"
                         f" agreement {agreement['name']!r} not found."
                     )
 
-                agreement_required = find_requirements(
-                    groups[fas_name], toplevel_prereq
-                )
+                agreement_required = find_requirements(dependents, toplevel_prereq.id)
 
-                for dep_name in progressbar.progressbar(
-                    agreement_required, redirect_stdout=True
-                ):
-                    result = self.ipa._request(
-                        "fasagreement_add_group",
-                        agreement["name"],
-                        {"group": fas_conf["groups"].get("prefix", "") + dep_name},
-                    )
-                    if result["completed"]:
+                # Only add groups which don't require the agreement in IPA yet
+                existing_groups, _ = self._agreement_members(agreement["name"])
+                missing = []
+                for dep_name in agreement_required:
+                    if (prefix + dep_name).lower() in existing_groups:
                         print_status(
-                            Status.ADDED,
-                            f"Marking {dep_name} as requiring the {agreement['name']}",
+                            Status.SKIPPED,
+                            f"{dep_name} already requires {agreement['name']}",
                         )
                     else:
-                        error_msg = result["failed"]["member"]["group"][0][1]
-                        if error_msg == "This entry is already a member":
+                        missing.append(dep_name)
+
+                if not missing:
+                    continue
+
+                chunker = self.chunker("fasagreement_add_group")
+                bar = OUTPUT.progress_bar(len(missing))
+                counter = 0
+
+                def requirements_added(chunk, result, error):
+                    nonlocal counter
+
+                    counter += len(chunk)
+                    bar.update(counter)
+                    chunker.observe(
+                        len(chunk), self.batch.command_seconds, error is not None
+                    )
+                    if error is not None:
+                        for dep_name in chunk:
+                            print_status(
+                                Status.FAILED,
+                                f"Could not mark {dep_name} as requiring the"
+                                f" {agreement['name']}: {error}",
+                            )
+                        return
+                    failed = {
+                        name.lower(): msg
+                        for name, msg in result["failed"]["member"]["group"]
+                    }
+                    for dep_name in chunk:
+                        error_msg = failed.get((prefix + dep_name).lower())
+                        if error_msg is None:
+                            print_status(
+                                Status.ADDED,
+                                f"Marking {dep_name} as requiring the {agreement['name']}",
+                            )
+                        elif error_msg == "This entry is already a member":
                             print_status(
                                 Status.SKIPPED,
                                 f"{dep_name} already requires {agreement['name']}",
@@ -131,4 +247,18 @@ class Agreements(ObjectManager):
                         elif error_msg == "no such entry":
                             print_status(Status.FAILED, f"No group named {dep_name}")
                         else:
-                            print(result["failed"])
+                            print_status(
+                                Status.FAILED,
+                                f"Could not mark {dep_name} as requiring the"
+                                f" {agreement['name']}: {error_msg}",
+                            )
+
+                with bar:
+                    for chunk in chunker.chunks(missing):
+                        self.batch.add(
+                            "fasagreement_add_group",
+                            agreement["name"],
+                            {"group": [prefix + dep_name for dep_name in chunk]},
+                            callback=partial(requirements_added, chunk),
+                        )
+                    self.batch.flush()
@@ -0,0 +1,306 @@
+import asyncio
+import json
+import ssl
+import threading
+from concurrent.futures import Future
+from hashlib import sha1
+from http import HTTPStatus
+from typing import Any, Dict, Optional
+from urllib.parse import quote, urljoin
+
+import click
+import requests
+from fedora.client import AppError, AuthError, ServerError
+from munch import Munch
+from python_freeipa import ClientLegacy
+from python_freeipa import exceptions
+from requests.cookies import morsel_to_cookie
+
+
+# Exceptions raised by ClientLegacy.login() by reason given by IPA
+LOGIN_REJECTIONS = {
+    "password-expired": exceptions.PasswordExpired,
+    "krbprincipal-expired": exceptions.KrbPrincipalExpired,
+    "denied": exceptions.Denied,
+    "invalid-password": exceptions.InvalidSessionPassword,
+    "user-locked": exceptions.UserLocked,
+}
+
+
+def _form_items(params: Dict[str, Any]):
+    """Flatten form parameters with several values, like requests does."""
+    items = []
+    for name, value in params.items():
+        if isinstance(value, (list, tuple)):
+            items.extend((name, str(item)) for item in value)
+        elif value is not None:
+            items.append((name, str(value)))
+    return items
+
+
+class Response:
+    """An HTTP response, with its body read."""
+
+    __slots__ = ("url", "status", "headers", "cookies", "body")
+
+    def __init__(self, url, status, headers, cookies, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.cookies = cookies
+        self.body = body
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    @property
+    def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+
+class AsyncEngine:
+    """Send HTTP requests from an asyncio event loop running in a background thread.
+
+    Requests can be submitted from any thread and many of them can be in flight at
+    once: they're coroutines running on the loop, whose results are handed back as
+    concurrent futures. Connections are pooled and at most connections_per_host of
+    them are opened to each host, further requests wait for one to be free.
+
+    Connection errors and timeouts are raised as their equivalents in requests, which
+    the rest of fas2ipa knows how to handle.
+    """
+
+    def __init__(self, connections_per_host: int):
+        try:
+            import aiohttp
+        except ImportError:
+            raise click.ClickException(
+                "The async engine needs aiohttp, install fas2ipa with the async extra."
+            )
+        self._aiohttp = aiohttp
+        self.connections_per_host = connections_per_host
+        self._ssl_contexts = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._session = self.submit(self._create_session()).result()
+
+    async def _create_session(self):
+        aiohttp = self._aiohttp
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=0, limit_per_host=self.connections_per_host
+            ),
+            # Clients keep their own cookies
+            cookie_jar=aiohttp.DummyCookieJar(),
+            # Like requests, don't time out unless asked to
+            timeout=aiohttp.ClientTimeout(total=None),
+        )
+
+    def submit(self, coroutine) -> Future:
+        """Run a coroutine on the event loop."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _ssl(self, verify):
+        # Like requests: whether to verify certificates or a file of CA certificates
+        if not isinstance(verify, str):
+            return verify is not False
+        if verify not in self._ssl_contexts:
+            self._ssl_contexts[verify] = ssl.create_default_context(cafile=verify)
+        return self._ssl_contexts[verify]
+
+    async def post(
+        self,
+        url: str,
+        data,
+        headers: Optional[Dict[str, str]] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        verify=True,
+        timeout: Optional[float] = None,
+    ) -> Response:
+        """Send a POST request, from the event loop.
+
+        Like in requests, the timeout applies to connecting and to every read.
+        """
+        aiohttp = self._aiohttp
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(
+                total=None, sock_connect=timeout, sock_read=timeout
+            )
+        try:
+            async with self._session.post(
+                url,
+                data=data,
+                headers=headers,
+                cookies=cookies,
+                ssl=self._ssl(verify),
+                **kwargs,
+            ) as response:
+                body = await response.read()
+        except asyncio.TimeoutError as e:
+            raise requests.exceptions.Timeout(f"Request to {url} timed out") from e
+        except aiohttp.ClientError as e:
+            raise requests.exceptions.ConnectionError(f"{url}: {e}") from e
+        return Response(url, response.status, response.headers, response.cookies, body)
+
+    def close(self):
+        self.submit(self._session.close()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+class AsyncIPAClient(ClientLegacy):
+    """An IPA client sending its requests through the async engine.
+
+    All commands of ClientLegacy go through _request(), which waits for the response.
+    request_async() sends a command without waiting. Session cookies are kept in the
+    cookie jar of the requests session like ClientLegacy does, so they're cached and
+    renewed the same way.
+    """
+
+    def __init__(self, engine: AsyncEngine, host, verify_ssl=True, version=None):
+        super().__init__(host=host, verify_ssl=verify_ssl, version=version)
+        self._engine = engine
+
+    def _store_cookies(self, response: Response):
+        for morsel in response.cookies.values():
+            self._session.cookies.set_cookie(morsel_to_cookie(morsel))
+
+    def _login(self, username, password):
+        login_url = f"https://{self._current_host}/ipa/session/login_password"
+        response = self._engine.submit(
+            self._engine.post(
+                login_url,
+                {"user": username, "password": password},
+                headers={"Referer": login_url, "Accept": "text/plain"},
+                verify=self._verify_ssl,
+            )
+        ).result()
+        if not response.ok:
+            reason = response.headers.get("X-IPA-Rejection-Reason")
+            if reason in LOGIN_REJECTIONS:
+                raise LOGIN_REJECTIONS[reason]()
+            raise exceptions.Unauthorized(response.text)
+        self._store_cookies(response)
+        self.log.info(f"Successfully logged in as {username}")
+
+    async def _send(self, method, args, params):
+        session_url = f"https://{self._current_host}/ipa/session/json"
+        headers = {
+            "Referer": f"https://{self._current_host}/ipa",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        if not args:
+            args = []
+        elif not isinstance(args, list):
+            args = [args]
+        params = dict(params or {})
+        if self._version:
+            params.setdefault("version", self._version)
+
+        response = await self._engine.post(
+            session_url,
+            json.dumps({"method": method, "params": [args, params]}),
+            headers=headers,
+            cookies=self._session.cookies.get_dict(),
+            verify=self._verify_ssl,
+        )
+        if response.status == 401:
+            raise exceptions.Unauthorized()
+        if not response.ok:
+            raise exceptions.FreeIPAError(message=response.text, code=response.status)
+        result = json.loads(response.body)
+        if result["error"]:
+            exceptions.parse_error(result["error"])
+        return result["result"]
+
+    def request_async(self, method, args=None, params=None) -> Future:
+        """Send a command, return the future of its result."""
+        return self._engine.submit(self._send(method, args, params))
+
+    def _request(self, method, args=None, params=None):
+        return self.request_async(method, args, params).result()
+
+
+class AsyncFASClient:
+    """A FAS client sending its requests through the async engine.
+
+    Requests are authenticated like python-fedora's AccountSystem does: with the
+    username and password, and the session the server returned, if any.
+    """
+
+    session_name = "tg-visit"
+
+    def __init__(self, engine: AsyncEngine, base_url: str, username, password):
+        self._engine = engine
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.username = username
+        self.password = password
+        self.session_id = None
+
+    async def _send(self, method, req_params, auth, timeout):
+        url = urljoin(self.base_url, quote(method.lstrip("/")))
+        params = dict(req_params or {})
+        cookies = {}
+        if self.session_id:
+            cookies[self.session_name] = self.session_id
+            params["_csrf_token"] = sha1(self.session_id.encode("utf-8")).hexdigest()
+        if auth:
+            params.update(
+                {
+                    "user_name": self.username,
+                    "password": self.password,
+                    "login": "Login",
+                }
+            )
+
+        response = await self._engine.post(
+            url,
+            _form_items(params),
+            headers={"Accept": "application/json"},
+            cookies=cookies,
+            timeout=timeout,
+        )
+        if response.status in (401, 403):
+            raise AuthError(
+                "Unable to log into server.  Invalid authentication tokens.  Send new"
+                " username and password"
+            )
+        if not response.ok:
+            try:
+                msg = HTTPStatus(response.status).phrase
+            except ValueError:
+                msg = "Unknown HTTP Server Response"
+            raise ServerError(url, response.status, msg)
+
+        session = response.cookies.get(self.session_name)
+        if session is not None:
+            self.session_id = session.value
+
+        try:
+            # Parse straight into Munch objects, like python-fedora returns
+            data = json.loads(response.body, object_hook=Munch)
+        except ValueError as e:
+            raise ServerError(
+                url,
+                response.status,
+                f"Error returned from json module while processing {url}: {e}",
+            )
+        if "exc" in data:
+            name = data.pop("exc")
+            message = data.pop("tg_flash")
+            raise AppError(name=name, message=message, extras=data)
+        return data
+
+    def send_request_async(
+        self, method, req_params=None, auth=False, timeout=None
+    ) -> Future:
+        """Send a request, return the future of its data."""
+        return self._engine.submit(self._send(method, req_params, auth, timeout))
+
+    def send_request(self, method, req_params=None, auth=False, timeout=None):
+        return self.send_request_async(method, req_params, auth, timeout).result()
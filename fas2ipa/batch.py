@@ -0,0 +1,233 @@
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import python_freeipa
+from python_freeipa.exceptions import BadRequest, error_codes
+
+from .metrics import METRICS
+from .plan import is_read_command
+from .router import is_replica_failure
+
+
+def _as_list(args):
+    if args is None:
+        return []
+    if not isinstance(args, list):
+        return [args]
+    return args
+
+
+class _Request:
+    """A request sending commands to a replica, retried until it's done."""
+
+    __slots__ = ("index", "ops", "tried", "logged_in", "start", "seconds", "results")
+
+    def __init__(self, index, ops):
+        self.index = index
+        self.ops = ops
+        self.tried = set()
+        self.logged_in = False
+        self.start = time.monotonic()
+        # How long the request took until it was done, retries included
+        self.seconds = 0.0
+        self.results = None
+
+    def done(self, results, end):
+        self.results = results
+        self.seconds = end - self.start
+
+
+class Batch:
+    """Queue IPA commands and send them in server-side ``batch`` requests.
+
+    Every queued command gets a future which is resolved once its batch has been
+    sent. If a callback is passed, it's called with the command's result and error
+    (one of them being None) and its return value becomes the result of the future.
+    Callbacks can read how long a command took on average in ``command_seconds``.
+
+    Commands are sent to the replica picked by the manager's router for their first
+    argument, and retried on another replica if that one fails. When the manager is
+    planning, commands writing to IPA are added to the plan and resolved right away
+    instead.
+
+    Up to ``window`` commands are queued before they're sent, in requests of ``size``
+    commands. With the async engine, all these requests are in flight at once. With
+    the synchronous one, the window is a single request, only the requests to
+    different replicas are sent in parallel.
+    """
+
+    def __init__(self, manager, size: int):
+        self.manager = manager
+        self.size = size
+        if manager.config["engine"] == "async":
+            self.window = size * manager.config["async_requests_in_flight"]
+        else:
+            self.window = size
+        self.command_seconds = 0.0
+        self._queue = []
+        self._executor = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, method, args=None, params=None, callback=None) -> Future:
+        future = Future()
+        op = (method, _as_list(args), params or {}, callback, future)
+        plan = self.manager.plan
+        if plan is not None and not is_read_command(method):
+            self._resolve(op, plan.add(*op[:3]), None)
+            return future
+        self._queue.append(op)
+        if len(self._queue) >= self.window:
+            self.flush()
+        return future
+
+    def flush(self):
+        router = self.manager.router
+        # Callbacks may queue follow-up commands, these are sent in turn.
+        while self._queue:
+            ops = self._queue[: self.window]
+            del self._queue[: self.window]
+            # Commands are routed by their first argument, the name of the user or
+            # group they're about. Those without arguments go to any one replica.
+            default_index = router.pick()
+            replica_ops = defaultdict(list)
+            for op in ops:
+                args = op[1]
+                index = router.pick(str(args[0])) if args else default_index
+                replica_ops[index].append(op)
+            requests = [
+                _Request(index, ops[start : start + self.size])
+                for index, ops in replica_ops.items()
+                for start in range(0, len(ops), self.size)
+            ]
+            self._send(requests)
+            # Run callbacks in this thread
+            for request in requests:
+                self.command_seconds = request.seconds / len(request.ops)
+                for op, (result, error) in zip(request.ops, request.results):
+                    self._resolve(op, result, error)
+
+    def _start(self, ipa, ops, in_parallel: bool) -> Future:
+        """Start sending commands to IPA, return the future of the response."""
+        if len(ops) == 1:
+            method, args, params, _callback, _future = ops[0]
+        else:
+            method = "batch"
+            args = [
+                {"method": method, "params": [args, params]}
+                for method, args, params, _callback, _future in ops
+            ]
+            params = {}
+
+        # Clients of the async engine send requests without blocking
+        request_async = getattr(ipa, "request_async", None)
+        if request_async is not None:
+            return request_async(method, args, params)
+
+        if in_parallel:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=len(self.manager.router.hosts)
+                )
+            return self._executor.submit(ipa._request, method, args, params)
+
+        future = Future()
+        try:
+            future.set_result(ipa._request(method, args, params))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _send(self, requests):
+        """Send requests until they're done, setting their results.
+
+        Requests which failed because the session expired or the replica failed are
+        retried together, after logging in again or on another replica.
+        """
+        router = self.manager.router
+        instances = self.manager.thread_ipa_instances
+        pending = requests
+        while pending:
+            # Before any request is in flight on the clients
+            for index in {request.index for request in pending}:
+                self.manager.sessions.renew_marked(instances[index])
+            attempts = []
+            for request in pending:
+                # Responses are looked at in turn, note when they actually came in
+                times = [time.monotonic(), None]
+                future = self._start(
+                    instances[request.index], request.ops, len(pending) > 1
+                )
+                future.add_done_callback(
+                    lambda _future, times=times: times.__setitem__(1, time.monotonic())
+                )
+                attempts.append((request, times, future))
+
+            pending = []
+            for request, (start, end), future in attempts:
+                index = request.index
+                ops = request.ops
+                error = future.exception()
+                # Done callbacks may not have been called yet
+                end = end or time.monotonic()
+                if isinstance(error, python_freeipa.exceptions.Unauthorized):
+                    self._observe(index, ops, start, end, failed=True)
+                    if request.logged_in:
+                        raise error
+                    self.manager.sessions.login(instances[index])
+                    request.logged_in = True
+                    pending.append(request)
+                elif error is not None:
+                    self._observe(index, ops, start, end, failed=True)
+                    if is_replica_failure(error):
+                        router.report(index, failed=True)
+                        request.tried.add(index)
+                        if len(request.tried) < len(router.hosts):
+                            # Retry on another replica
+                            request.index = router.pick(exclude=request.tried)
+                            pending.append(request)
+                            continue
+                    request.done([(None, error)] * len(ops), end)
+                else:
+                    response = future.result()
+                    if len(ops) == 1:
+                        results = [(response, None)]
+                    else:
+                        results = [
+                            self._parse_item(item) for item in response["results"]
+                        ]
+                    router.report(index, end - start)
+                    self._observe(index, ops, start, end, results=results)
+                    request.done(results, end)
+
+    def _observe(self, index, ops, start, end, failed=False, results=None):
+        # Commands in a batch request are accounted for with their average duration
+        host = self.manager.router.hosts[index]
+        seconds = (end - start) / len(ops)
+        for op_index, (method, *_rest) in enumerate(ops):
+            error = failed or results[op_index][1] is not None
+            METRICS.observe("ipa", method, host, seconds, error)
+
+    @staticmethod
+    def _parse_item(item):
+        if not item.get("error"):
+            return item, None
+        code = item.get("error_code")
+        exception_class = error_codes.get(code, BadRequest)
+        return None, exception_class(item["error"], code)
+
+    @staticmethod
+    def _resolve(op, result, error):
+        method, args, params, callback, future = op
+        if callback is None:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+            return
+        try:
+            future.set_result(callback(result, error))
+        except Exception as e:
+            future.set_exception(e)
@@ -0,0 +1,56 @@
+import threading
+from collections import Counter
+from typing import Dict, Iterator, Sequence
+
+
+class AdaptiveChunker:
+    """Split items into chunks, adapting their size to how IPA copes with them.
+
+    After an error, the chunk size is halved. Chunks which take longer than the
+    target duration shrink the size, chunks which take less than half of it grow the
+    size. The size stays within the configured bounds.
+    """
+
+    def __init__(self, size: int, min_size: int, max_size: int, target_seconds: float):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = self._bounded(size)
+        self.target_seconds = target_seconds
+        # How many chunks of which size were sent
+        self.sizes = Counter()
+        self._lock = threading.Lock()
+
+    def _bounded(self, size):
+        return max(self.min_size, min(self.max_size, size))
+
+    def chunks(self, items: Sequence) -> Iterator[Sequence]:
+        """Yield chunks of items, each with the current chunk size."""
+        pos = 0
+        while pos < len(items):
+            chunk = items[pos : pos + self.size]
+            self.sizes[self.size] += 1
+            pos += len(chunk)
+            yield chunk
+
+    def observe(self, size: int, seconds: float, error: bool = False):
+        """Adapt the chunk size to how processing a chunk of this size went.
+
+        The new size is derived from the observed size, so that all chunks of a
+        failed or slow batch request only shrink the size once.
+        """
+        if error:
+            new_size = size // 2
+        elif seconds > self.target_seconds:
+            new_size = int(size * 0.75)
+        elif seconds < self.target_seconds / 2:
+            new_size = size + max(1, size // 2)
+        else:
+            return
+        with self._lock:
+            if error or seconds > self.target_seconds:
+                self.size = self._bounded(min(self.size, new_size))
+            else:
+                self.size = self._bounded(max(self.size, new_size))
+
+    def stats(self, name: str) -> Dict[str, int]:
+        return {f"chunks_{name}_{size}": count for size, count in self.sizes.items()}
@@ -1,40 +1,83 @@
 import os
 import pathlib
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack
+from functools import partial
+from typing import Optional
 from urllib.parse import parse_qs, urlencode
 
 import click
-import munch
 import vcr
-from python_freeipa import ClientLegacy as Client
+from fedora.client import ServerError
 from fedora.client.fas2 import AccountSystem
-from requests.exceptions import ConnectionError
+from requests.exceptions import RequestException
 
+from .aio import AsyncEngine, AsyncFASClient
 from .config import get_config
+from .executor import PlanExecutor
+from .journal import Journal
+from .metrics import METRICS
+from .plan import Plan
+from .replay import CassetteLibrary
+from .sessions import SessionManager
 from .statistics import Stats
+from .status import OUTPUT, OUTPUT_MODES, echo
 from .users import Users
 from .groups import Groups
 from .agreements import Agreements
-from .utils import load_data, report_conflicts, save_data
+from .utils import (
+    DatasetQueue,
+    DatasetWriter,
+    dataset_to_dicts,
+    is_streamed_file,
+    load_data,
+    load_dataset,
+    make_router,
+    report_conflicts,
+    save_data,
+)
 
 
 class FASWrapper:
 
     _remove_from_request_body = ("_csrf_token", "user_name", "password", "login")
 
-    def __init__(self, config, inst_conf):
+    def __init__(self, config, inst_conf, cassettes=None, engine=None):
+        self.config = config
         self.inst_conf = inst_conf
-        self.fas = AccountSystem(
-            inst_conf["url"],
-            username=inst_conf["username"],
-            password=inst_conf["password"],
-        )
         self._replay = config["replay"]
+        self._engine = engine
+        # Requests are only recorded and replayed with python-fedora
+        if engine is not None and not self._replay:
+            self.fas = AsyncFASClient(
+                engine,
+                inst_conf["url"],
+                username=inst_conf["username"],
+                password=inst_conf["password"],
+            )
+        else:
+            self.fas = AccountSystem(
+                inst_conf["url"],
+                username=inst_conf["username"],
+                password=inst_conf["password"],
+            )
         self._recorder = vcr.VCR(
             ignore_hosts=config["ipa"]["instances"],
             record_mode="new_episodes",
             filter_post_data_parameters=self._remove_from_request_body,
         )
         self._recorder.register_matcher("fas2ipa", self._vcr_match_request)
+        # Recorded responses are shared by clones
+        if cassettes is None and self._replay:
+            cassettes = CassetteLibrary(self._remove_from_request_body)
+        self._cassettes = cassettes
+
+    def clone(self):
+        """Create a wrapper for the same FAS instance with its own session."""
+        return type(self)(
+            self.config, self.inst_conf, cassettes=self._cassettes, engine=self._engine
+        )
 
     def _vcr_match_request(self, r1, r2):
         assert r1.query == r2.query
@@ -62,21 +105,49 @@ class FASWrapper:
             ]
         return "".join(cassette_path)
 
+    def send_request_async(self, url, *args, **kwargs) -> Optional[Future]:
+        """Send a request without waiting for it, with the async engine.
+
+        Return the future of its data, without retrying it if it fails, or None if
+        requests are sent with python-fedora: use send_request() then.
+        """
+        if not isinstance(self.fas, AsyncFASClient):
+            return None
+        start = time.monotonic()
+        future = self.fas.send_request_async(url, *args, **kwargs)
+
+        def observe(future):
+            failed = future.cancelled() or future.exception() is not None
+            METRICS.observe(
+                "fas", url, self.inst_conf["url"], time.monotonic() - start, failed
+            )
+
+        future.add_done_callback(observe)
+        return future
+
     def send_request(self, url, *args, **kwargs):
         if not self._replay:
             for attempt in range(self.inst_conf["retries"] + 1):
                 try:
-                    return self.fas.send_request(url, *args, **kwargs)
-                except ConnectionError:
+                    with METRICS.timed("fas", url, self.inst_conf["url"]):
+                        return self.fas.send_request(url, *args, **kwargs)
+                except (ServerError, RequestException):
                     if attempt < self.inst_conf["retries"]:
-                        click.echo(f"Retry #{attempt + 1}")
+                        echo(f"Retry #{attempt + 1}")
                     else:
-                        click.echo("Giving up.")
+                        echo("Giving up.")
                         raise
 
         cassette_path = self._vcr_get_cassette_path(url, *args, **kwargs)
+        data = self._cassettes.get(cassette_path, kwargs.get("req_params"))
+        if data is not None:
+            return data
+
+        # Not recorded yet
         with self._recorder.use_cassette(cassette_path, match_on=["fas2ipa"]):
-            return self.fas.send_request(url, *args, **kwargs)
+            data = self.fas.send_request(url, *args, **kwargs)
+        self._cassettes.forget(cassette_path)
+        return data
 
 
 @click.command(context_settings={"help_option_names": ("-h", "--help")})
@@ -106,7 +177,60 @@ class FASWrapper:
     is_flag=True,
     help="Don't store users' signatures of agreements.",
 )
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only push users, memberships and signatures changed since the last push.",
+)
+@click.option(
+    "--state-file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Keep the state of incremental pushes in this file.",
+)
 @click.option("--users-start-at", help="Start migrating users at that (partial) name.")
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Skip what an interrupted push recorded as done in its journal.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Migrate users in parallel with this many IPA sessions.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["sync", "async"]),
+    default=None,
+    help="Send requests one at a time per thread, or many at once with asyncio.",
+)
+@click.option(
+    "--pipeline",
+    is_flag=True,
+    help="Push users while pulling the next ones, needs --pull and --push.",
+)
+@click.option(
+    "--plan",
+    "plan_file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write the commands a push would send to IPA into this file instead.",
+)
+@click.option(
+    "--execute",
+    "execute_file",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Send the commands planned in this file to IPA.",
+)
+@click.option(
+    "--output",
+    type=click.Choice(OUTPUT_MODES),
+    default=None,
+    help="Print every object's status, JSON events or only failures and summaries.",
+)
 @click.option(
     "--restrict-users",
     "-u",
@@ -125,10 +249,27 @@ def cli(
     skip_user_add,
     skip_user_membership,
     skip_user_signature,
+    incremental,
+    state_file,
     users_start_at,
+    resume,
+    workers,
+    engine,
+    pipeline,
+    plan_file,
+    execute_file,
+    output,
     restrict_users,
     config_file,
 ):
+    if execute_file:
+        if pull or push or check or plan_file:
+            raise click.BadOptionUsage(
+                option_name="--execute",
+                message="--execute can't be combined with --pull, --push, --check or --plan",
+            )
+        pull = push = check = False
+
     _orig_check = check
 
     if check is False:
@@ -150,12 +291,12 @@ def cli(
         check = True
 
     if pull is None and push is None:
-        if not check:
+        if not (check or pipeline):
             raise click.BadOptionUsage(
                 option_name=("--pull", "--push", "--check"),
                 message="Neither pulling, pushing nor, checking. Bailing out.",
             )
-        if _orig_check is None:
+        if _orig_check is None or pipeline:
             pull = push = True
     elif False in (pull, push):
         pull = pull is not False
@@ -175,6 +316,50 @@ def cli(
     config["skip_user_add"] = skip_user_add
     config["skip_user_membership"] = skip_user_membership
     config["skip_user_signature"] = skip_user_signature
+    config["incremental"] = incremental
+    if state_file is not None:
+        config["state_file"] = state_file
+    if workers is not None:
+        config["workers"] = workers
+    if engine is not None:
+        config["engine"] = engine
+    if output is not None:
+        config["output"] = output
+
+    OUTPUT.configure(
+        config["output"], config["output_sample_rate"], config["output_interval"]
+    )
+    # Write what's buffered, however the command ends
+    click.get_current_context().call_on_close(OUTPUT.close)
+
+    if plan_file:
+        if not push:
+            raise click.BadOptionUsage(
+                option_name="--plan", message="--plan needs --push"
+            )
+        if incremental or resume:
+            raise click.BadOptionUsage(
+                option_name="--plan",
+                message="--plan can't be combined with --incremental or --resume",
+            )
+        plan_file = pathlib.Path(plan_file)
+        if plan_file.exists() and not force_overwrite:
+            raise click.ClickException(
+                f"Refusing to overwrite '{plan_file}', use --force-overwrite to override."
+            )
+
+    # Don't lose track of what an interrupted push completed
+    if (
+        push
+        and not plan_file
+        and not resume
+        and not force_overwrite
+        and pathlib.Path(config["journal_file"]).exists()
+    ):
+        raise click.ClickException(
+            f"'{config['journal_file']}' records an interrupted push, use --resume to"
+            " resume it or --force-overwrite to start over."
+        )
 
     # If dataset or conlicts files should be written later, bail out before overwriting
     # an existing file (unless force_overwrite is set). This will be checked again later
@@ -191,89 +376,236 @@ def cli(
     if conflicts_file:
         conflicts_file = pathlib.Path(conflicts_file)
 
-        if check and dataset_file and conflicts_file.exists() and not force_overwrite:
+        if (
+            check
+            and dataset_file
+            and not pipeline
+            and conflicts_file.exists()
+            and not force_overwrite
+        ):
             raise click.ClickException(
                 f"Refusing to overwrite '{conflicts_file}', use --force-overwrite to override."
             )
 
     if dataset_file and not pull:
-        dataset = load_data(dataset_file)
+        dataset = load_dataset(dataset_file)
     else:
         dataset = {}
-    dataset.setdefault("users", [])
-    dataset.setdefault("groups", [])
+        dataset.setdefault("users", [])
+        dataset.setdefault("groups", [])
+
+    if pipeline:
+        if not (pull and push):
+            raise click.BadOptionUsage(
+                option_name="--pipeline", message="--pipeline needs --pull and --push"
+            )
+        if dataset_file and not is_streamed_file(dataset_file):
+            raise click.BadOptionUsage(
+                option_name="--dataset-file",
+                message=(
+                    "--pipeline only writes JSON Lines or pack datasets (.jsonl,"
+                    " .jsonl.gz, .pack)"
+                ),
+            )
+        if check and not (conflicts_file and conflicts_file.exists()):
+            raise click.BadOptionUsage(
+                option_name="--pipeline",
+                message=(
+                    "--pipeline can't check for conflicts before pushing, pass"
+                    " --no-check or the --conflicts-file of an earlier check"
+                ),
+            )
+
+    if config["engine"] == "async":
+        async_engine = AsyncEngine(config["async_connections_per_host"])
+    else:
+        async_engine = None
 
     fas_instances = {}
 
     if pull:
         for inst_name, inst_conf in config["fas"].items():
-            fas = FASWrapper(config, inst_conf)
+            fas = FASWrapper(config, inst_conf, engine=async_engine)
             fas_instances[inst_name] = fas
-            click.echo(f"Logged into FAS ({inst_name}): {inst_conf['url']}")
-
-    if push:
-        ipa_instances = []
-        for instance in config["ipa"]["instances"]:
-            ipa = Client(host=instance, verify_ssl=config["ipa"]["cert_path"])
-            ipa.login(config["ipa"]["username"], config["ipa"]["password"])
-            ipa_instances.append(ipa)
-        click.echo("Logged into IPA")
+            echo(f"Logged into FAS ({inst_name}): {inst_conf['url']}")
+
+    sessions = SessionManager(config, engine=async_engine)
+    if push or execute_file:
+        ipa_instances = sessions.connect_all()
+        sessions.start()
+        echo("Logged into IPA")
     else:
         ipa_instances = None
 
     stats = Stats()
 
-    agreements_mgr = Agreements(config, ipa_instances, fas_instances)
-    users_mgr = Users(config, ipa_instances, fas_instances, agreements=agreements_mgr)
-    groups_mgr = Groups(config, ipa_instances, fas_instances, agreements=agreements_mgr)
-
-    if pull:
-        if not skip_groups:
-            dataset["groups"] = groups_mgr.pull_from_fas()
-
-        dataset["users"] = users_mgr.pull_from_fas(
-            users_start_at=users_start_at, restrict_users=restrict_users
-        )
-
-    conflicts = {}
-    if check:
-        if dataset_file:
-            users_to_conflicts = users_mgr.find_user_conflicts(dataset["users"])
-            groups_to_conflicts = groups_mgr.find_group_conflicts(dataset["groups"])
-
-            conflicts = {}
-            if users_to_conflicts:
-                conflicts["users"] = users_to_conflicts
-            if groups_to_conflicts:
-                conflicts["groups"] = groups_to_conflicts
-
-            if conflicts_file:
-                save_data(conflicts, conflicts_file, force_overwrite=force_overwrite)
-        elif conflicts_file and os.path.exists(conflicts_file):
-            conflicts = load_data(conflicts_file)
-        report_conflicts(conflicts)
-    conflicts.setdefault("users", [])
-    conflicts.setdefault("groups", [])
-
-    if pull and dataset_file:
-        save_data(
-            munch.unmunchify(dataset), dataset_file, force_overwrite=force_overwrite
+    if plan_file:
+        # Nothing is pushed, nothing to journal
+        journal = Journal()
+        plan = Plan()
+        echo("Planning the push, only reading from IPA")
+    elif push:
+        journal = Journal(
+            config["journal_file"], resume=resume, force_overwrite=force_overwrite
         )
-
-    if push:
-        if any(fas.get("agreement") for fas in config["fas"].values()):
-            # Create agreements, relations to users and groups will be done later
-            agreements_mgr.push_to_ipa()
-
-        if not skip_groups:
-            groups_stats = groups_mgr.push_to_ipa(
-                dataset["groups"], conflicts["groups"]
+        plan = None
+        if resume:
+            echo(f"Resuming the push recorded in {config['journal_file']}")
+    else:
+        journal = plan = None
+
+    # Replica health is shared between all managers
+    managers_kwargs = {
+        "journal": journal,
+        "router": make_router(config),
+        "sessions": sessions,
+        "plan": plan,
+    }
+    agreements_mgr = Agreements(config, ipa_instances, fas_instances, **managers_kwargs)
+    users_mgr = Users(
+        config,
+        ipa_instances,
+        fas_instances,
+        agreements=agreements_mgr,
+        **managers_kwargs,
+    )
+    groups_mgr = Groups(
+        config,
+        ipa_instances,
+        fas_instances,
+        agreements=agreements_mgr,
+        **managers_kwargs,
+    )
+
+    # JSON Lines and pack datasets are written while pulling, and streamed later
+    stream_dataset = dataset_file and is_streamed_file(dataset_file)
+
+    # Close the streamed dataset even if pulling or pushing fails
+    with ExitStack() as cleanup:
+        pulled_users = None
+        if pull:
+            if stream_dataset:
+                writer = cleanup.enter_context(
+                    DatasetWriter(dataset_file, force_overwrite=force_overwrite)
+                )
+            else:
+                writer = None
+
+            if not skip_groups:
+                if pipeline:
+                    # Groups are pushed before users, from memory
+                    dataset["groups"] = groups_mgr.pull_from_fas()
+                    if writer:
+                        for fas_name, groups in dataset["groups"].items():
+                            writer.write("groups", fas_name, groups)
+                else:
+                    dataset["groups"] = groups_mgr.pull_from_fas(writer=writer)
+
+            if pipeline:
+                # Users are pulled in the background and pushed in batches as they come in
+                pulled_users = DatasetQueue(
+                    config["pipeline_queue_size"], writer=writer
+                )
+                pulled_users.start(
+                    partial(
+                        users_mgr.pull_from_fas,
+                        users_start_at=users_start_at,
+                        restrict_users=restrict_users,
+                        writer=pulled_users,
+                    )
+                )
+            else:
+                dataset["users"] = users_mgr.pull_from_fas(
+                    users_start_at=users_start_at,
+                    restrict_users=restrict_users,
+                    writer=writer,
+                )
+
+                if writer:
+                    writer.close()
+                    dataset = load_dataset(dataset_file)
+
+                stats.export(config, "pull")
+
+        conflicts = {}
+        if check:
+            if dataset_file and not pipeline:
+                users_to_conflicts = users_mgr.find_user_conflicts(dataset["users"])
+                groups_to_conflicts = groups_mgr.find_group_conflicts(dataset["groups"])
+
+                conflicts = {}
+                if users_to_conflicts:
+                    conflicts["users"] = users_to_conflicts
+                if groups_to_conflicts:
+                    conflicts["groups"] = groups_to_conflicts
+
+                if conflicts_file:
+                    save_data(
+                        conflicts, conflicts_file, force_overwrite=force_overwrite
+                    )
+            elif conflicts_file and os.path.exists(conflicts_file):
+                conflicts = load_data(conflicts_file)
+            report_conflicts(conflicts)
+        conflicts.setdefault("users", [])
+        conflicts.setdefault("groups", [])
+
+        if pull and dataset_file and not stream_dataset:
+            save_data(
+                dataset_to_dicts(dataset), dataset_file, force_overwrite=force_overwrite
             )
-            stats.update(groups_stats)
 
-        users_stats = users_mgr.push_to_ipa(
-            dataset["users"], users_start_at, restrict_users, conflicts["users"]
-        )
-        stats.update(users_stats)
+        if push:
+            with ExitStack() as stack:
+                stack.enter_context(journal)
+                if pulled_users is not None:
+                    # Stop pulling if the push fails
+                    stack.enter_context(pulled_users)
+
+                if any(fas.get("agreement") for fas in config["fas"].values()):
+                    # Create agreements, relations to users and groups will be done later
+                    agreements_mgr.push_to_ipa()
+
+                if not skip_groups:
+                    groups_stats = groups_mgr.push_to_ipa(
+                        dataset["groups"], conflicts["groups"]
+                    )
+                    stats.update(groups_stats)
+                    stats.export(config, "push_groups")
+
+                if pulled_users is not None:
+                    users = (
+                        (fas_name, records) for _kind, fas_name, records in pulled_users
+                    )
+                else:
+                    users = dataset["users"]
+                users_stats = users_mgr.push_to_ipa(
+                    users, users_start_at, restrict_users, conflicts["users"]
+                )
+                stats.update(users_stats)
+                stats.export(config, "push_users")
+
+            if pulled_users is not None and pulled_users.writer:
+                # Complete before the plan is saved and the journal finished
+                pulled_users.writer.close()
+
+            if plan is not None:
+                plan.save(plan_file, force_overwrite=force_overwrite)
+                plan.print_summary(config["batch_size"])
+                echo(
+                    f"Nothing was written to IPA, the commands are planned in {plan_file}."
+                )
+
+            # The push is complete, nothing to resume
+            journal.finish()
+            sessions.stop()
+
+    if execute_file:
+        executor = PlanExecutor(config, ipa_instances, fas_instances, **managers_kwargs)
+        stats.update(executor.execute(Plan.load(execute_file)))
+        stats.export(config, "execute")
+        sessions.stop()
+
+    if async_engine is not None:
+        async_engine.close()
 
     stats.print()
@@ -3,13 +3,73 @@ from copy import deepcopy
 
 import toml
 
-
 CONFIG_FILES = ["/etc/fas2ipa/config.toml", "config.toml"]
 
 DEFAULT_CONFIG = {
     # We batch our queries (groups, users, memberships, etc).
-    # How many objects maximum should be in each request?
+    # How many objects should be in each request, to begin with?
     "chunks": 30,
+    # Chunk sizes adapt to how IPA copes with them, within these bounds, aiming for
+    # each chunk to be processed within this many seconds.
+    "chunks_min": 5,
+    "chunks_max": 300,
+    "chunks_target_seconds": 5.0,
+    # How many commands to send to IPA in one batch request, 1 disables batching.
+    "batch_size": 25,
+    # How many existing entries to fetch from IPA in one request.
+    "prefetch_page_size": 500,
+    # How many users to migrate in parallel, each worker has its own IPA sessions.
+    "workers": 1,
+    # Send requests with the "sync" engine (python-freeipa and python-fedora, one
+    # request at a time per thread) or the "async" one (aiohttp, needs the async
+    # extra). The async engine keeps up to async_requests_in_flight batch requests in
+    # flight and opens at most async_connections_per_host connections to each host.
+    "engine": "sync",
+    "async_requests_in_flight": 200,
+    "async_connections_per_host": 100,
+    # IPA sessions are renewed session_renew_before seconds before they expire, after
+    # session_lifetime seconds unless their cookie says otherwise. Session cookies are
+    # kept in session_cache_file to be reused by later runs.
+    "session_lifetime": 1200,
+    "session_renew_before": 300,
+    "session_cache_file": "fas2ipa-sessions.json",
+    # Take IPA replicas out of rotation for replica_retry_after seconds when requests
+    # to them failed replica_unhealthy_after times in a row.
+    "replica_unhealthy_after": 3,
+    "replica_retry_after": 30,
+    # Where to keep fingerprints of pushed objects for incremental pushes
+    "state_file": "fas2ipa-state.json",
+    # How many requests to send to each FAS instance in parallel when pulling users
+    "pull_concurrency": 1,
+    # Users are transformed into what is sent to IPA in batches of
+    # transform_batch_size, by transform_processes worker processes while requests
+    # are sent (0 transforms them in the main process, in between requests).
+    "transform_processes": 0,
+    "transform_batch_size": 1000,
+    # With --pipeline, users are pushed while they're pulled. How many batches of
+    # pulled users (one per search pattern) may wait to be pushed?
+    "pipeline_queue_size": 4,
+    # Where to record completed operations while pushing, for --resume
+    "journal_file": "fas2ipa-journal.jsonl",
+    # Split FAS search patterns whose responses have more objects, or right away
+    # those which take longer
+    "pull_split_results": 5000,
+    "pull_split_seconds": 120,
+    # Where to remember how search patterns are split
+    "pattern_cache_file": "fas2ipa-patterns.json",
+    # Write stats and metrics of FAS and IPA requests after each phase (pull, pushing
+    # groups, pushing users) to these files, as JSON and for Prometheus' textfile
+    # collector.
+    "metrics_json_file": None,
+    "metrics_prometheus_file": None,
+    # How to report migrated objects: "text" prints each of them with its status,
+    # "json" writes JSON Lines events for failures and summaries, and for
+    # output_sample_rate (0 to 1) of other statuses, "quiet" prints failures and
+    # summaries only. In these two modes, other messages go to stderr. Output is
+    # written and progress bars redrawn every output_interval seconds.
+    "output": "text",
+    "output_sample_rate": 0.0,
+    "output_interval": 0.5,
     # Record and replay requests to FAS (for testing)
     "replay": False,
     # Users configuration
@@ -39,9 +99,6 @@ DEFAULT_CONFIG = {
         "cert_path": None,
         "username": None,
         "password": None,
-        # After too long a session can expire.
-        # So we just trigger a re-auth, every reauth_every imports.
-        "reauth_every": 300,
     },
 }
 
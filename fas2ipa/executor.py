@@ -0,0 +1,156 @@
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+import python_freeipa
+
+from .plan import DEPENDENCIES, Plan
+from .status import OUTPUT, Status, echo, print_status
+from .utils import ObjectManager
+
+# Errors meaning a command was applied already, e.g. by an earlier run
+UNMODIFIED_ERRORS = {"no modifications to be performed"}
+UNMODIFIED_FAILURES = {"This entry is already a member", "This entry is not a member"}
+
+# The stats of objects, by the command adding or changing them
+STATS_KEYS = {
+    "user_add": "users_added",
+    "user_mod": "users_edited",
+    "group_add": "groups_added",
+    "group_mod": "groups_edited",
+}
+
+
+def _failures(result):
+    """List the (name, message) failures reported in the result of a command."""
+    failures = []
+    for member_types in (result.get("failed") or {}).values():
+        if not isinstance(member_types, dict):
+            continue
+        for entries in member_types.values():
+            failures.extend(tuple(entry) for entry in entries)
+    return failures
+
+
+class PlanExecutor(ObjectManager):
+    """Execute the commands of a plan, stage after stage.
+
+    All commands of a stage are sent at once, in batch requests to the replicas
+    routing picks for them, by as many workers as configured.
+    """
+
+    def _executed(self, method, args, result, error):
+        name = args[0] if args else method
+        if error is None:
+            failures = [
+                (member, message)
+                for member, message in _failures(result)
+                if message not in UNMODIFIED_FAILURES
+            ]
+            for member, message in failures:
+                print_status(Status.FAILED, f"{method} {name}: {member}: {message}")
+            return Status.FAILED if failures else Status.UPDATED
+        if isinstance(error, python_freeipa.exceptions.DuplicateEntry) or (
+            getattr(error, "message", None) in UNMODIFIED_ERRORS
+        ):
+            return Status.UNMODIFIED
+        print_status(Status.FAILED, f"{method} {name}: {error}")
+        return Status.FAILED
+
+    def _execute_window(self, commands):
+        results = []
+        for method, args, params in commands:
+            results.append(
+                self.batch.add(
+                    method, args, params, callback=partial(self._executed, method, args)
+                )
+            )
+        self.batch.flush()
+        return [
+            (command, future.result()) for command, future in zip(commands, results)
+        ]
+
+    def _execute_stage(self, commands):
+        """Execute the commands of a stage, yield them and their statuses."""
+        workers = self.config["workers"]
+        commands = iter(commands)
+        windows = iter(lambda: list(islice(commands, self.batch.window)), [])
+        if workers <= 1:
+            for window in windows:
+                yield from self._execute_window(window)
+            return
+        pending = deque()
+        with ThreadPoolExecutor(
+            max_workers=workers, initializer=self.init_worker
+        ) as executor:
+            for window in windows:
+                pending.append(executor.submit(self._execute_window, window))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    @staticmethod
+    def _skip_dependents(commands, prerequisites, statuses):
+        """Leave out commands whose prerequisite didn't create their object.
+
+        The statuses of the commands left out are counted in statuses: unmodified
+        if the object existed already, failed if their prerequisite failed.
+        """
+        remaining = []
+        for method, args, params in commands:
+            name = args[0] if args else method
+            status = prerequisites.get((DEPENDENCIES.get(method), name))
+            if status is None or status == Status.UPDATED:
+                remaining.append((method, args, params))
+                continue
+            if status == Status.FAILED:
+                print_status(
+                    Status.FAILED, f"{method} {name}: {DEPENDENCIES[method]} failed"
+                )
+            statuses[method, status] += 1
+        return remaining
+
+    def execute(self, plan: Plan) -> dict:
+        echo(f"Executing {len(plan)} planned commands")
+        statuses = Counter()
+        # Statuses of the commands others depend on, by method and object name
+        prerequisites = {}
+        for stage, commands in plan.stages():
+            commands = self._skip_dependents(commands, prerequisites, statuses)
+            echo(f"Stage {stage}: {len(commands)} commands")
+            with OUTPUT.progress_bar(len(commands)) as bar:
+                for counter, ((method, args, _params), status) in enumerate(
+                    self._execute_stage(commands), 1
+                ):
+                    statuses[method, status] += 1
+                    if method in DEPENDENCIES.values():
+                        prerequisites[method, args[0] if args else method] = status
+                    bar.update(counter)
+
+        methods = sorted({method for method, _status in statuses})
+        if OUTPUT.mode == "json":
+            OUTPUT.event(
+                "summary",
+                name="execute",
+                commands={
+                    method: {
+                        "done": statuses[method, Status.UPDATED],
+                        "already_done": statuses[method, Status.UNMODIFIED],
+                        "failed": statuses[method, Status.FAILED],
+                    }
+                    for method in methods
+                },
+            )
+        else:
+            echo("Commands executed:")
+            for method in methods:
+                echo(
+                    f"  {method}: {statuses[method, Status.UPDATED]} done,"
+                    f" {statuses[method, Status.UNMODIFIED]} already done,"
+                    f" {statuses[method, Status.FAILED]} failed"
+                )
+        return {
+            key: statuses[method, Status.UPDATED] for method, key in STATS_KEYS.items()
+        }
@@ -1,39 +1,72 @@
-import click
-import progressbar
 import python_freeipa
 from collections import defaultdict
-from typing import Any, Dict, List
+from concurrent.futures import Future
+from functools import partial
+from typing import Any, Dict, List, Optional
 
-from .status import Status, print_status
-from .utils import ObjectManager
+from .patterns import PatternPlanner
+from .records import Group
+from .status import OUTPUT, Status, echo, print_object_status, print_status
+from .utils import DatasetWriter, ObjectManager
+
+
+# The attributes of IPA groups which are written from FAS
+GROUP_ATTRIBUTES = {"description", "fasurl", "fasmailinglist", "fasircchannel"}
 
 
 class Groups(ObjectManager):
     def __init__(self, *args, agreements, **kwargs):
         super().__init__(*args, **kwargs)
         self.agreements = agreements
+        # Existing IPA groups, by name
+        self.ipa_groups = {}
 
-    def pull_from_fas(self) -> Dict[str, List[Dict]]:
+    def pull_from_fas(
+        self, writer: Optional[DatasetWriter] = None
+    ) -> Dict[str, List[Group]]:
+        """Pull groups from FAS.
+
+        If a dataset writer is passed, groups are written to it instead of being
+        collected and returned.
+        """
         fas_groups = {}
 
-        for fas_name, fas_inst in self.fas_instances.items():
-            click.echo(f"Pulling group information from FAS ({fas_name})...")
+        with PatternPlanner(self.config) as planner:
+            for fas_name, fas_inst in self.fas_instances.items():
+                fas_groups[fas_name] = self._pull_groups(
+                    fas_name, fas_inst, planner, writer
+                )
 
-            fas_conf = self.config["fas"][fas_name]
-            groups = fas_inst.send_request(
+        return fas_groups
+
+    def _pull_groups(self, fas_name, fas_inst, planner, writer):
+        echo(f"Pulling group information from FAS ({fas_name})...")
+
+        def fetch(pattern, timeout):
+            return fas_inst.send_request(
                 "/group/list",
-                req_params={"search": fas_conf["groups"]["search"]},
+                req_params={"search": pattern},
                 auth=True,
-                timeout=240,
+                timeout=timeout or 240,
             )["groups"]
-            groups.sort(key=lambda g: g["name"])
-            click.echo(f"Got {len(groups)} groups!")
-            fas_groups[fas_name] = groups
 
-        return fas_groups
+        fas_conf = self.config["fas"][fas_name]
+        groups = {}
+        for pattern in planner.plan(fas_name, "groups", fas_conf["groups"]["search"]):
+            # Split patterns can overlap
+            for group in planner.fetch(fas_name, "groups", pattern, fetch):
+                groups[group["name"]] = Group.from_dict(group)
+        groups = sorted(groups.values(), key=lambda g: g.name)
+        echo(f"Got {len(groups)} groups!")
+        if writer:
+            writer.write("groups", fas_name, groups)
+            return []
+        return groups
 
     def push_to_ipa(
-        self, groups: Dict[str, List[Dict]], conflicts: Dict[str, List[Dict[str, Any]]],
+        self,
+        groups: Dict[str, List[Group]],
+        conflicts: Dict[str, List[Dict[str, Any]]],
     ) -> dict:
         added = 0
         edited = 0
@@ -43,19 +76,25 @@ class Groups(ObjectManager):
             conflicts = {}
         skip_conflicts = set(self.config["groups"].get("skip_conflicts", ()))
 
+        self.prefetch_ipa_groups(self._ipa_group_names(groups))
+
         for fas_name, fas_groups in groups.items():
-            click.echo(f"Pushing {fas_name} group information to IPA...")
+            echo(f"Pushing {fas_name} group information to IPA...")
 
             fas_conf = self.config["fas"][fas_name]
 
             # Start by creating the umbrella group, if any
             umbrella_group = fas_conf["groups"].get("umbrella")
             if umbrella_group:
-                click.echo(f"Ensuring umbrella group {umbrella_group['name']} exists...")
-                name_max_length = max((len(g["name"]) for g in fas_groups))
-                click.echo(umbrella_group["name"].ljust(name_max_length + 2), nl=False)
+                echo(f"Ensuring umbrella group {umbrella_group['name']} exists...")
+                name_max_length = max((len(g.name) for g in fas_groups))
                 status = self._write_group_to_ipa(fas_name, umbrella_group, from_fas=False)
-                print_status(status)
+                self.batch.flush()
+                while isinstance(status, Future):
+                    status = status.result()
+                print_object_status(
+                    "group", umbrella_group["name"], status, width=name_max_length + 2
+                )
                 if status == Status.ADDED:
                     added += 1
                 elif status == Status.UPDATED:
@@ -66,79 +105,173 @@ class Groups(ObjectManager):
             fas_groups = [
                 g
                 for g in fas_groups
-                if g["name"] not in fas_conf["groups"].get("ignore", ())
+                if g.name not in fas_conf["groups"].get("ignore", ())
             ]
 
-            name_max_length = max((len(g["name"]) for g in fas_groups))
-
-            for group in progressbar.progressbar(fas_groups, redirect_stdout=True):
-                counter += 1
-
-                group_conflicts = set(conflicts.get(group["name"], ()))
-                group_skip_conflicts = skip_conflicts & group_conflicts
-                if group_skip_conflicts:
-                    print_status(
-                        Status.FAILED,
-                        f"[{fas_name}: Skipping group '{group['name']}' because of conflicts:"
-                        f" {', '.join(group_skip_conflicts)}",
+            name_max_length = max((len(g.name) for g in fas_groups))
+
+            def groups_to_write():
+                nonlocal counter
+
+                for group in fas_groups:
+                    counter += 1
+
+                    # Groups pushed before an interrupted run was resumed
+                    status = self.journal.status("group", f"{fas_name}:{group.name}")
+                    if status is not None:
+                        if umbrella_group and status in (
+                            Status.ADDED,
+                            Status.UPDATED,
+                            Status.UNMODIFIED,
+                        ):
+                            umbrella_members.add(
+                                fas_conf["groups"].get("prefix", "")
+                                + group.name.lower()
+                            )
+                        continue
+
+                    group_conflicts = set(conflicts.get(group.name, ()))
+                    group_skip_conflicts = skip_conflicts & group_conflicts
+                    if group_skip_conflicts:
+                        print_status(
+                            Status.FAILED,
+                            f"[{fas_name}: Skipping group '{group.name}' because of"
+                            f" conflicts: {', '.join(group_skip_conflicts)}",
+                            kind="group",
+                            name=group.name,
+                        )
+                        continue
+
+                    yield group
+
+            for group, status in OUTPUT.progress_bar(len(fas_groups))(
+                self.map_batched(
+                    partial(self._write_group_to_ipa, fas_name), groups_to_write()
+                )
+            ):
+                print_object_status(
+                    "group", group.name, status, width=name_max_length + 2
+                )
+                if status != Status.FAILED:
+                    self.journal.record_status(
+                        "group", f"{fas_name}:{group.name}", status
                     )
-                    continue
-
-                self.check_reauth(counter)
-                click.echo(group["name"].ljust(name_max_length + 2), nl=False)
-                status = self._write_group_to_ipa(fas_name, group)
-                print_status(status)
                 if status == Status.ADDED:
                     added += 1
                 elif status == Status.UPDATED:
                     edited += 1
                 if umbrella_group and status in (Status.ADDED, Status.UPDATED, Status.UNMODIFIED):
                     umbrella_members.add(
-                        fas_conf["groups"].get("prefix", "") + group["name"].lower()
+                        fas_conf["groups"].get("prefix", "") + group.name.lower()
                     )
 
             if umbrella_group:
-                ipa_group = self.ipa.group_show(umbrella_group["name"])
+                ipa_group = self.ipa_groups.get(umbrella_group["name"], {})
                 existing_umbrella_members = set(ipa_group.get("member_group", []))
                 new_umbrella_members = umbrella_members - existing_umbrella_members
                 if not new_umbrella_members:
-                    click.echo(f"No new members to add to umbrella group {umbrella_group['name']}")
+                    echo(f"No new members to add to umbrella group {umbrella_group['name']}")
                 else:
-                    click.echo(
+                    echo(
                         f"Adding {len(new_umbrella_members)} new groups to umbrella group"
                         f" {umbrella_group['name']}"
                     )
-                    self.ipa.group_add_member(
-                        umbrella_group["name"], groups=list(new_umbrella_members)
+                    self.ipa_call(
+                        umbrella_group["name"],
+                        "group_add_member",
+                        umbrella_group["name"],
+                        groups=list(new_umbrella_members),
                     )
 
-            click.echo(f"Done with {fas_name}")
+            echo(f"Done with {fas_name}")
 
         # add groups to agreements
-        click.echo("Recording group requirements in IPA...")
+        echo("Recording group requirements in IPA...")
         self.agreements.record_group_requirements(groups)
 
-        click.echo("Done.")
+        echo("Done.")
 
         return dict(groups_added=added, groups_edited=edited, groups_counter=counter,)
 
-    def _write_group_to_ipa(self, fas_name: str, group: dict, from_fas: bool = True):
+    def _ipa_group_names(self, groups: Dict[str, List[Group]]) -> List[str]:
+        """List the names of the IPA groups FAS groups are pushed to."""
+        names = []
+        for fas_name, fas_groups in groups.items():
+            groups_conf = self.config["fas"][fas_name]["groups"]
+            if groups_conf.get("umbrella"):
+                names.append(groups_conf["umbrella"]["name"])
+            ignored = groups_conf.get("ignore", ())
+            prefix = groups_conf.get("prefix", "")
+            names.extend(
+                prefix + group.name.lower()
+                for group in fas_groups
+                if group.name not in ignored
+            )
+        return names
+
+    def prefetch_ipa_groups(self, names: List[str]):
+        """Fetch the existing IPA groups with one search.
+
+        If the server truncates the results to its search size limit, the groups
+        which were left out are fetched with show commands. Members are only fetched
+        for umbrella groups, with a show command each.
+        """
+        echo("Fetching existing groups from IPA")
+        names = set(names)
+        result = self.ipa_call(
+            None, "group_find", all=True, sizelimit=0, no_members=True
+        )
+        self.ipa_groups = {}
+        for entry in result["result"]:
+            name = entry["cn"][0]
+            if name in names:
+                self.ipa_groups[name] = {
+                    key: value
+                    for key, value in entry.items()
+                    if key in GROUP_ATTRIBUTES
+                }
+        if result.get("truncated"):
+            self.ipa_groups.update(
+                self.fetch_entries(
+                    "group_show",
+                    sorted(names - set(self.ipa_groups)),
+                    GROUP_ATTRIBUTES,
+                    {"no_members": True},
+                )
+            )
+
+        umbrella_names = {
+            fas_conf["groups"]["umbrella"]["name"]
+            for fas_conf in self.config["fas"].values()
+            if fas_conf["groups"].get("umbrella")
+        }
+        umbrella_members = self.fetch_entries(
+            "group_show",
+            sorted(umbrella_names & set(self.ipa_groups)),
+            {"member_group"},
+        )
+        for name, members in umbrella_members.items():
+            self.ipa_groups[name].update(members)
+        echo(f"Found {len(self.ipa_groups)} existing groups.")
+
+    def _write_group_to_ipa(self, fas_name: str, group, from_fas: bool = True):
+        """Add or update a group in IPA, from FAS or from the configuration (a dict)."""
         if from_fas:
             # transform FAS group info into what IPA expects
             name = (
                 self.config["fas"][fas_name]["groups"].get("prefix", "")
-                + group["name"].lower()
+                + group.name.lower()
             )
             # calculate the IRC channel (FAS has 2 fields, freeipa-fas has a single one )
             # if we have an irc channel defined. try to generate the irc:// uri
             # there are a handful of groups that have an IRC server defined (freenode), but
             # no channel, which is kind of useless, so we don't handle that case.
-            irc_channel = group.get("irc_channel")
+            irc_channel = group.irc_channel
             irc_string = None
             if irc_channel:
                 if irc_channel[0] == "#":
                     irc_channel = irc_channel[1:]
-                irc_network = group.get("irc_network").lower()
+                irc_network = group.irc_network.lower()
                 if "gimp" in irc_network:
                     irc_string = f"irc://irc.gimp.org/#{irc_channel}"
                 elif "oftc" in irc_network:
@@ -147,12 +280,12 @@ class Groups(ObjectManager):
                     # the remainder of the entries here are either blank or
                     # freenode, so we freenode them all.
                     irc_string = f"irc://irc.freenode.net/#{irc_channel}"
-            url = group.get("url")
+            url = group.url
             if not url:
                 url = None
             else:
                 url = url.strip()
-            mailing_list = group.get("mailing_list")
+            mailing_list = group.mailing_list
             if not mailing_list:
                 mailing_list = None
             else:
@@ -163,47 +296,79 @@ class Groups(ObjectManager):
                 mailing_list = mailing_list.lower()
 
             group_args = {
-                "description": group["display_name"].strip(),
+                "description": group.display_name.strip(),
                 "fasurl": url,
                 "fasmailinglist": mailing_list,
                 "fasircchannel": irc_string,
             }
         else:
             name = group["name"]
+            url = mailing_list = irc_string = None
             group_args = {
                 k: v for k, v in group.items() if k in (
                     "description", "fasurl", "fasmailinglist", "fasircchannel"
                 )
             }
 
-        group["fasgroup"] = True
+        ipa_group = self.ipa_groups.get(name)
+        if ipa_group is None:
+            return self.batch.add(
+                "group_add",
+                name,
+                group_args,
+                callback=partial(
+                    self._group_added, name, group_args, url, mailing_list, irc_string
+                ),
+            )
 
-        try:
-            self.ipa.group_add(name, **group_args)
+        # Only change what differs, unset values are left alone like group_mod does
+        changed_args = {
+            key: value
+            for key, value in group_args.items()
+            if value is not None and [value] != ipa_group.get(key)
+        }
+        if not changed_args:
+            return Status.UNMODIFIED
+        return self.batch.add(
+            "group_mod",
+            name,
+            changed_args,
+            callback=partial(self._group_modified, name, report=True),
+        )
+
+    def _group_added(self, name, group_args, url, mailing_list, irc_string, result, error):
+        if error is None:
             return Status.ADDED
-        except python_freeipa.exceptions.FreeIPAError as e:
-            if e.message == 'group with name "%s" already exists' % name:
-                try:
-                    self.ipa.group_mod(name, **group_args)
-                except python_freeipa.exceptions.FreeIPAError as e:
-                    if e.message != "no modifications to be performed":
-                        raise
-                return Status.UNMODIFIED
-            else:
-                print(e.message)
-                print(e)
-                print(url, mailing_list, irc_string)
-                return Status.FAILED
-        except Exception as e:
-            print(e)
-            print(url, mailing_list, irc_string)
+        if (
+            not isinstance(error, python_freeipa.exceptions.FreeIPAError)
+            or error.message != 'group with name "%s" already exists' % name
+        ):
+            print_status(
+                Status.FAILED,
+                f"Failed to add group {name}: {error}"
+                f" ({url}, {mailing_list}, {irc_string})",
+            )
+            return Status.FAILED
+
+        self.batch.add(
+            "group_mod", name, group_args, callback=partial(self._group_modified, name)
+        )
+        return Status.UNMODIFIED
+
+    @staticmethod
+    def _group_modified(name, result, error, report=False):
+        if error is None:
+            return Status.UPDATED if report else None
+        if getattr(error, "message", None) != "no modifications to be performed":
+            print_status(Status.FAILED, f"Failed to update group {name}: {error}")
             return Status.FAILED
+        return Status.UNMODIFIED
 
     def find_group_conflicts(
-        self, fas_groups: Dict[str, List[Dict]]
+        self, fas_groups: Dict[str, List[Group]]
     ) -> Dict[str, List[str]]:
         """Compare groups from different FAS instances and flag conflicts."""
-        click.echo("Checking for conflicts between groups from different FAS instances")
+        echo("Checking for conflicts between groups from different FAS instances")
 
         groups_to_conflicts = {}
 
@@ -211,7 +376,7 @@ class Groups(ObjectManager):
 
         for fas_name, group_objs in fas_groups.items():
             for group_obj in group_objs:
-                groupnames_to_fas[group_obj["name"]].add(fas_name)
+                groupnames_to_fas[group_obj.name].add(fas_name)
 
         for group_name, fas_names in sorted(
             groupnames_to_fas.items(), key=lambda x: x[0]
@@ -223,7 +388,7 @@ class Groups(ObjectManager):
 
             group_conflicts["same_group_name"] = {"fas_names": fas_names}
 
-        click.echo("Done checking group conflicts.")
-        click.echo(f"Found {len(groups_to_conflicts)} groups with conflicts.")
+        echo("Done checking group conflicts.")
+        echo(f"Found {len(groups_to_conflicts)} groups with conflicts.")
 
         return groups_to_conflicts
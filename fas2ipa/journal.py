@@ -0,0 +1,97 @@
+import json
+import os
+import pathlib
+import threading
+from collections import defaultdict
+from typing import Iterable, Optional, Set, Union
+
+from .status import Status
+
+
+class Journal:
+    """Append-only log of operations completed while pushing to IPA.
+
+    Every line records one operation, either an object with its status, e.g.
+    ``{"op": "user", "key": "fedora:jdoe", "status": "ADDED"}``, or users processed
+    for a group or agreement, e.g. ``{"op": "members", "key": "g1", "users": [...]}``.
+    When resuming, operations found in the journal are skipped. Without a file path,
+    operations are only kept in memory.
+
+    The journal is removed once the push is finished. If it exists otherwise, it's
+    the only record of what an interrupted push completed: it's only overwritten if
+    forced to.
+    """
+
+    def __init__(
+        self,
+        fpath: Optional[Union[str, pathlib.Path]] = None,
+        resume: bool = False,
+        force_overwrite: bool = False,
+    ):
+        self.fpath = pathlib.Path(fpath) if fpath is not None else None
+        self._statuses = defaultdict(dict)
+        self._users = defaultdict(lambda: defaultdict(set))
+        self._lock = threading.Lock()
+        self._fobj = None
+
+        if self.fpath is None:
+            return
+
+        if resume and self.fpath.exists():
+            with self.fpath.open() as fobj:
+                for line in fobj:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be incomplete if the process was killed
+                        continue
+                    self._load_entry(entry)
+            self._fobj = self.fpath.open("a")
+        else:
+            self._fobj = self.fpath.open("w" if force_overwrite else "x")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load_entry(self, entry):
+        if "status" in entry:
+            self._statuses[entry["op"]][entry["key"]] = Status(entry["status"])
+        else:
+            self._users[entry["op"]][entry["key"]].update(entry["users"])
+
+    def _write(self, entry):
+        with self._lock:
+            self._load_entry(entry)
+            if self._fobj is not None:
+                self._fobj.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                self._fobj.flush()
+
+    def record_status(self, op: str, key: str, status: Status):
+        self._write({"op": op, "key": key, "status": status.value})
+
+    def record_users(self, op: str, key: str, users: Iterable[str]):
+        users = sorted(users)
+        if users:
+            self._write({"op": op, "key": key, "users": users})
+
+    def status(self, op: str, key: str) -> Optional[Status]:
+        return self._statuses[op].get(key)
+
+    def users(self, op: str, key: str) -> Set[str]:
+        return self._users[op].get(key, set())
+
+    def close(self):
+        if self._fobj is not None:
+            self._fobj.flush()
+            os.fsync(self._fobj.fileno())
+            self._fobj.close()
+            self._fobj = None
+
+    def finish(self):
+        """Close and remove the journal once the push is complete."""
+        self.close()
+        if self.fpath is not None and self.fpath.exists():
+            self.fpath.unlink()
@@ -0,0 +1,158 @@
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Upper bounds of the histogram buckets of request durations, in seconds, like
+# Prometheus' default buckets but up to the time a large FAS search can take
+BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+
+class Histogram:
+    """Counts of durations in fixed buckets, with their sum, maximum and errors.
+
+    The last count is that of the durations above the last bucket's bound.
+    """
+
+    __slots__ = ("counts", "sum", "max", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float, error: bool = False):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        if error:
+            self.errors += 1
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def cumulative_counts(self) -> List[Tuple[float, int]]:
+        """List the (upper bound, count of durations up to it) of all buckets."""
+        cumulative = []
+        total = 0
+        for bound, count in zip(BUCKETS + (math.inf,), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def quantile(self, quantile: float) -> float:
+        """Estimate a quantile, interpolating linearly in its bucket.
+
+        Like Prometheus' histogram_quantile(), but capped to the maximum duration.
+        """
+        rank = quantile * self.count
+        lower = 0.0
+        below = 0
+        for bound, count in zip(BUCKETS + (math.inf,), self.counts):
+            if count and below + count >= rank:
+                upper = min(bound, self.max)
+                return lower + (upper - lower) * max(0.0, rank - below) / count
+            below += count
+            lower = bound
+        return 0.0
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram()
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.max = self.max
+        histogram.errors = self.errors
+        return histogram
+
+
+class Metrics:
+    """Durations and errors of requests to FAS and IPA.
+
+    Requests are recorded by service ("fas" or "ipa"), operation (the URL or IPA
+    command) and instance, in histograms: their memory doesn't grow with the number
+    of requests.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(
+        self,
+        service: str,
+        operation: str,
+        instance: str,
+        seconds: float,
+        error: bool = False,
+    ):
+        key = (service, operation, instance)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds, error)
+
+    @contextmanager
+    def timed(self, service: str, operation: str, instance: str):
+        """Record the duration of a request made in the context."""
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.observe(service, operation, instance, time.monotonic() - start, True)
+            raise
+        self.observe(service, operation, instance, time.monotonic() - start)
+
+    def summary(self) -> List[Dict]:
+        with self._lock:
+            items = [
+                (key, histogram.copy()) for key, histogram in self._histograms.items()
+            ]
+        summary = []
+        for (service, operation, instance), histogram in sorted(
+            items, key=lambda item: item[0]
+        ):
+            entry = {
+                "service": service,
+                "operation": operation,
+                "instance": instance,
+                "count": histogram.count,
+                "errors": histogram.errors,
+                "seconds": histogram.sum,
+                "max": histogram.max,
+            }
+            for quantile in QUANTILES:
+                entry[f"p{quantile * 100:g}"] = histogram.quantile(quantile)
+            # Cumulative counts by upper bound, the last one being +Inf
+            entry["buckets"] = [
+                [bound if bound != math.inf else "+Inf", count]
+                for bound, count in histogram.cumulative_counts()
+            ]
+            summary.append(entry)
+        return summary
+
+
+# Requests made anywhere in the process are recorded here
+METRICS = Metrics()
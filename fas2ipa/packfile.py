@@ -0,0 +1,305 @@
+import json
+import lzma
+import pathlib
+import struct
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import click
+
+from .records import RECORD_TYPES, Group, Membership, User
+
+MAGIC = b"FAS2IPA"
+VERSION = 1
+SUFFIX = ".pack"
+
+# Compression codecs, by their identifier in the file header
+ZSTD = b"z"
+XZ = b"x"
+
+# Frame types
+STRINGS = b"S"
+RECORDS = b"R"
+DATA = b"D"
+
+_FRAME_HEADER = struct.Struct(">cI")
+
+# User fields which are stored as indices into the string table
+TABLE_FIELDS = frozenset({"status", "locale", "timezone"})
+
+_USER_FIELDS_COUNT = len(User.FIELDS)
+_USER_TABLE_FIELDS = tuple(
+    (position, field)
+    for position, field in enumerate(User.FIELDS)
+    if field in TABLE_FIELDS
+)
+
+
+def is_pack_file(fpath: Union[str, pathlib.Path]) -> bool:
+    """Check whether a file name denotes a pack file."""
+    return pathlib.Path(fpath).name.lower().endswith(SUFFIX)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def _dumps(data, cls=None) -> bytes:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False, cls=cls).encode(
+        "utf-8"
+    )
+
+
+class PackWriter:
+    """Write a dataset, or any other data, into a compact binary file.
+
+    A pack file starts with MAGIC, the format version and the compression codec:
+    zstd if the zstandard module is installed, xz otherwise. The compressed stream
+    that follows is made of frames, each a type byte and the length of its payload:
+
+    - STRINGS: JSON list of strings appended to the string table. Values repeated
+      across users, like group names, statuses or locales, are stored as their
+      index in the table.
+    - RECORDS: a batch of users or groups of one FAS instance. A JSON header line
+      with the kind, the FAS instance and the number of records lets readers skip
+      the batch without parsing it, the records follow as a JSON list of lists of
+      field values.
+    - DATA: any other data, as JSON.
+    """
+
+    def __init__(self, fpath: Union[str, pathlib.Path], mode: str = "x"):
+        self._raw = open(fpath, mode + "b")
+        zstandard = _zstandard()
+        codec = ZSTD if zstandard else XZ
+        self._raw.write(MAGIC + bytes([VERSION]) + codec)
+        if zstandard:
+            self._fobj = zstandard.ZstdCompressor(level=3).stream_writer(self._raw)
+        else:
+            self._fobj = lzma.LZMAFile(self._raw, "w", preset=1)
+        self._strings = {}
+        self._new_strings = []
+
+    def _frame(self, frame_type: bytes, payload: bytes):
+        self._fobj.write(_FRAME_HEADER.pack(frame_type, len(payload)))
+        self._fobj.write(payload)
+
+    def _index(self, value: Optional[str]) -> Optional[int]:
+        if value is None:
+            return None
+        index = self._strings.get(value)
+        if index is None:
+            index = self._strings[value] = len(self._strings)
+            self._new_strings.append(value)
+        return index
+
+    def _encode_user(self, user: User) -> list:
+        index = self._index
+        values = [
+            index(getattr(user, field))
+            if field in TABLE_FIELDS
+            else getattr(user, field)
+            for field in User.FIELDS
+        ]
+        roles = []
+        for membership in user.group_roles:
+            roles += (
+                index(membership.group),
+                membership.group_id,
+                index(membership.role_status),
+                index(membership.role_type),
+            )
+        values.append(roles)
+        values.append([index(name) for name in user.memberships])
+        values.append(user.extra)
+        return values
+
+    @staticmethod
+    def _encode_group(group: Group) -> list:
+        return [getattr(group, field) for field in Group.FIELDS]
+
+    def write_records(self, kind: str, fas_name: str, records: Iterable[Any]):
+        """Write users or groups, as records or dictionaries."""
+        record_type = RECORD_TYPES[kind]
+        encode = self._encode_user if record_type is User else self._encode_group
+        encoded = [
+            encode(
+                record
+                if isinstance(record, record_type)
+                else record_type.from_dict(record)
+            )
+            for record in records
+        ]
+        if not encoded:
+            return
+        if self._new_strings:
+            self._frame(STRINGS, _dumps(self._new_strings))
+            self._new_strings = []
+        header = _dumps([kind, fas_name, len(encoded)])
+        self._frame(RECORDS, header + b"\n" + _dumps(encoded))
+
+    def write_data(self, data, cls: Optional[type] = None):
+        """Write other data, with an optional JSON encoder class."""
+        self._frame(DATA, _dumps(data, cls=cls))
+
+    def close(self):
+        self._fobj.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _read_exactly(fobj, size: int) -> bytes:
+    # Decompressing streams may return less than asked for
+    chunks = []
+    while size:
+        chunk = fobj.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _read_frame(fpath: pathlib.Path, fobj) -> Optional[Tuple[bytes, bytes]]:
+    try:
+        frame_header = _read_exactly(fobj, _FRAME_HEADER.size)
+        if not frame_header:
+            return None
+        frame_type, length = _FRAME_HEADER.unpack(frame_header)
+        payload = _read_exactly(fobj, length)
+    except (EOFError, struct.error):
+        # The xz stream ends early, or in the middle of a frame header
+        raise ValueError(f"{fpath} is truncated") from None
+    if len(payload) != length:
+        raise ValueError(f"{fpath} is truncated")
+    return frame_type, payload
+
+
+def _iter_frames(
+    fpath: pathlib.Path, offsets: Optional[List[int]] = None
+) -> Iterator[Tuple[int, bytes, bytes]]:
+    """Read the frames of a pack file, yield their offsets, types and payloads.
+
+    Offsets are positions in the decompressed stream. If offsets are passed, in
+    increasing order, only the frames starting there are read.
+    """
+    with open(fpath, "rb") as raw:
+        header = raw.read(len(MAGIC) + 2)
+        if header[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{fpath} isn't a pack file")
+        version = header[len(MAGIC)]
+        codec = header[len(MAGIC) + 1 :]
+        if version != VERSION:
+            raise ValueError(f"{fpath} has the unknown pack format version {version}")
+        if codec == ZSTD:
+            zstandard = _zstandard()
+            if zstandard is None:
+                raise click.ClickException(
+                    f"Reading {fpath} needs zstandard, install fas2ipa with the zstd"
+                    " extra."
+                )
+            fobj = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+        elif codec == XZ:
+            fobj = lzma.LZMAFile(raw)
+        else:
+            raise ValueError(f"{fpath} is compressed with an unknown codec {codec!r}")
+
+        with fobj:
+            if offsets is None:
+                offset = 0
+                while True:
+                    frame = _read_frame(fpath, fobj)
+                    if frame is None:
+                        return
+                    yield (offset,) + frame
+                    offset += _FRAME_HEADER.size + len(frame[1])
+            for offset in offsets:
+                # Decompressing streams can seek forward only, that's all we need
+                fobj.seek(offset)
+                frame = _read_frame(fpath, fobj)
+                if frame is None:
+                    raise ValueError(f"{fpath} is truncated")
+                yield (offset,) + frame
+
+
+def scan(
+    fpath: pathlib.Path,
+) -> Tuple[Any, Dict[Tuple[str, str], int], Dict[Tuple[str, str], List[int]]]:
+    """Read the data of a pack file, and index its records by kind and FAS instance.
+
+    Records aren't parsed, they're counted. Their index lists the offsets of the
+    frames iter_records() reads: those of the records, and of the string tables
+    written before them.
+    """
+    data = None
+    lengths = {}
+    index = {}
+    strings_offsets = []
+    for offset, frame_type, payload in _iter_frames(fpath):
+        if frame_type == DATA:
+            data = json.loads(payload)
+        elif frame_type == STRINGS:
+            strings_offsets.append(offset)
+        elif frame_type == RECORDS:
+            kind, fas_name, length = json.loads(payload[: payload.index(b"\n")])
+            lengths[kind, fas_name] = lengths.get((kind, fas_name), 0) + length
+            offsets, strings_count = index.get((kind, fas_name), ([], 0))
+            offsets.extend(strings_offsets[strings_count:])
+            offsets.append(offset)
+            index[kind, fas_name] = offsets, len(strings_offsets)
+    return data, lengths, {key: offsets for key, (offsets, _count) in index.items()}
+
+
+def _decode_user(values: list, strings: list) -> User:
+    fields = dict(zip(User.FIELDS, values))
+    for position, field in _USER_TABLE_FIELDS:
+        if values[position] is not None:
+            fields[field] = strings[values[position]]
+    roles, memberships, extra = values[_USER_FIELDS_COUNT:]
+    return User(
+        group_roles=[
+            Membership(
+                strings[roles[i]],
+                roles[i + 1],
+                None if roles[i + 2] is None else strings[roles[i + 2]],
+                None if roles[i + 3] is None else strings[roles[i + 3]],
+            )
+            for i in range(0, len(roles), 4)
+        ],
+        memberships=[strings[index] for index in memberships],
+        extra=extra,
+        **fields,
+    )
+
+
+def _decode_group(values: list, strings: list) -> Group:
+    return Group(**dict(zip(Group.FIELDS, values)))
+
+
+def iter_records(
+    fpath: pathlib.Path, kind: str, fas_name: str, offsets: Optional[List[int]] = None,
+) -> Iterator[Union[User, Group]]:
+    """Read the users or groups of a FAS instance from a pack file.
+
+    With their offsets, as indexed by scan(), only the frames they need are read.
+    """
+    decode = _decode_user if RECORD_TYPES[kind] is User else _decode_group
+    strings = []
+    for _offset, frame_type, payload in _iter_frames(fpath, offsets):
+        if frame_type == STRINGS:
+            strings.extend(sys.intern(string) for string in json.loads(payload))
+        elif frame_type == RECORDS:
+            end = payload.index(b"\n")
+            frame_kind, frame_fas_name, _length = json.loads(payload[:end])
+            if frame_kind != kind or frame_fas_name != fas_name:
+                continue
+            for values in json.loads(payload[end + 1 :]):
+                yield decode(values, strings)
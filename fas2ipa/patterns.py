@@ -0,0 +1,157 @@
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from fedora.client import ServerError
+from requests.exceptions import RequestException
+
+from .status import echo
+
+
+class PatternPlanner:
+    """Split FAS search patterns into longer prefixes where responses are too big.
+
+    A pattern like "m*" is split into "m", "m0*", …, "ma*", …, "mz*" if fetching it
+    fails or takes too long, or for later runs if the response was too large. The
+    split patterns are remembered per FAS instance and kind of object in a JSON file.
+    """
+
+    # Characters which FAS allows in names, in ASCII order so that results of split
+    # patterns come back ordered by name.
+    CHARACTERS = {
+        "users": "0123456789abcdefghijklmnopqrstuvwxyz",
+        "groups": "-0123456789_abcdefghijklmnopqrstuvwxyz",
+    }
+
+    def __init__(self, config):
+        self.fpath = pathlib.Path(config["pattern_cache_file"])
+        self.config = config
+        self._lock = threading.Lock()
+        if self.fpath.exists():
+            self.split_patterns = json.loads(self.fpath.read_text())
+        else:
+            self.split_patterns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.save()
+
+    def save(self):
+        tmp_fpath = self.fpath.with_name(self.fpath.name + ".tmp")
+        with self._lock:
+            tmp_fpath.write_text(
+                json.dumps(self.split_patterns, indent=2, sort_keys=True)
+            )
+        os.replace(tmp_fpath, self.fpath)
+
+    @staticmethod
+    def _is_splittable(pattern: str) -> bool:
+        return pattern.endswith("*") and "*" not in pattern[:-1]
+
+    def _is_split(self, fas_name: str, kind: str, pattern: str) -> bool:
+        return pattern in self.split_patterns.get(fas_name, {}).get(kind, ())
+
+    def _mark_split(self, fas_name: str, kind: str, pattern: str):
+        with self._lock:
+            patterns = self.split_patterns.setdefault(fas_name, {}).setdefault(kind, [])
+            if pattern not in patterns:
+                patterns.append(pattern)
+                patterns.sort()
+
+    def split(self, kind: str, pattern: str) -> List[str]:
+        prefix = pattern[:-1]
+        sub_patterns = [prefix + char + "*" for char in self.CHARACTERS[kind]]
+        if prefix:
+            # Exact match of the prefix itself
+            sub_patterns.insert(0, prefix)
+        return sub_patterns
+
+    def plan(self, fas_name: str, kind: str, pattern: str) -> List[str]:
+        """Replace a pattern with its remembered partitioning, if any."""
+        if not self._is_splittable(pattern) or not self._is_split(
+            fas_name, kind, pattern
+        ):
+            return [pattern]
+        return [
+            planned
+            for sub_pattern in self.split(kind, pattern)
+            for planned in self.plan(fas_name, kind, sub_pattern)
+        ]
+
+    def timeout(self, fas_name: str, pattern: str) -> Optional[float]:
+        """Get how long FAS has to respond to a search, None for the default time.
+
+        Splittable patterns are fetched with pull_split_seconds as their timeout:
+        slower responses time out, and the pattern is split.
+        """
+        if not self._is_splittable(pattern):
+            return None
+        return self.config["fas"][fas_name]["pull_split_seconds"]
+
+    def fetch(
+        self,
+        fas_name: str,
+        kind: str,
+        pattern: str,
+        fetch: Callable[[str, Optional[float]], List[Dict]],
+        sent: Optional[Callable[[], List[Dict]]] = None,
+    ) -> List[Dict]:
+        """Fetch the objects matching a pattern, splitting it if that fails.
+
+        :param fas_name:    The name of the FAS instance.
+        :param kind:        The kind of objects, "users" or "groups".
+        :param pattern:     The search pattern.
+        :param fetch:       A function which fetches the objects matching a pattern,
+                            within a timeout in seconds, see timeout().
+        :param sent:        A function which waits for the objects of a request
+                            already sent for the pattern, with its timeout, if any.
+                            If it fails, the pattern is split, or fetched again if
+                            it can't be.
+
+        :return:            The list of objects matching the pattern.
+        """
+        fas_conf = self.config["fas"][fas_name]
+        split_seconds = fas_conf["pull_split_seconds"]
+        splittable = self._is_splittable(pattern)
+
+        start = time.monotonic()
+        try:
+            if sent is not None:
+                result = sent()
+            else:
+                result = fetch(pattern, self.timeout(fas_name, pattern))
+        except (ServerError, RequestException):
+            # Timeouts and server errors, e.g. when FAS gives up on a large search
+            if not splittable:
+                if sent is not None:
+                    return self.fetch(fas_name, kind, pattern, fetch)
+                raise
+            echo(
+                f"[{fas_name}] Fetching {pattern!r} failed after"
+                f" {time.monotonic() - start:.0f}s, splitting it up."
+            )
+            self._mark_split(fas_name, kind, pattern)
+            return [
+                obj
+                for sub_pattern in self.split(kind, pattern)
+                for obj in self.fetch(fas_name, kind, sub_pattern, fetch)
+            ]
+        duration = time.monotonic() - start
+
+        # Requests sent ahead may have waited for a connection, don't count that
+        if splittable and (
+            len(result) > fas_conf["pull_split_results"]
+            or (sent is None and duration > split_seconds)
+        ):
+            echo(
+                f"[{fas_name}] Fetching {pattern!r} returned {len(result)} {kind} in"
+                f" {duration:.0f}s, splitting it up next time."
+            )
+            self._mark_split(fas_name, kind, pattern)
+
+        return result
@@ -0,0 +1,154 @@
+import gzip
+import json
+import pathlib
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterator, List, Set, Tuple, Union
+
+from python_freeipa import ClientLegacy
+
+from .status import echo
+
+# When planned commands are executed: commands only depend on commands of earlier
+# stages, so all commands of a stage can be sent at once. Signatures come before
+# memberships, as groups may require their members to have signed an agreement.
+STAGES = {
+    "fasagreement_add": 0,
+    "group_add": 0,
+    "user_add": 0,
+    "automember_add": 1,
+    "group_mod": 1,
+    "user_mod": 1,
+    "automember_add_condition": 2,
+    "fasagreement_add_group": 2,
+    "fasagreement_add_user": 3,
+    "group_add_member": 4,
+    "group_remove_member": 4,
+    "group_add_member_manager": 5,
+}
+# Commands which aren't known above are executed last, one stage each
+UNKNOWN_STAGE = max(STAGES.values()) + 1
+
+# Commands which are only executed if the command of an earlier stage they depend on
+# created their object. Like when pushing, conditions are only added to automember
+# rules which didn't exist already.
+DEPENDENCIES = {"automember_add_condition": "automember_add"}
+
+
+def is_read_command(method: str) -> bool:
+    """Check whether an IPA command only reads, i.e. is sent even when planning."""
+    return method.endswith(("_show", "_find"))
+
+
+class PlannedResult(dict):
+    """The result of a planned command: empty, and so is anything looked up in it."""
+
+    def __missing__(self, key):
+        return PlannedResult()
+
+
+class Plan:
+    """IPA commands a push would send, recorded instead of being sent.
+
+    While planning, commands reading from IPA are sent as usual: they're the
+    snapshot of the IPA state that the plan is based on. Commands writing to IPA
+    are recorded with their exact arguments, and succeed right away with an empty
+    PlannedResult.
+
+    Plans are saved to and loaded from JSON Lines files (compressed with gzip if
+    their name ends with ".gz"), one command per line, by stage.
+    """
+
+    def __init__(self):
+        self._commands = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def add(self, method: str, args: List[Any], params: Dict[str, Any]):
+        with self._lock:
+            self._commands.append((method, args, params))
+        return PlannedResult()
+
+    def _request(self, method, args=None, params=None):
+        # Like ClientLegacy._request()
+        if not args:
+            args = []
+        elif not isinstance(args, list):
+            args = [args]
+        return self.add(method, args, dict(params or {}))
+
+    def call(self, method: str, *args, **kwargs):
+        """Record a call of a ClientLegacy method, or of _request()."""
+        if method == "_request":
+            return self._request(*args, **kwargs)
+        # ClientLegacy methods build the command and pass it to _request()
+        return getattr(ClientLegacy, method)(self, *args, **kwargs)
+
+    def created(self, method: str) -> Set[str]:
+        """Get the names of the objects a command is planned for, e.g. group_add."""
+        return {args[0] for m, args, _params in self._commands if m == method and args}
+
+    def stages(self) -> Iterator[Tuple[int, List[Tuple[str, list, dict]]]]:
+        """Iterate over the stages and their commands, in order."""
+        stages = defaultdict(list)
+        for command in self._commands:
+            stages[STAGES.get(command[0], UNKNOWN_STAGE)].append(command)
+        for stage in sorted(stages):
+            if stage < UNKNOWN_STAGE:
+                yield stage, stages[stage]
+                continue
+            # Unknown commands are executed in turn
+            for offset, command in enumerate(stages[stage]):
+                yield stage + offset, [command]
+
+    def counts(self) -> Dict[str, int]:
+        return dict(Counter(method for method, _args, _params in self._commands))
+
+    def print_summary(self, batch_size: int):
+        """Print how many commands of each kind are planned, and requests to send."""
+        requests = 0
+        for stage, commands in self.stages():
+            stage_requests = -(-len(commands) // batch_size)
+            requests += stage_requests
+            echo(
+                f"Stage {stage}: {len(commands)} commands in {stage_requests}"
+                " batch requests"
+            )
+            for method, count in sorted(Counter(c[0] for c in commands).items()):
+                echo(f"  {method}: {count}")
+        echo(f"Total: {len(self)} commands in {requests} batch requests")
+
+    @staticmethod
+    def _open(fpath: pathlib.Path, mode: str):
+        if fpath.name.lower().endswith(".gz"):
+            return gzip.open(fpath, mode + "t", encoding="utf-8")
+        return fpath.open(mode, encoding="utf-8")
+
+    def save(self, fpath: Union[str, pathlib.Path], force_overwrite: bool = False):
+        fpath = pathlib.Path(fpath)
+        with self._open(fpath, "w" if force_overwrite else "x") as fobj:
+            for stage, commands in self.stages():
+                for method, args, params in commands:
+                    fobj.write(
+                        json.dumps(
+                            {
+                                "stage": stage,
+                                "method": method,
+                                "args": args,
+                                "params": params,
+                            }
+                        )
+                    )
+                    fobj.write("\n")
+
+    @classmethod
+    def load(cls, fpath: Union[str, pathlib.Path]) -> "Plan":
+        plan = cls()
+        with cls._open(pathlib.Path(fpath), "r") as fobj:
+            for line in fobj:
+                if line.strip():
+                    command = json.loads(line)
+                    plan.add(command["method"], command["args"], command["params"])
+        return plan
@@ -0,0 +1,199 @@
+import sys
+from typing import Any, Dict, Iterable, Optional
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Membership:
+    """The role of a FAS user in a group."""
+
+    __slots__ = ("group", "group_id", "role_status", "role_type")
+
+    def __init__(
+        self,
+        group: str,
+        group_id: Optional[int],
+        role_status: Optional[str],
+        role_type: Optional[str],
+    ):
+        self.group = _intern(group)
+        self.group_id = group_id
+        self.role_status = _intern(role_status)
+        self.role_type = _intern(role_type)
+
+    def __reduce__(self):
+        # Pickled when users are sent to other processes, this is much faster
+        return Membership, (self.group, self.group_id, self.role_status, self.role_type)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "group_id": self.group_id,
+            "role_status": self.role_status,
+            "role_type": self.role_type,
+        }
+
+
+class User:
+    """A FAS user, with the details which are migrated to IPA.
+
+    Details which aren't migrated are dropped, unknown ones are kept in extra so
+    they can be reported. Group roles and memberships only keep what's needed to
+    migrate memberships and agreement signatures, names are interned.
+    """
+
+    # Details which are migrated, as strings (or privacy as a boolean)
+    FIELDS = (
+        "username",
+        "human_name",
+        "status",
+        "email",
+        "ircnick",
+        "locale",
+        "timezone",
+        "gpg_keyid",
+        "ssh_key",
+        "creation",
+        "privacy",
+    )
+
+    # Details which are shared by many users
+    INTERNED_FIELDS = ("username", "status", "locale", "timezone")
+
+    # Details which aren't migrated
+    IGNORED_FIELDS = frozenset(
+        {
+            "affiliation",
+            "alias_enabled",
+            "certificate_serial",
+            "comments",
+            "country_code",
+            "facsimile",
+            "id",
+            "internal_comments",
+            "ipa_sync_status",
+            "last_seen",
+            "latitude",
+            "longitude",
+            "old_password",
+            "password",
+            "password_changed",
+            "postal_address",
+            "roles",
+            "security_answer",
+            "security_question",
+            "status_change",
+            "telephone",
+            "unverified_email",
+        }
+    )
+    IGNORED_FIELD_SUBSTRINGS = ("token",)
+
+    __slots__ = FIELDS + ("group_roles", "memberships", "extra")
+
+    def __init__(
+        self,
+        group_roles: Iterable[Membership] = (),
+        memberships: Iterable[str] = (),
+        extra: Optional[Dict[str, Any]] = None,
+        **fields,
+    ):
+        for field in self.FIELDS:
+            value = fields.pop(field, None)
+            if field in self.INTERNED_FIELDS:
+                value = _intern(value)
+            setattr(self, field, value)
+        if fields:
+            raise TypeError(f"Unknown user fields: {', '.join(sorted(fields))}")
+        self.group_roles = tuple(group_roles)
+        self.memberships = tuple(_intern(name) for name in memberships)
+        self.extra = extra or None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @classmethod
+    def _is_ignored(cls, key: str) -> bool:
+        return key in cls.IGNORED_FIELDS or any(
+            s in key for s in cls.IGNORED_FIELD_SUBSTRINGS
+        )
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "User":
+        """Make a user from its data, as returned by FAS or written to a dataset."""
+        fields = {}
+        extra = {}
+        for key, value in data.items():
+            if key in cls.FIELDS:
+                fields[key] = value
+            elif key not in ("group_roles", "memberships") and not cls._is_ignored(key):
+                extra[key] = value
+
+        # FAS sends an empty list rather than an empty dictionary
+        group_roles = data.get("group_roles") or {}
+        return cls(
+            group_roles=(
+                Membership(
+                    name,
+                    role.get("group_id"),
+                    role.get("role_status"),
+                    role.get("role_type"),
+                )
+                for name, role in group_roles.items()
+            ),
+            memberships=(group["name"] for group in data.get("memberships") or ()),
+            extra=extra,
+            **fields,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the user into a dictionary like FAS returns it."""
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        data["group_roles"] = {
+            membership.group: membership.to_dict() for membership in self.group_roles
+        }
+        data["memberships"] = [{"name": name} for name in self.memberships]
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class Group:
+    """A FAS group, with the details which are migrated to IPA."""
+
+    FIELDS = (
+        "id",
+        "name",
+        "display_name",
+        "prerequisite_id",
+        "irc_channel",
+        "irc_network",
+        "url",
+        "mailing_list",
+    )
+
+    __slots__ = FIELDS
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields.pop(field, None))
+        if fields:
+            raise TypeError(f"Unknown group fields: {', '.join(sorted(fields))}")
+        self.name = _intern(self.name)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Group":
+        """Make a group from its data, as returned by FAS or written to a dataset."""
+        return cls(**{field: data.get(field) for field in cls.FIELDS})
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+# Record types by kind of objects in datasets
+RECORD_TYPES = {"users": User, "groups": Group}
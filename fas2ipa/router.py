@@ -0,0 +1,108 @@
+import bisect
+import hashlib
+import random
+import threading
+import time
+from typing import Collection, List, Optional, Sequence
+
+import python_freeipa
+import requests
+
+from .status import echo
+
+
+def is_replica_failure(error: Exception) -> bool:
+    """Check whether an error means the replica rather than the request failed."""
+    if isinstance(error, requests.exceptions.RequestException):
+        return True
+    if isinstance(error, python_freeipa.exceptions.FreeIPAError):
+        # HTTP server errors, IPA's own error codes are 900 and above
+        return isinstance(error.code, int) and 500 <= error.code < 600
+    return False
+
+
+class ReplicaRouter:
+    """Pick the IPA replicas to send requests to.
+
+    Requests about the same user or group go to the same replica, so they don't trip
+    over replication lag. Replicas are assigned to these keys by consistent hashing,
+    so a replica dropping out only moves its own keys elsewhere. Requests without a
+    key go to the faster one of two random replicas.
+
+    Replicas failing unhealthy_after times in a row are taken out of rotation for
+    retry_after seconds. If they fail again afterwards, they're out again right away.
+    """
+
+    # Points per replica on the hash ring, for an even spread of keys
+    VIRTUAL_NODES = 64
+
+    def __init__(
+        self, hosts: Sequence[str], unhealthy_after: int = 3, retry_after: float = 30.0
+    ):
+        self.hosts = list(hosts)
+        self.unhealthy_after = unhealthy_after
+        self.retry_after = retry_after
+        self._ring = sorted(
+            (self._hash(f"{host}#{node}"), index)
+            for index, host in enumerate(self.hosts)
+            for node in range(self.VIRTUAL_NODES)
+        )
+        self._ring_hashes = [point for point, _index in self._ring]
+        self._latencies = [None] * len(self.hosts)
+        self._errors = [0] * len(self.hosts)
+        self._down_until = [0.0] * len(self.hosts)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def healthy(self, exclude: Collection[int] = ()) -> List[int]:
+        """Get the indices of replicas in rotation, or of all if none is."""
+        candidates = [i for i in range(len(self.hosts)) if i not in exclude]
+        if not candidates:
+            candidates = list(range(len(self.hosts)))
+        now = time.monotonic()
+        return [i for i in candidates if self._down_until[i] <= now] or candidates
+
+    def pick(self, key: Optional[str] = None, exclude: Collection[int] = ()) -> int:
+        """Get the index of the replica to send a request about key to."""
+        healthy = self.healthy(exclude)
+        if len(healthy) == 1:
+            return healthy[0]
+
+        if key is None:
+            first, second = random.sample(healthy, 2)
+            if (self._latencies[second] or 0.0) < (self._latencies[first] or 0.0):
+                return second
+            return first
+
+        healthy = set(healthy)
+        start = bisect.bisect(self._ring_hashes, self._hash(key))
+        for offset in range(len(self._ring)):
+            index = self._ring[(start + offset) % len(self._ring)][1]
+            if index in healthy:
+                return index
+
+    def report(self, index: int, seconds: Optional[float] = None, failed: bool = False):
+        """Record how a request to a replica went."""
+        with self._lock:
+            if failed:
+                self._errors[index] += 1
+                if self._errors[index] >= self.unhealthy_after:
+                    if self._down_until[index] <= time.monotonic():
+                        echo(
+                            f"Taking IPA replica {self.hosts[index]} out of rotation"
+                            f" for {self.retry_after:.0f}s"
+                        )
+                    self._down_until[index] = time.monotonic() + self.retry_after
+                return
+
+            self._errors[index] = 0
+            if seconds is not None:
+                latency = self._latencies[index]
+                if latency is None:
+                    self._latencies[index] = seconds
+                else:
+                    # Exponentially weighted moving average
+                    self._latencies[index] = 0.8 * latency + 0.2 * seconds
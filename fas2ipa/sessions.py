@@ -0,0 +1,191 @@
+import json
+import os
+import pathlib
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from python_freeipa import ClientLegacy as Client
+
+from .aio import AsyncIPAClient
+from .metrics import METRICS
+from .status import echo
+
+
+class SessionManager:
+    """Keep IPA sessions logged in.
+
+    Sessions are renewed before they expire: when they're about to reach the expiry
+    time of their cookie or, if it has none, session_lifetime after logging in. A
+    background thread marks the sessions to renew, and the threads using them log in
+    again before their next request with renew_marked(): clients aren't thread-safe.
+    Session cookies are cached in session_cache_file, so that later runs can reuse
+    them instead of logging in again.
+    """
+
+    def __init__(self, config, engine=None):
+        self.config = config
+        # Clients send their requests through the async engine, if any
+        self.engine = engine
+        self.lifetime = config["session_lifetime"]
+        self.renew_before = config["session_renew_before"]
+        self.cache_fpath = pathlib.Path(config["session_cache_file"])
+        # Clients, their instances and when their sessions expire. Clients are weakly
+        # referenced: those of worker threads are forgotten once the threads ended.
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _load_cache(self):
+        try:
+            return json.loads(self.cache_fpath.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, instance, session):
+        with self._lock:
+            cache = self._load_cache()
+            cache[instance] = session
+            tmp_fpath = self.cache_fpath.with_name(self.cache_fpath.name + ".tmp")
+            # Session cookies are as good as passwords
+            fd = os.open(tmp_fpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as fobj:
+                json.dump(cache, fobj)
+            os.replace(tmp_fpath, self.cache_fpath)
+
+    def _cookie_expiry(self, ipa):
+        expiries = [c.expires for c in ipa._session.cookies if c.expires]
+        if expiries:
+            return min(expiries)
+        return time.time() + self.lifetime
+
+    def _session(self, ipa):
+        with self._lock:
+            for session in self._sessions:
+                if session["ipa"]() is ipa:
+                    return session
+
+    def _live_sessions(self):
+        """Forget the sessions of garbage collected clients, return the others.
+
+        Each returned item is a (session, client) tuple. Call with the lock held.
+        """
+        live = []
+        for session in self._sessions:
+            ipa = session["ipa"]()
+            if ipa is not None:
+                live.append((session, ipa))
+        self._sessions = [session for session, _ipa in live]
+        return live
+
+    def login(self, ipa):
+        """Log into an IPA instance, and remember the new session."""
+        session = self._session(ipa)
+        with METRICS.timed("ipa", "login", session["instance"]):
+            ipa.login(self.config["ipa"]["username"], self.config["ipa"]["password"])
+        expires = self._cookie_expiry(ipa)
+        session["expires"] = expires
+        session["renew"] = False
+        self._save_cache(
+            session["instance"],
+            {
+                "username": self.config["ipa"]["username"],
+                "cookies": ipa._session.cookies.get_dict(),
+                "expires": expires,
+            },
+        )
+
+    def connect(self, instance: str, cache=None):
+        """Get a client for an IPA instance, reusing a cached session if possible."""
+        if self.engine is not None:
+            ipa = AsyncIPAClient(
+                self.engine, host=instance, verify_ssl=self.config["ipa"]["cert_path"]
+            )
+        else:
+            ipa = Client(host=instance, verify_ssl=self.config["ipa"]["cert_path"])
+        session = {
+            "ipa": weakref.ref(ipa),
+            "instance": instance,
+            "expires": 0,
+            "renew": False,
+        }
+        with self._lock:
+            self._live_sessions()
+            self._sessions.append(session)
+
+        if cache is None:
+            cache = self._load_cache()
+        cached = cache.get(instance)
+        if (
+            cached
+            and cached["username"] == self.config["ipa"]["username"]
+            and cached["expires"] - self.renew_before > time.time()
+        ):
+            for name, value in cached["cookies"].items():
+                ipa._session.cookies.set(name, value)
+            # Normally set when logging in, requests are sent to this host
+            ipa._current_host = instance
+            session["expires"] = cached["expires"]
+        else:
+            self.login(ipa)
+        return ipa
+
+    def connect_all(self) -> List[Client]:
+        """Get clients for all IPA instances, logging into them in parallel."""
+        instances = self.config["ipa"]["instances"]
+        cache = self._load_cache()
+        with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+            return list(executor.map(lambda i: self.connect(i, cache), instances))
+
+    def renew_expiring(self):
+        """Mark the sessions which expire soon to be renewed before their next request.
+
+        Clients are used by one thread at a time, logging in from here could change
+        their session in the middle of a request.
+        """
+        deadline = time.time() + self.renew_before
+        with self._lock:
+            expiring = [
+                s
+                for s, _ipa in self._live_sessions()
+                if s["expires"] < deadline and not s["renew"]
+            ]
+            for session in expiring:
+                session["renew"] = True
+        if expiring:
+            echo(f"Renewing {len(expiring)} IPA sessions")
+
+    def renew_marked(self, ipa):
+        """Log in again if the session of a client was marked to be renewed.
+
+        Call this from the thread using the client, before sending requests with it.
+        """
+        session = self._session(ipa)
+        if session is None or not session["renew"]:
+            return
+        try:
+            self.login(ipa)
+        except Exception as e:
+            # Try again next time, requests log in again if the session expired
+            session["renew"] = False
+            echo(f"Couldn't renew an IPA session: {e}")
+
+    def _run(self):
+        interval = max(1, min(60, self.renew_before / 2))
+        while not self._stop.wait(interval):
+            self.renew_expiring()
+
+    def start(self):
+        """Start renewing sessions in the background."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,42 @@
+import hashlib
+import json
+import os
+import pathlib
+from typing import Any, Union
+
+from .utils import CustomJSONEncoder
+
+
+class SyncState:
+    """Fingerprints of objects as they were last pushed to IPA.
+
+    The state is kept in a JSON file which maps kinds of objects ("users",
+    "memberships", "agreements") to object keys and their fingerprints.
+    """
+
+    def __init__(self, fpath: Union[str, pathlib.Path]):
+        self.fpath = pathlib.Path(fpath)
+        if self.fpath.exists():
+            self.data = json.loads(self.fpath.read_text())
+        else:
+            self.data = {}
+
+    @staticmethod
+    def fingerprint(obj: Any) -> str:
+        serialized = json.dumps(
+            obj, sort_keys=True, separators=(",", ":"), cls=CustomJSONEncoder
+        )
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def changed(self, kind: str, key: str, fingerprint: str) -> bool:
+        return self.data.get(kind, {}).get(key) != fingerprint
+
+    def record(self, kind: str, key: str, fingerprint: str):
+        self.data.setdefault(kind, {})[key] = fingerprint
+
+    def save(self):
+        # Write to a temporary file first so an interrupted run can't corrupt it.
+        tmp_fpath = self.fpath.with_name(self.fpath.name + ".tmp")
+        with tmp_fpath.open("w") as fobj:
+            json.dump(self.data, fobj, separators=(",", ":"))
+        os.replace(tmp_fpath, self.fpath)
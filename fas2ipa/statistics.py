@@ -1,5 +1,23 @@
+import json
+import os
+import pathlib
+import time
 from collections import defaultdict
 
+from .metrics import METRICS
+from .status import OUTPUT
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomically(fpath, text):
+    fpath = pathlib.Path(fpath)
+    tmp_fpath = fpath.with_name(fpath.name + ".tmp")
+    tmp_fpath.write_text(text)
+    os.replace(tmp_fpath, fpath)
+
 
 class Stats(defaultdict):
     def __init__(self, *args, **kwargs):
@@ -15,6 +33,9 @@ class Stats(defaultdict):
             self[key] += value
 
     def print(self):
+        if OUTPUT.mode == "json":
+            OUTPUT.event("summary", name="stats", stats=dict(self))
+            return
         groups_changed = self["groups_added"] + self["groups_edited"]
         users_changed = self["users_added"] + self["users_edited"]
         print(
@@ -33,3 +54,80 @@ Total FAS users: {self['user_counter']}. Total users changed in FreeIPA: { users
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 """
         )
+        chunk_stats = []
+        for key, count in self.items():
+            if key.startswith("chunks_"):
+                method, size = key[len("chunks_") :].rsplit("_", 1)
+                chunk_stats.append((method, int(size), count))
+        if chunk_stats:
+            print("Chunk sizes (command: size × number of chunks):")
+            for method, size, count in sorted(chunk_stats):
+                print(f"  {method}: {size} × {count}")
+
+    def to_dict(self, phase: str) -> dict:
+        return {
+            "phase": phase,
+            "timestamp": time.time(),
+            "stats": dict(self),
+            "requests": METRICS.summary(),
+        }
+
+    def to_prometheus(self, phase: str) -> str:
+        """Format the stats and request metrics for the Prometheus textfile collector."""
+        lines = [
+            "# HELP fas2ipa_objects Objects processed, by what happened to them.",
+            "# TYPE fas2ipa_objects gauge",
+        ]
+        for key, value in sorted(self.items()):
+            lines.append(f'fas2ipa_objects{{name="{_label(key)}"}} {value}')
+
+        requests = [
+            (
+                ",".join(
+                    f'{name}="{_label(entry[name])}"'
+                    for name in ("service", "operation", "instance")
+                ),
+                entry,
+            )
+            for entry in METRICS.summary()
+        ]
+        lines += [
+            "# HELP fas2ipa_request_duration_seconds Duration of FAS and IPA requests.",
+            "# TYPE fas2ipa_request_duration_seconds histogram",
+        ]
+        for labels, entry in requests:
+            for bound, count in entry["buckets"]:
+                lines.append(
+                    f'fas2ipa_request_duration_seconds_bucket{{{labels},le="{bound}"}}'
+                    f" {count}"
+                )
+            lines.append(
+                f"fas2ipa_request_duration_seconds_sum{{{labels}}} {entry['seconds']}"
+            )
+            lines.append(
+                f"fas2ipa_request_duration_seconds_count{{{labels}}} {entry['count']}"
+            )
+        lines += [
+            "# HELP fas2ipa_request_errors_total Failed FAS and IPA requests.",
+            "# TYPE fas2ipa_request_errors_total counter",
+        ]
+        for labels, entry in requests:
+            lines.append(f"fas2ipa_request_errors_total{{{labels}}} {entry['errors']}")
+        lines += [
+            "# HELP fas2ipa_phase_completed_timestamp_seconds When a phase was completed.",
+            "# TYPE fas2ipa_phase_completed_timestamp_seconds gauge",
+            f'fas2ipa_phase_completed_timestamp_seconds{{phase="{_label(phase)}"}}'
+            f" {time.time()}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def export(self, config, phase: str):
+        """Write the stats and request metrics to the configured files, if any."""
+        if config["metrics_json_file"]:
+            _write_atomically(
+                config["metrics_json_file"], json.dumps(self.to_dict(phase), indent=2)
+            )
+        if config["metrics_prometheus_file"]:
+            _write_atomically(
+                config["metrics_prometheus_file"], self.to_prometheus(phase)
+            )
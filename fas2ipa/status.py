@@ -1,5 +1,11 @@
+import json
+import sys
+import threading
+import time
 from enum import Enum
 
+import click
+import progressbar
 from colorama import Fore, Style
 
 
@@ -12,19 +18,154 @@ class Status(Enum):
     REMOVED = "REMOVED"
 
 
-def print_status(status, text=None):
-    if status == Status.ADDED:
-        color = Style.BRIGHT + Fore.GREEN
-    elif status == Status.UPDATED:
-        color = Style.BRIGHT + Fore.CYAN
-    elif status == Status.FAILED:
-        color = Style.BRIGHT + Fore.RED
-    elif status == Status.SKIPPED:
-        color = Style.BRIGHT + Fore.BLUE
-    elif status == Status.UNMODIFIED:
-        color = Style.BRIGHT + Fore.YELLOW
-    elif status == Status.REMOVED:
-        color = Style.NORMAL + Fore.MAGENTA
-    else:
-        raise ValueError(f"Unknown status: {status!r}")
-    print(f"{color}{text or status.value}{Style.RESET_ALL}")
+COLORS = {
+    Status.ADDED: Style.BRIGHT + Fore.GREEN,
+    Status.UPDATED: Style.BRIGHT + Fore.CYAN,
+    Status.FAILED: Style.BRIGHT + Fore.RED,
+    Status.SKIPPED: Style.BRIGHT + Fore.BLUE,
+    Status.UNMODIFIED: Style.BRIGHT + Fore.YELLOW,
+    Status.REMOVED: Style.NORMAL + Fore.MAGENTA,
+}
+
+OUTPUT_MODES = ("text", "json", "quiet")
+
+
+class Output:
+    """Where the statuses of migrated objects and summaries are written.
+
+    - text: every object and its colored status, a line each, as they're migrated.
+    - json: JSON Lines events for failures and summaries, and for sample_rate of the
+      other statuses.
+    - quiet: failures and summaries only, as plain text.
+
+    In the json and quiet modes, other messages go to stderr, so stdout only carries
+    the events, or the failures and summaries.
+
+    The json and quiet modes buffer their lines, a background thread writes them to
+    stdout every interval seconds. Progress bars are redrawn on the same timer,
+    instead of on every line. In the json and quiet modes, they're only shown if
+    stderr is a terminal.
+    """
+
+    def __init__(self):
+        self.mode = "text"
+        self.sample_rate = 0.0
+        self.interval = 0.5
+        self._lines = []
+        self._sampled = 0.0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._writer = None
+
+    def configure(self, mode: str, sample_rate: float = 0.0, interval: float = 0.5):
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {mode!r}")
+        self.close()
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.interval = interval
+        if mode != "text":
+            self._stop.clear()
+            self._writer = threading.Thread(target=self._write_lines, daemon=True)
+            self._writer.start()
+
+    def _write_lines(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+        if not lines:
+            return
+        with self._write_lock:
+            if sys.stdout.isatty() and sys.stderr.isatty():
+                # Clear the progress bar, it's redrawn on its next update
+                sys.stderr.write("\r\033[K")
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+
+    def close(self):
+        """Write what's buffered and stop the background thread."""
+        if self._writer is None:
+            return
+        self._stop.set()
+        self._writer.join()
+        self._writer = None
+
+    def _write(self, line: str):
+        with self._lock:
+            self._lines.append(line + "\n")
+
+    def _sample(self) -> bool:
+        with self._lock:
+            self._sampled += self.sample_rate
+            if self._sampled < 1:
+                return False
+            self._sampled -= 1
+            return True
+
+    def event(self, event: str, **fields):
+        """Write an event, in the json mode only."""
+        if self.mode == "json":
+            self._write(json.dumps({"event": event, "time": time.time(), **fields}))
+
+    def echo(self, message: str = ""):
+        """Print an informational message, to stderr in the json and quiet modes.
+
+        In these modes, stdout only carries events, failures and summaries.
+        """
+        click.echo(message, err=self.mode != "text")
+
+    def status(self, status: Status, text=None, kind=None, name=None, width=0):
+        color = COLORS.get(status)
+        if color is None:
+            raise ValueError(f"Unknown status: {status!r}")
+        if self.mode == "text":
+            if name is not None and not text:
+                click.echo(name.ljust(width), nl=False)
+            print(f"{color}{text or status.value}{Style.RESET_ALL}")
+            return
+        if status != Status.FAILED and not (self.mode == "json" and self._sample()):
+            return
+        if self.mode == "json":
+            fields = {"status": status.value}
+            if kind is not None:
+                fields.update(kind=kind, name=name)
+            if text:
+                fields["message"] = text
+            self.event("status", **fields)
+        else:
+            self._write(
+                " ".join(str(part) for part in (status.value, kind, name, text) if part)
+            )
+
+    def progress_bar(self, max_value) -> progressbar.ProgressBar:
+        timer = {"min_poll_interval": self.interval, "poll_interval": self.interval}
+        if self.mode == "text":
+            # Lines printed meanwhile are shown when the bar is redrawn
+            return progressbar.ProgressBar(
+                max_value=max_value, redirect_stdout=True, **timer
+            )
+        if not sys.stderr.isatty():
+            return progressbar.NullBar(max_value=max_value)
+        return progressbar.ProgressBar(max_value=max_value, **timer)
+
+
+# Everything is written through this
+OUTPUT = Output()
+
+
+def echo(message: str = ""):
+    OUTPUT.echo(message)
+
+
+def print_status(status, text=None, kind=None, name=None):
+    OUTPUT.status(status, text, kind=kind, name=name)
+
+
+def print_object_status(kind, name, status, width=0):
+    """Print the status of a migrated object, after its name padded to the width."""
+    OUTPUT.status(status, kind=kind, name=name, width=width)
@@ -0,0 +1,61 @@
+import pytest
+
+from fas2ipa.chunking import AdaptiveChunker
+
+
+@pytest.fixture
+def chunker():
+    return AdaptiveChunker(size=40, min_size=5, max_size=100, target_seconds=10)
+
+
+def test_initial_size_is_bounded():
+    assert AdaptiveChunker(1000, 5, 100, 10).size == 100
+    assert AdaptiveChunker(1, 5, 100, 10).size == 5
+
+
+def test_chunks(chunker):
+    chunks = list(chunker.chunks(list(range(100))))
+    assert [len(chunk) for chunk in chunks] == [40, 40, 20]
+    assert [item for chunk in chunks for item in chunk] == list(range(100))
+    assert chunker.stats("users") == {"chunks_users_40": 3}
+
+
+def test_size_halves_on_error(chunker):
+    chunker.observe(40, 1, error=True)
+    assert chunker.size == 20
+    chunker.observe(20, 1, error=True)
+    assert chunker.size == 10
+
+
+def test_chunks_of_a_failed_request_halve_the_size_once(chunker):
+    for _chunk in range(3):
+        chunker.observe(40, 1, error=True)
+    assert chunker.size == 20
+
+
+def test_size_stays_above_minimum(chunker):
+    for _error in range(10):
+        chunker.observe(chunker.size, 1, error=True)
+    assert chunker.size == 5
+
+
+def test_size_stays_below_maximum(chunker):
+    for _chunk in range(10):
+        chunker.observe(chunker.size, 1)
+    assert chunker.size == 100
+
+
+def test_size_adapts_to_duration(chunker):
+    chunker.observe(40, 20)
+    assert chunker.size == 30
+    # Within the target, nothing changes
+    chunker.observe(30, 7)
+    assert chunker.size == 30
+    chunker.observe(30, 2)
+    assert chunker.size == 45
+
+
+def test_smaller_fast_chunks_dont_undo_an_error(chunker):
+    chunker.observe(40, 1, error=True)
+    chunker.observe(10, 1)
+    assert chunker.size == 20
@@ -0,0 +1,153 @@
+import copy
+
+import pytest
+
+from fas2ipa.config import DEFAULT_CONFIG, merge_dicts
+from fas2ipa.records import User
+from fas2ipa.users import Users
+
+
+@pytest.fixture
+def users():
+    config = merge_dicts(
+        copy.deepcopy(DEFAULT_CONFIG),
+        {
+            "fas": {
+                "fedora": {"email_domain": "fedoraproject.org", "groups": {}},
+                "centos": {"email_domain": "centos.org", "groups": {}},
+            }
+        },
+    )
+    return Users(config, {}, {}, agreements=None)
+
+
+def make_users(*users):
+    return [User(username=username, email=email) for username, email in users]
+
+
+def test_no_conflicts(users):
+    conflicts = users.find_user_conflicts(
+        {
+            "fedora": make_users(("alice", "alice@example.com")),
+            "centos": make_users(("alice", "alice@example.com"), ("bob", None)),
+        }
+    )
+    assert conflicts == {}
+
+
+def test_email_address_conflicts_compare_addresses_as_they_are(users):
+    conflicts = users.find_user_conflicts(
+        {
+            "fedora": make_users(("alice", "alice@example.com")),
+            "centos": make_users(("alice", "Alice@Example.com")),
+        }
+    )
+    assert conflicts == {
+        "alice": {
+            "email_address_conflicts": [
+                {"email_address": "alice@example.com", "fas_names": {"fedora"}},
+                {"email_address": "Alice@Example.com", "fas_names": {"centos"}},
+            ]
+        }
+    }
+
+
+def test_circular_email(users):
+    conflicts = users.find_user_conflicts(
+        {
+            "fedora": make_users(("alice", "alice@fedoraproject.org")),
+            "centos": make_users(("alice", "alice@example.com")),
+        }
+    )
+    assert conflicts == {
+        "alice": {
+            "circular_email": [
+                {"fas_name": "fedora", "email_address": "alice@fedoraproject.org"}
+            ]
+        }
+    }
+
+
+def test_email_pointing_to_other_fas(users):
+    conflicts = users.find_user_conflicts(
+        {
+            "fedora": make_users(("alice", "alice@centos.org")),
+            "centos": make_users(("alice", "alice@centos.org")),
+        }
+    )
+    assert conflicts == {
+        "alice": {
+            "circular_email": [
+                {"fas_name": "centos", "email_address": "alice@centos.org"}
+            ],
+            "email_pointing_to_other_fas": [
+                {
+                    "tgt_fas_name": "centos",
+                    "email_address": "alice@centos.org",
+                    "src_fas_names": {"fedora"},
+                }
+            ],
+        }
+    }
+
+
+def test_mixed_case_domain_isnt_circular(users):
+    # The mailbox and domain must match the username and email domain exactly
+    conflicts = users.find_user_conflicts(
+        {
+            "fedora": make_users(("alice", "alice@FedoraProject.org")),
+            "centos": make_users(("alice", "Alice@centos.org")),
+        }
+    )
+    assert conflicts == {
+        "alice": {
+            "email_address_conflicts": [
+                {"email_address": "alice@FedoraProject.org", "fas_names": {"fedora"}},
+                {"email_address": "Alice@centos.org", "fas_names": {"centos"}},
+            ]
+        }
+    }
+
+
+def test_email_used_by_other_user(users):
+    conflicts = users.find_user_conflicts(
+        {
+            "fedora": make_users(
+                ("alice", "alice@example.com"), ("alice2", " Alice@Example.com")
+            ),
+            "centos": make_users(("bob", "ALICE@example.com")),
+        }
+    )
+    assert conflicts == {
+        "alice2": {
+            "email_used_by_other_user": [
+                {
+                    "fas_name": "fedora",
+                    "email_address": " Alice@Example.com",
+                    "other_fas_name": "fedora",
+                    "other_username": "alice",
+                }
+            ]
+        },
+        "bob": {
+            "email_used_by_other_user": [
+                {
+                    "fas_name": "centos",
+                    "email_address": "ALICE@example.com",
+                    "other_fas_name": "fedora",
+                    "other_username": "alice",
+                }
+            ]
+        },
+    }
+
+
+def test_same_user_with_address_in_another_case_isnt_other_user(users):
+    conflicts = users.find_user_conflicts(
+        {
+            "fedora": make_users(("alice", "alice@example.com")),
+            "centos": make_users(("alice", "ALICE@example.com"), ("bob", "bob@a.org")),
+        }
+    )
+    assert set(conflicts) == {"alice"}
+    assert set(conflicts["alice"]) == {"email_address_conflicts"}
@@ -0,0 +1,136 @@
+import lzma
+
+import pytest
+
+from fas2ipa import packfile
+from fas2ipa.records import Group, User
+
+
+@pytest.fixture(params=["zstd", "xz"])
+def codec(request, monkeypatch):
+    if request.param == "zstd":
+        pytest.importorskip("zstandard")
+        return packfile.ZSTD
+    # Pack files are compressed with xz when zstandard isn't installed
+    monkeypatch.setattr(packfile, "_zstandard", lambda: None)
+    return packfile.XZ
+
+
+def make_user(username, groups, **fields):
+    return User.from_dict(
+        {
+            "username": username,
+            "human_name": username.title(),
+            "status": "active",
+            "email": f"{username}@example.com",
+            "locale": "en_US",
+            "timezone": "UTC",
+            "privacy": False,
+            "group_roles": {
+                name: {"group_id": i, "role_status": "approved", "role_type": "user"}
+                for i, name in enumerate(groups)
+            },
+            "memberships": [{"name": name} for name in groups],
+            **fields,
+        }
+    )
+
+
+DATASET = {
+    ("groups", "fedora"): [
+        Group(id=1, name="packager", display_name="Packagers"),
+        Group(id=2, name="sysadmin", irc_channel="#fedora-admin"),
+    ],
+    ("groups", "centos"): [Group(id=1, name="sig-cloud")],
+    ("users", "fedora"): [
+        make_user("alice", ["packager", "sysadmin"], ircnick="alice"),
+        make_user("bob", [], status="inactive", timezone=None),
+        make_user("carol", ["packager"], telephone="555-1234"),
+    ],
+    ("users", "centos"): [
+        make_user("alice", ["sig-cloud"], locale="fr_FR"),
+        make_user("dave", ["sig-cloud"]),
+    ],
+}
+
+
+def to_dicts(records):
+    return [record.to_dict() for record in records]
+
+
+@pytest.fixture
+def pack_file(tmp_path, codec):
+    fpath = tmp_path / "dataset.pack"
+    with packfile.PackWriter(fpath) as writer:
+        writer.write_data({"version": 1})
+        for fas_name in ("fedora", "centos"):
+            writer.write_records("groups", fas_name, DATASET["groups", fas_name])
+        # Users of both instances are interleaved, as when they're pulled in parallel
+        for position in range(3):
+            for fas_name in ("fedora", "centos"):
+                users = DATASET["users", fas_name][position : position + 1]
+                writer.write_records("users", fas_name, users)
+    return fpath
+
+
+def test_codec(pack_file, codec):
+    header = pack_file.read_bytes()[: len(packfile.MAGIC) + 2]
+    assert header == packfile.MAGIC + bytes([packfile.VERSION]) + codec
+
+
+def test_round_trip_through_offsets(pack_file):
+    data, lengths, index = packfile.scan(pack_file)
+    assert data == {"version": 1}
+    assert lengths == {key: len(records) for key, records in DATASET.items()}
+    assert set(index) == set(DATASET)
+    for (kind, fas_name), records in DATASET.items():
+        read = list(
+            packfile.iter_records(pack_file, kind, fas_name, index[kind, fas_name])
+        )
+        assert all(isinstance(record, type(records[0])) for record in read)
+        assert to_dicts(read) == to_dicts(records)
+
+
+def test_round_trip_without_offsets(pack_file):
+    read = list(packfile.iter_records(pack_file, "users", "centos"))
+    assert to_dicts(read) == to_dicts(DATASET["users", "centos"])
+
+
+def test_offsets_skip_other_instances(pack_file):
+    _data, _lengths, index = packfile.scan(pack_file)
+    shared = set(index["users", "fedora"]) & set(index["users", "centos"])
+    assert shared
+    # Only string tables are read for both instances
+    frames = packfile._iter_frames(pack_file, sorted(shared))
+    assert {frame_type for _offset, frame_type, _payload in frames} == {
+        packfile.STRINGS
+    }
+
+
+def test_truncated_file(pack_file):
+    content = pack_file.read_bytes()
+    pack_file.write_bytes(content[: len(content) // 2])
+    with pytest.raises(ValueError, match="is truncated"):
+        packfile.scan(pack_file)
+
+
+def test_truncated_frame(tmp_path, codec):
+    fpath = tmp_path / "dataset.pack"
+    with packfile.PackWriter(fpath) as writer:
+        writer.write_records("groups", "fedora", DATASET["groups", "fedora"])
+        # The payload is shorter than its header says
+        writer._fobj.write(packfile._FRAME_HEADER.pack(packfile.DATA, 100) + b"{}")
+    with pytest.raises(ValueError, match="is truncated"):
+        packfile.scan(fpath)
+
+
+def test_truncated_at_offset(pack_file):
+    with pytest.raises(ValueError, match="is truncated"):
+        list(packfile.iter_records(pack_file, "users", "fedora", [10 ** 9]))
+
+
+def test_not_a_pack_file(tmp_path):
+    fpath = tmp_path / "dataset.pack"
+    fpath.write_bytes(lzma.compress(b"{}"))
+    with pytest.raises(ValueError, match="isn't a pack file"):
+        packfile.scan(fpath)
@@ -0,0 +1,70 @@
+import gzip
+import json
+
+import pytest
+
+from fas2ipa.plan import Plan, PlannedResult, is_read_command
+
+
+@pytest.fixture
+def plan():
+    plan = Plan()
+    plan.call("_request", "group_add_member", "packager", {"user": ["alice"]})
+    plan.call("_request", "user_add", "alice", {"givenname": "Alice", "sn": "Liddell"})
+    plan.call("_request", "group_add", ["packager"], {"description": "Packagers"})
+    plan.call("_request", "user_mod", "alice", {"fasircnick": ["alice"]})
+    plan.call("_request", "custom_command", None, None)
+    return plan
+
+
+def test_commands_are_staged(plan):
+    assert [
+        (stage, [method for method, _args, _params in commands])
+        for stage, commands in plan.stages()
+    ] == [
+        (0, ["user_add", "group_add"]),
+        (1, ["user_mod"]),
+        (4, ["group_add_member"]),
+        (6, ["custom_command"]),
+    ]
+    assert plan.created("group_add") == {"packager"}
+
+
+def test_planned_results_are_empty(plan):
+    result = plan.call("_request", "group_add", "sysadmin")
+    assert isinstance(result, PlannedResult)
+    assert result["result"]["cn"] == {}
+
+
+@pytest.mark.parametrize("fname", ["plan.jsonl", "plan.jsonl.gz"])
+def test_save_load(plan, tmp_path, fname):
+    fpath = tmp_path / fname
+    plan.save(fpath)
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(fpath, "rt") as fobj:
+        first = json.loads(next(fobj))
+    assert first == {
+        "stage": 0,
+        "method": "user_add",
+        "args": ["alice"],
+        "params": {"givenname": "Alice", "sn": "Liddell"},
+    }
+    loaded = Plan.load(fpath)
+    assert len(loaded) == len(plan)
+    assert list(loaded.stages()) == list(plan.stages())
+    assert loaded.counts() == plan.counts()
+
+
+def test_save_does_not_overwrite(plan, tmp_path):
+    fpath = tmp_path / "plan.jsonl"
+    plan.save(fpath)
+    with pytest.raises(FileExistsError):
+        plan.save(fpath)
+    Plan().save(fpath, force_overwrite=True)
+    assert len(Plan.load(fpath)) == 0
+
+
+def test_read_commands():
+    assert is_read_command("user_show")
+    assert is_read_command("group_find")
+    assert not is_read_command("group_add_member")
@@ -0,0 +1,83 @@
+import python_freeipa
+import pytest
+import requests
+
+from fas2ipa.router import ReplicaRouter, is_replica_failure
+
+HOSTS = ["ipa01.example.com", "ipa02.example.com", "ipa03.example.com"]
+KEYS = [f"user{i}" for i in range(300)]
+
+
+@pytest.fixture
+def router():
+    return ReplicaRouter(HOSTS, unhealthy_after=3, retry_after=30)
+
+
+def test_routing_is_stable(router):
+    picks = {key: router.pick(key) for key in KEYS}
+    assert {key: router.pick(key) for key in KEYS} == picks
+    # Also across runs
+    other_router = ReplicaRouter(HOSTS)
+    assert {key: other_router.pick(key) for key in KEYS} == picks
+
+
+def test_keys_are_spread(router):
+    picks = [router.pick(key) for key in KEYS]
+    for index in range(len(HOSTS)):
+        assert picks.count(index) > len(KEYS) / len(HOSTS) / 2
+
+
+def test_failover_to_healthy_replicas(router):
+    picks = {key: router.pick(key) for key in KEYS}
+    for _failure in range(3):
+        router.report(0, failed=True)
+    assert router.healthy() == [1, 2]
+    for key, index in picks.items():
+        if index == 0:
+            assert router.pick(key) in (1, 2)
+        else:
+            # Keys of other replicas don't move
+            assert router.pick(key) == index
+    assert {router.pick() for _request in range(50)} <= {1, 2}
+
+
+def test_replica_stays_healthy_until_failing_in_a_row(router):
+    router.report(0, failed=True)
+    router.report(0, failed=True)
+    router.report(0, 0.1)
+    router.report(0, failed=True)
+    assert router.healthy() == [0, 1, 2]
+
+
+def test_replica_comes_back(router, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("fas2ipa.router.time.monotonic", lambda: now)
+    for _failure in range(3):
+        router.report(0, failed=True)
+    assert router.healthy() == [1, 2]
+    now += 31
+    assert router.healthy() == [0, 1, 2]
+    # Failing again takes it out right away
+    router.report(0, failed=True)
+    assert router.healthy() == [1, 2]
+
+
+def test_all_replicas_unhealthy(router):
+    for index in range(len(HOSTS)):
+        for _failure in range(3):
+            router.report(index, failed=True)
+    assert router.healthy() == [0, 1, 2]
+
+
+def test_exclude(router):
+    for key in KEYS[:20]:
+        index = router.pick(key)
+        assert router.pick(key, exclude={index}) != index
+    assert router.pick("user0", exclude={0, 1}) == 2
+
+
+def test_replica_failures():
+    assert is_replica_failure(requests.exceptions.ConnectionError())
+    assert is_replica_failure(python_freeipa.exceptions.FreeIPAError("", 503))
+    assert not is_replica_failure(python_freeipa.exceptions.FreeIPAError("", 4001))
+    assert not is_replica_failure(ValueError())
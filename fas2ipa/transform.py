@@ -0,0 +1,248 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from .records import User
+from .state import SyncState
+from .status import Status
+
+CREATION_TIME_RE = re.compile(r"([0-9 :-]+).[0-9]+\+00:00")
+
+# Keyword arguments of ClientLegacy.user_add() & user_mod() and the attributes they set
+USER_ARGS_TO_ATTRIBUTES = {
+    "first_name": "givenname",
+    "last_name": "sn",
+    "full_name": "cn",
+    "display_name": "displayname",
+    "home_directory": "homedirectory",
+    "disabled": "nsaccountlock",
+    "random_pass": "random",
+}
+
+
+def user_args_to_params(user_args: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert ClientLegacy style user arguments to raw IPA command parameters."""
+    return {
+        USER_ARGS_TO_ATTRIBUTES.get(key, key): value
+        for key, value in user_args.items()
+        # ClientLegacy only sets these flags if they're true
+        if value is not None and (value or key not in ("disabled", "random_pass"))
+    }
+
+
+def _compact_dict(val):
+    # If it has ID fields, it's just to bulky and uninformative.
+    if any("id" in key for key in val):
+        return "{…}"
+
+    items_strs = (f"'{k}': …" for k in val.keys())
+    return f"{{{', '.join(items_strs)}}}"
+
+
+def _compact_sequence(val):
+    return (_compact_value(item) for item in val)
+
+
+def _compact_value(val):
+    if isinstance(val, dict):
+        return _compact_dict(val)
+    elif isinstance(val, list):
+        return list(_compact_sequence(val))
+    elif isinstance(val, tuple):
+        return tuple(_compact_sequence(val))
+    elif isinstance(val, set):
+        return set(_compact_sequence(val))
+    else:
+        return val
+
+
+def make_user_args(person: User) -> Dict[str, Any]:
+    """Compute the arguments of a user in IPA from its FAS data."""
+    username = person.username
+    human_name = person.human_name
+    status = person.status
+    email = person.email
+    ircnick = person.ircnick
+    locale = person.locale
+    timezone = person.timezone
+    gpg_keyid = person.gpg_keyid
+    ssh_key = person.ssh_key
+    creation = person.creation
+    privacy = person.privacy
+
+    # Fail if any details are unknown, i.e. unprocessed
+    if person.extra:
+        details = ["Unprocessed details:"]
+        for key, value in sorted(person.extra.items(), key=lambda x: x[0]):
+            if (
+                key in {"email", "ssh_key", "telephone", "facsimile"}
+                or "password" in key
+            ):
+                details.append(f"\t{key}: <…shhhhh…>")
+            else:
+                details.append(f"\t{key}: {_compact_value(value)}")
+        raise ValueError("\n".join(details))
+
+    if human_name:
+        name = human_name.strip()
+        name_split = name.split(" ")
+        if len(name_split) > 2 or len(name_split) == 1:
+            first_name = "<first-name-unset>"
+            last_name = name
+        else:
+            first_name = name_split[0].strip()
+            last_name = name_split[1].strip()
+    else:
+        name = "<first-name-unset> <last-name-unset>"
+        first_name = "<first-name-unset>"
+        last_name = "<last-name-unset>"
+    return {
+        "first_name": first_name,
+        "last_name": last_name,
+        "full_name": name,
+        "gecos": name,
+        "display_name": name,
+        "home_directory": f"/home/fedora/{username}",
+        "disabled": status != "active",
+        "mail": email,
+        "ipasshpubkey": [k.strip() for k in ssh_key.split("\n") if k.strip()]
+        if ssh_key
+        else None,
+        "fasircnick": ircnick.strip() if ircnick else None,
+        "faslocale": locale.strip() if locale else None,
+        "fastimezone": timezone.strip() if timezone else None,
+        "fasgpgkeyid": [gpg_keyid[:16].strip()] if gpg_keyid else None,
+        "fasstatusnote": status.strip(),
+        "fasisprivate": bool(privacy),
+        "fascreationtime": CREATION_TIME_RE.sub(r"\1Z", creation),
+    }
+
+
+def transform_settings(config: Dict[str, Any], fas_name: str) -> Dict[str, Any]:
+    """Extract what transforming the users of a FAS instance depends on.
+
+    The settings are plain data, so they can be sent to worker processes.
+    """
+    fas_conf = config["fas"][fas_name]
+    return {
+        "skip_disabled": config["users"]["skip_disabled"],
+        "skip_spam": config["users"]["skip_spam"],
+        "skip_user_add": config["skip_user_add"],
+        "ignore_groups": frozenset(fas_conf["groups"].get("ignore", ())),
+        "prefix": fas_conf["groups"].get("prefix", ""),
+        "agreements": [
+            (agreement["name"], frozenset(agreement["signed_groups"]))
+            for agreement in fas_conf.get("agreement", ())
+        ],
+        "fingerprint": bool(config["incremental"]),
+    }
+
+
+def skip_status(person: User, settings: Dict[str, Any]) -> Optional[Status]:
+    """Get the status of a user who isn't added or updated in IPA, if any."""
+    if settings["skip_disabled"] and person.status not in ("active", "bot"):
+        return Status.SKIPPED
+    if settings["skip_spam"] and person.status == "spamcheck_denied":
+        return Status.SKIPPED
+    if settings["skip_user_add"]:
+        return Status.UNMODIFIED
+
+
+class UserPayload:
+    """A FAS user, transformed into what is sent to IPA.
+
+    If the user isn't added or updated, status is set. If their details couldn't
+    be converted, error is. Otherwise, user_args are the arguments of the user in
+    IPA, add_params the parameters of user_add and fingerprint their fingerprint
+    for incremental pushes, if asked for.
+
+    Memberships are (category, group) tuples, categories being "members",
+    "sponsors" and "unapproved". Agreements are the names of the agreements the
+    user signed.
+    """
+
+    __slots__ = (
+        "username",
+        "status",
+        "error",
+        "user_args",
+        "add_params",
+        "fingerprint",
+        "memberships",
+        "agreements",
+    )
+
+    def __init__(self, username: str):
+        self.username = username
+        self.status = None
+        self.error = None
+        self.user_args = None
+        self.add_params = None
+        self.fingerprint = None
+        self.memberships = []
+        self.agreements = []
+
+    def __getstate__(self):
+        # Pickled when sent back from worker processes, this is much faster
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def _memberships(person: User, settings: Dict[str, Any]) -> List[Tuple[str, str]]:
+    ignore_groups = settings["ignore_groups"]
+    prefix = settings["prefix"]
+    memberships = []
+    for membership in person.group_roles:
+        if (
+            membership.group in ignore_groups
+            or membership.group_id is None  # empty list of groups
+        ):
+            continue
+        groupname = prefix + membership.group
+        if membership.role_status == "approved":
+            memberships.append(("members", groupname))
+            if membership.role_type in ["administrator", "sponsor"]:
+                memberships.append(("sponsors", groupname))
+        else:
+            memberships.append(("unapproved", groupname))
+    return memberships
+
+
+def transform_user(person: User, settings: Dict[str, Any]) -> UserPayload:
+    """Transform a FAS user, without any network request."""
+    payload = UserPayload(person.username)
+    payload.memberships = _memberships(person, settings)
+    payload.agreements = [
+        name
+        for name, signed_groups in settings["agreements"]
+        # the intersection is not empty: the user signed it
+        if not signed_groups.isdisjoint(person.memberships)
+    ]
+
+    payload.status = skip_status(person, settings)
+    if payload.status is not None:
+        return payload
+    try:
+        user_args = make_user_args(person)
+    except Exception as e:
+        payload.error = str(e)
+        return payload
+
+    user_add_args = user_args.copy()
+    # If they haven't synced yet, they must reset their password:
+    user_add_args["random_pass"] = True
+    user_add_args["faslocale"] = user_add_args["faslocale"] or "en_US"
+    user_add_args["fastimezone"] = user_add_args["fastimezone"] or "UTC"
+
+    payload.user_args = user_args
+    payload.add_params = user_args_to_params(user_add_args)
+    if settings["fingerprint"]:
+        payload.fingerprint = SyncState.fingerprint(user_args)
+    return payload
+
+
+def transform_users(persons: List[User], settings: Dict[str, Any]) -> List[UserPayload]:
+    """Transform a batch of FAS users, e.g. in a worker process."""
+    return [transform_user(person, settings) for person in persons]
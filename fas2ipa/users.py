@@ -1,25 +1,84 @@
+import multiprocessing
 import string
 import re
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from fnmatch import fnmatchcase
-from typing import Any, Dict, List, Optional, Sequence
+from functools import partial
+from itertools import islice, zip_longest
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
-import click
-import progressbar
 import python_freeipa
 
-from .status import Status, print_status
-from .utils import ObjectManager
+from .patterns import PatternPlanner
+from .records import User
+from .status import OUTPUT, Status, echo, print_object_status, print_status
+from .transform import (
+    UserPayload,
+    transform_settings,
+    transform_users,
+    user_args_to_params,
+)
+from .utils import DatasetWriter, ObjectManager
+from .state import SyncState
 from .statistics import Stats
 
 
-CREATION_TIME_RE = re.compile(r"([0-9 :-]+).[0-9]+\+00:00")
+def normalize_email(email_address: str) -> str:
+    """Normalize an email address to compare it with others."""
+    return email_address.strip().lower()
+
+
+# The attributes of IPA users which are written from FAS
+USER_ATTRIBUTES = {
+    "givenname",
+    "sn",
+    "cn",
+    "displayname",
+    "gecos",
+    "homedirectory",
+    "nsaccountlock",
+    "mail",
+    "ipasshpubkey",
+    "fasircnick",
+    "faslocale",
+    "fastimezone",
+    "fasgpgkeyid",
+    "fasstatusnote",
+    "fasisprivate",
+    "fascreationtime",
+}
+
+# The attributes of IPA groups listing their direct members and sponsors
+GROUP_MEMBER_ATTRIBUTES = {"member_user", "membermanager_user"}
+
+
+def _normalize_attribute(attr, value):
+    """Normalize a user attribute value, as sent or as returned by IPA."""
+    if value is None:
+        return ()
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    normalized = []
+    for item in value:
+        if isinstance(item, dict) and "__datetime__" in item:
+            item = item["__datetime__"]
+        if attr == "fascreationtime":
+            item = re.sub(r"[^0-9]", "", item)
+        normalized.append(item)
+    return tuple(sorted(normalized, key=str))
 
 
 class Users(ObjectManager):
     def __init__(self, *args, agreements, **kwargs):
         super().__init__(*args, **kwargs)
         self.agreements = agreements
+        # Existing IPA users by name, only with the attributes written from FAS
+        self.ipa_users = {}
+        # Members and sponsors of existing IPA groups by name, and missing groups
+        self.ipa_group_members = {}
+        self.missing_groups = set()
 
     @staticmethod
     def _make_user_patterns(
@@ -50,52 +109,264 @@ class Users(ObjectManager):
         self,
         users_start_at: Optional[str] = None,
         restrict_users: Optional[Sequence[str]] = None,
-    ) -> Dict[str, List[Dict]]:
-        user_patterns = self._make_user_patterns(users_start_at, restrict_users)
+        writer: Optional[DatasetWriter] = None,
+    ) -> Dict[str, List[User]]:
+        """Pull users from FAS.
 
-        fas_matched_users = {}
+        If a dataset writer is passed, users are written to it as each search pattern
+        completes, instead of being collected and returned.
+        """
+        user_patterns = self._make_user_patterns(users_start_at, restrict_users)
 
-        for fas_name, fas_inst in self.fas_instances.items():
-            matched_users = fas_matched_users[fas_name] = []
+        def echo_pattern(fas_name, pattern):
+            if "*" in pattern:
+                echo(f"[{fas_name}] finding users matching {pattern!r}")
+            else:
+                echo(f"[{fas_name}] finding user {pattern!r}")
+
+        def fetch_pattern(fas_name, pattern, timeout):
+            echo_pattern(fas_name, pattern)
+            result = self.thread_fas_instance(fas_name).send_request(
+                "/user/list",
+                req_params={"search": pattern},
+                auth=True,
+                timeout=timeout or 240,
+            )
+            return result["unapproved_people"] + result["people"]
+
+        def send_pattern(fas_name, pattern):
+            """Send the search of a pattern ahead with the async engine, if used."""
+            future = self.thread_fas_instance(fas_name).send_request_async(
+                "/user/list",
+                req_params={"search": pattern},
+                auth=True,
+                timeout=planner.timeout(fas_name, pattern) or 240,
+            )
+            if future is None:
+                return None
+            echo_pattern(fas_name, pattern)
 
-            for pattern in user_patterns:
-                if "*" in pattern:
-                    click.echo(f"[{fas_name}] finding users matching {pattern!r}")
-                else:
-                    click.echo(f"[{fas_name}] finding user {pattern!r}")
+            def sent():
+                result = future.result()
+                return result["unapproved_people"] + result["people"]
 
-                result = fas_inst.send_request(
-                    "/user/list",
-                    req_params={"search": pattern},
-                    auth=True,
-                    timeout=240,
-                )
+            return sent
 
-                people = result["unapproved_people"] + result["people"]
-                if users_start_at:
-                    matched_users.extend(
-                        u for u in people if u.username >= users_start_at
+        def fetch(fas_name, pattern, sent=None):
+            people = planner.fetch(
+                fas_name, "users", pattern, partial(fetch_pattern, fas_name), sent
+            )
+            people = [User.from_dict(person) for person in people]
+            if users_start_at:
+                people = [u for u in people if u.username >= users_start_at]
+            people.sort(key=lambda u: u.username)
+            return people
+
+        fas_matched_users = {fas_name: [] for fas_name in self.fas_instances}
+        # Split patterns can overlap
+        fas_seen_usernames = {fas_name: set() for fas_name in self.fas_instances}
+
+        # Fetch patterns concurrently, up to pull_concurrency per FAS instance, but
+        # collect the results in a fixed order.
+        with ExitStack() as stack:
+            planner = stack.enter_context(PatternPlanner(self.config))
+
+            if self.config["replay"]:
+                # VCR patches connections globally, fetch one pattern at a time.
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+                executors = {fas_name: executor for fas_name in self.fas_instances}
+            else:
+                executors = {
+                    fas_name: stack.enter_context(
+                        ThreadPoolExecutor(
+                            max_workers=self.config["fas"][fas_name]["pull_concurrency"]
+                        )
                     )
-                else:
-                    matched_users.extend(people)
+                    for fas_name in self.fas_instances
+                }
+
+            # With the async engine, the searches of all patterns are sent at once,
+            # workers only wait for their responses
+            fas_futures = [
+                [
+                    (
+                        fas_name,
+                        executors[fas_name].submit(
+                            fetch, fas_name, pattern, send_pattern(fas_name, pattern)
+                        ),
+                    )
+                    for user_pattern in user_patterns
+                    for pattern in planner.plan(fas_name, "users", user_pattern)
+                ]
+                for fas_name in self.fas_instances
+            ]
+
+            for futures in zip_longest(*fas_futures):
+                for fas_name, future in filter(None, futures):
+                    seen_usernames = fas_seen_usernames[fas_name]
+                    people = [
+                        u for u in future.result() if u.username not in seen_usernames
+                    ]
+                    seen_usernames.update(u.username for u in people)
+                    if writer:
+                        writer.write("users", fas_name, people)
+                    else:
+                        fas_matched_users[fas_name].extend(people)
+
+        for matched_users in fas_matched_users.values():
+            matched_users.sort(key=lambda u: u.username)
 
         return fas_matched_users
 
     def push_to_ipa(
         self,
-        users: List[Dict],
+        users: Union[Dict[str, List[User]], Iterable[Tuple[str, List[User]]]],
         users_start_at: Optional[str] = None,
         restrict_users: Optional[Sequence[str]] = None,
         conflicts: Optional[Dict[str, Sequence[Dict[str, Any]]]] = None,
     ) -> Stats:
+        """Push users to IPA.
+
+        Users are passed by FAS instance, or as (FAS instance, users) batches, e.g.
+        while they're being pulled. Group memberships and agreement signatures are
+        written once all batches have been pushed.
+        """
         stats = Stats()
 
         users_stats = self._push_users(users, users_start_at, restrict_users, conflicts)
         stats.update(users_stats)
+        stats.update(self.chunk_stats())
+        stats.update(self.agreements.chunk_stats())
 
         return stats
 
+    def prefetch_ipa_users(self, usernames: Iterable[str]):
+        echo("Fetching existing users from IPA")
+        self.ipa_users = self.fetch_entries(
+            "user_show", usernames, USER_ATTRIBUTES, {"all": True, "no_members": True}
+        )
+        echo(f"Found {len(self.ipa_users)} existing users.")
+
+    def prefetch_group_members(self, groups: Iterable[str]):
+        echo("Fetching existing group members from IPA")
+        self.missing_groups = set()
+        self.ipa_group_members = self.fetch_entries(
+            "group_show", groups, GROUP_MEMBER_ATTRIBUTES, not_found=self.missing_groups
+        )
+        if self.plan is not None:
+            # Planned groups will exist, without members, when the plan is executed
+            planned = self.missing_groups & self.plan.created("group_add")
+            self.missing_groups -= planned
+            self.ipa_group_members.update((group, {}) for group in planned)
+        echo(f"Found {len(self.ipa_group_members)} existing groups.")
+
+    def _transform_users(self, fas_name, persons, pool=None):
+        """Transform users, yielding their payloads in the original order.
+
+        Users are transformed in batches, by the worker processes of the pool if
+        there's one, while the caller sends what's already transformed to IPA.
+        """
+        settings = transform_settings(self.config, fas_name)
+        persons = iter(persons)
+        batch_size = self.config["transform_batch_size"]
+        batches = iter(lambda: list(islice(persons, batch_size)), [])
+        if pool is None:
+            for batch in batches:
+                yield from transform_users(batch, settings)
+            return
+
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.submit(transform_users, batch, settings))
+            if len(pending) >= 2 * self.config["transform_processes"]:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+    def _migrate_users(self, fas_name, transformed, unchanged=frozenset()):
+        """Migrate transformed users, yield (payload, status) tuples in order."""
+
+        def migrate(payload):
+            # Users pushed before an interrupted run was resumed
+            status = self.journal.status("user", f"{fas_name}:{payload.username}")
+            if status is not None:
+                return status
+            if payload.username in unchanged:
+                return Status.UNMODIFIED
+            return self.migrate_user(fas_name, payload)
+
+        workers = self.config["workers"]
+        if workers <= 1:
+            yield from self.map_batched(migrate, transformed)
+            return
+
+        def migrate_window(window):
+            return list(self.map_batched(migrate, window))
+
+        # Workers migrate whole windows of users in IPA batches. Keep a bounded number
+        # of windows in flight and hand results back in order, so statistics and
+        # memberships are only ever touched from this thread.
+        transformed = iter(transformed)
+        windows = iter(lambda: list(islice(transformed, self.batch.window)), [])
+        pending = deque()
+        with ThreadPoolExecutor(
+            max_workers=workers, initializer=self.init_worker
+        ) as executor:
+            for window in windows:
+                pending.append(executor.submit(migrate_window, window))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
     def _push_users(self, fas_users, users_start_at, restrict_users, conflicts):
+        if self.config["incremental"]:
+            state = SyncState(self.config["state_file"])
+        else:
+            state = None
+
+        processes = self.config["transform_processes"]
+        with ExitStack() as stack:
+            if processes > 0:
+                # Spawned rather than forked, the parent process runs threads
+                pool = stack.enter_context(
+                    ProcessPoolExecutor(
+                        max_workers=processes,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                )
+            else:
+                pool = None
+            try:
+                return self._push_users_with_state(
+                    fas_users, users_start_at, restrict_users, conflicts, state, pool
+                )
+            finally:
+                if state is not None:
+                    state.save()
+
+    @staticmethod
+    def _changed_only(state, kind, prefix, names_to_usernames):
+        """Remove entries with unchanged fingerprints, return the changed ones."""
+        fingerprints = {}
+        for name, usernames in list(names_to_usernames.items()):
+            fingerprint = state.fingerprint(sorted(usernames))
+            key = f"{prefix}:{name}"
+            if state.changed(kind, key, fingerprint):
+                fingerprints[name] = fingerprint
+            else:
+                del names_to_usernames[name]
+        return fingerprints
+
+    @staticmethod
+    def _record_fingerprints(state, kind, prefix, fingerprints, failed):
+        for name, fingerprint in fingerprints.items():
+            if name not in failed:
+                state.record(kind, f"{prefix}:{name}", fingerprint)
+
+    def _push_users_with_state(
+        self, fas_users, users_start_at, restrict_users, conflicts, state, pool
+    ):
         counter = 0
         added = 0
         edited = 0
@@ -104,76 +375,122 @@ class Users(ObjectManager):
         groups_to_unapproved_member_usernames = defaultdict(list)
         groups_to_sponsor_usernames = defaultdict(list)
         agreements_to_usernames = defaultdict(list)
+        groups_by_category = {
+            "members": groups_to_member_usernames,
+            "sponsors": groups_to_sponsor_usernames,
+            "unapproved": groups_to_unapproved_member_usernames,
+        }
 
         user_patterns = self._make_user_patterns(users_start_at, restrict_users)
         if not conflicts:
             conflicts = {}
         skip_conflicts = set(self.config["users"].get("skip_conflicts", ()))
 
-        for fas_name, users in fas_users.items():
-            print(f"{fas_name}: {len(users)} found")
+        if isinstance(fas_users, dict):
+            fas_users = fas_users.items()
+
+        for fas_name, users in fas_users:
+            echo(f"{fas_name}: {len(users)} found")
             if not users:
                 continue
 
-            fas_conf = self.config["fas"][fas_name]
+            # Streamed datasets are stored sorted already
+            if isinstance(users, list):
+                users.sort(key=lambda u: u.username)
 
-            users.sort(key=lambda u: u["username"])
+            max_length = max([len(u.username) for u in users])
 
-            max_length = max([len(u["username"]) for u in users])
+            # Users might be streamed from the dataset file, iterate anew every time
+            def matching_users():
+                return (
+                    u
+                    for u in users
+                    if any(fnmatchcase(u.username, pat) for pat in user_patterns)
+                )
 
-            for person in progressbar.progressbar(users, redirect_stdout=True):
-                username = person["username"]
-                if all(not fnmatchcase(username, pat) for pat in user_patterns):
-                    continue
+            def conflicts_to_skip(username):
+                return skip_conflicts.intersection(conflicts.get(username, ()))
 
-                user_conflicts = set(conflicts.get(username, ()))
-                user_skip_conflicts = skip_conflicts & user_conflicts
-                if user_skip_conflicts:
-                    print_status(
-                        Status.FAILED,
-                        f"[{fas_name}] Skipping user '{username}' because of conflicts:"
-                        f" {', '.join(user_skip_conflicts)}",
-                    )
-                    skipped += 1
-                    continue
+            def users_to_migrate():
+                nonlocal skipped
+
+                for person in matching_users():
+                    username = person.username
+                    user_skip_conflicts = conflicts_to_skip(username)
+                    if user_skip_conflicts:
+                        print_status(
+                            Status.FAILED,
+                            f"[{fas_name}] Skipping user '{username}' because of"
+                            f" conflicts: {', '.join(user_skip_conflicts)}",
+                            kind="user",
+                            name=username,
+                        )
+                        skipped += 1
+                        continue
+
+                    yield person
+
+            transformed = self._transform_users(fas_name, users_to_migrate(), pool)
+
+            # Users whose IPA attributes didn't change since they were last pushed
+            unchanged = set()
+            if state is not None:
+                # Their fingerprints are only known once transformed, keep the
+                # payloads rather than transforming them again to migrate them
+                transformed = list(transformed)
+                for payload in transformed:
+                    if payload.fingerprint is not None and not state.changed(
+                        "users", f"{fas_name}:{payload.username}", payload.fingerprint
+                    ):
+                        unchanged.add(payload.username)
+                echo(f"{len(unchanged)} users unchanged since the last push.")
+                usernames = (payload.username for payload in transformed)
+            else:
+                usernames = (
+                    u.username
+                    for u in matching_users()
+                    if not conflicts_to_skip(u.username)
+                )
+
+            if not self.config["skip_user_add"]:
+                self.prefetch_ipa_users(
+                    username
+                    for username in usernames
+                    if username not in unchanged
+                    and self.journal.status("user", f"{fas_name}:{username}") is None
+                )
+
+            resumed = 0
 
+            for payload, status in OUTPUT.progress_bar(len(users))(
+                self._migrate_users(fas_name, transformed, unchanged)
+            ):
                 counter += 1
-                self.check_reauth(counter)
-                click.echo(username.ljust(max_length + 2), nl=False)
-                # Add user
-                status = self.migrate_user(fas_name, person)
+                username = payload.username
+                journal_key = f"{fas_name}:{username}"
+                is_resumed = self.journal.status("user", journal_key) is not None
                 if status != Status.SKIPPED:
-                    # Record membership
-                    for _groupname, membership in person["group_roles"].items():
-                        if (
-                            _groupname in fas_conf["groups"].get("ignore", ())
-                            or membership["group_id"] is None  # empty list of groups
-                        ):
-                            continue
-                        groupname = fas_conf["groups"].get("prefix", "") + _groupname
-                        if membership["role_status"] == "approved":
-                            groups_to_member_usernames[groupname].append(
-                                person["username"]
-                            )
-                            if membership["role_type"] in ["administrator", "sponsor"]:
-                                groups_to_sponsor_usernames[groupname].append(
-                                    person["username"]
-                                )
-                        else:
-                            groups_to_unapproved_member_usernames[groupname].append(
-                                person["username"]
-                            )
-                    # Record agreement signatures
-                    group_names = [g["name"] for g in person["memberships"]]
-                    for agreement in fas_conf.get("agreement", ()):
-                        if set(agreement["signed_groups"]) & set(group_names):
-                            # intersection is not empty: the user signed it
-                            agreements_to_usernames[agreement["name"]].append(
-                                person["username"]
-                            )
+                    # Record memberships and agreement signatures
+                    for category, groupname in payload.memberships:
+                        groups_by_category[category][groupname].append(username)
+                    for agreement_name in payload.agreements:
+                        agreements_to_usernames[agreement_name].append(username)
+
+                if payload.fingerprint and status in (
+                    Status.ADDED,
+                    Status.UPDATED,
+                    Status.UNMODIFIED,
+                ):
+                    state.record("users", journal_key, payload.fingerprint)
+
+                if is_resumed:
+                    resumed += 1
+                    continue
+                if status != Status.FAILED:
+                    self.journal.record_status("user", journal_key, status)
 
                 # Status
-                print_status(status)
+                print_object_status("user", username, status, width=max_length + 2)
                 if status == Status.ADDED:
                     added += 1
                 elif status == Status.UPDATED:
@@ -181,10 +498,69 @@ class Users(ObjectManager):
                 elif status == Status.SKIPPED:
                     skipped += 1
 
-        self.agreements.record_user_signatures(agreements_to_usernames)
-        self.add_users_to_groups(groups_to_member_usernames, "members")
-        self.add_users_to_groups(groups_to_sponsor_usernames, "sponsors")
-        self.remove_users_from_groups(groups_to_unapproved_member_usernames)
+            if resumed:
+                echo(f"{resumed} users were already pushed before resuming.")
+
+        # Membership and signature sets are only complete if all users were pushed
+        if state is not None and not (users_start_at or restrict_users):
+            fingerprints = {
+                "members": self._changed_only(
+                    state, "memberships", "members", groups_to_member_usernames
+                ),
+                "sponsors": self._changed_only(
+                    state, "memberships", "sponsors", groups_to_sponsor_usernames
+                ),
+                "unapproved": self._changed_only(
+                    state,
+                    "memberships",
+                    "unapproved",
+                    groups_to_unapproved_member_usernames,
+                ),
+                "agreements": self._changed_only(
+                    state, "agreements", "signers", agreements_to_usernames
+                ),
+            }
+        else:
+            fingerprints = None
+
+        if not self.config["skip_user_membership"]:
+            self.prefetch_group_members(
+                {
+                    group
+                    for groups_to_usernames in (
+                        groups_to_member_usernames,
+                        groups_to_sponsor_usernames,
+                    )
+                    for group, usernames in groups_to_usernames.items()
+                    if usernames
+                }
+                | {
+                    self.config["groups"]["prefix"] + group
+                    for group, usernames in groups_to_unapproved_member_usernames.items()
+                    if usernames
+                }
+            )
+
+        failed = self.agreements.record_user_signatures(agreements_to_usernames)
+        if fingerprints and failed is not None:
+            self._record_fingerprints(
+                state, "agreements", "signers", fingerprints["agreements"], failed
+            )
+        for category, groups_to_usernames in (
+            ("members", groups_to_member_usernames),
+            ("sponsors", groups_to_sponsor_usernames),
+        ):
+            failed = self.add_users_to_groups(groups_to_usernames, category)
+            if fingerprints and failed is not None:
+                self._record_fingerprints(
+                    state, "memberships", category, fingerprints[category], failed
+                )
+        failed = self.remove_users_from_groups(groups_to_unapproved_member_usernames)
+        if fingerprints and failed is not None:
+            self._record_fingerprints(
+                state, "memberships", "unapproved", fingerprints["unapproved"], failed
+            )
+
         return {
             "user_counter": counter,
             "users_added": added,
@@ -192,470 +568,455 @@ class Users(ObjectManager):
             "users_skipped": skipped,
         }
 
-    @classmethod
-    def _compact_dict(cls, val):
-        # If it has ID fields, it's just to bulky and uninformative.
-        if any("id" in key for key in val):
-            return "{…}"
-
-        items_strs = (f"'{k}': …" for k in val.keys())
-        return f"{{{', '.join(items_strs)}}}"
-
-    @classmethod
-    def _compact_sequence(cls, val):
-        return (cls._compact_value(item) for item in val)
-
-    @classmethod
-    def _compact_list(cls, val):
-        return list(cls._compact_sequence(val))
-
-    @classmethod
-    def _compact_tuple(cls, val):
-        return tuple(cls._compact_sequence(val))
-
-    @classmethod
-    def _compact_set(cls, val):
-        return set(cls._compact_sequence(val))
-
-    @classmethod
-    def _compact_value(cls, val):
-        if isinstance(val, dict):
-            return cls._compact_dict(val)
-        elif isinstance(val, list):
-            return cls._compact_list(val)
-        elif isinstance(val, tuple):
-            return cls._compact_tuple(val)
-        elif isinstance(val, set):
-            return cls._compact_set(val)
-        else:
-            return val
+    def migrate_user(self, fas_name, payload: UserPayload):
+        """Add or update a transformed user in IPA."""
+        if payload.status is not None:
+            return payload.status
+        if payload.error is not None:
+            print_status(Status.FAILED, f"{payload.username}: {payload.error}")
+            return Status.FAILED
 
-    def migrate_user(self, fas_name, person):
-        fas_conf = self.config["fas"][fas_name]
-        person_orig = person
-        person = person.copy()
-        if (
-                self.config["users"]["skip_disabled"] 
-                and person.get("status") not in ("active", "bot")
+        username = payload.username
+        ipa_user = self.ipa_users.get(username)
+        if ipa_user is not None:
+            return self._update_user(fas_name, username, payload.user_args, ipa_user)
+
+        return self.batch.add(
+            "user_add",
+            username,
+            payload.add_params,
+            callback=partial(self._user_added, fas_name, username, payload.user_args),
+        )
+
+    def _user_added(self, fas_name, username, user_args, result, error):
+        try:
+            if error is None:
+                return Status.ADDED
+            if (
+                getattr(error, "message", None)
+                != f'user with name "{username}" already exists'
             ):
-            return Status.SKIPPED
-        if (
-            self.config["users"]["skip_spam"]
-            and person.get("status") == "spamcheck_denied"
-        ):
-            return Status.SKIPPED
-        if self.config["skip_user_add"]:
+                raise error
+            # Not prefetched, e.g. created in the meantime
+            ipa_user = self.ipa_call(username, "user_show", username)
+            return self._update_user(fas_name, username, user_args, ipa_user)
+        except python_freeipa.exceptions.FreeIPAError as e:
+            if e.message != "no modifications to be performed":
+                print_status(Status.FAILED, f"{username}: {e}")
+                return Status.FAILED
             return Status.UNMODIFIED
+        except Exception as e:
+            print_status(Status.FAILED, f"{username}: {e}")
+            return Status.FAILED
 
-        # Don't modify the original object, and remove all key/value pairs that should
-        # be ignored
-        ignored_keys = {
-            "affiliation",
-            "alias_enabled",
-            "certificate_serial",
-            "comments",
-            "country_code",
-            "facsimile",
-            "group_roles",
-            "id",
-            "internal_comments",
-            "ipa_sync_status",
-            "last_seen",
-            "latitude",
-            "longitude",
-            "memberships",
-            "old_password",
-            "password",
-            "password_changed",
-            "postal_address",
-            "roles",
-            "security_answer",
-            "security_question",
-            "status_change",
-            "telephone",
-            "unverified_email",
-        }
-        ignored_key_substrings = ("token",)
-        person = {
-            key: value
-            for key, value in person.items()
-            if not (
-                key in ignored_keys or any(t in key for t in ignored_key_substrings)
-            )
-        }
+    def _user_modified(self, username, result, error):
+        if error is None:
+            return Status.UPDATED
+        if getattr(error, "message", None) == "no modifications to be performed":
+            return Status.UNMODIFIED
+        print_status(Status.FAILED, f"{username}: {error}")
+        return Status.FAILED
 
-        # Pop all key/value pairs that are processed
-        username = person.pop("username")
-        human_name = person.pop("human_name")
-        status = person.pop("status")
-        email = person.pop("email")
-        ircnick = person.pop("ircnick")
-        locale = person.pop("locale")
-        timezone = person.pop("timezone")
-        gpg_keyid = person.pop("gpg_keyid")
-        ssh_key = person.pop("ssh_key")
-        creation = person.pop("creation")
-        privacy = person.pop("privacy")
-
-        # Fail if any details are left, i.e. unprocessed
-        if person:
-            print("Unprocessed details:")
-            for key, value in sorted(person.items(), key=lambda x: x[0]):
-                if (
-                    key in {"email", "ssh_key", "telephone", "facsimile"}
-                    or "password" in key
-                ):
-                    print(f"\t{key}: <…shhhhh…>")
-                else:
-                    print(f"\t{key}: {self._compact_value(value)}")
-            return Status.FAILED
+    def _update_user(self, fas_name, username, user_args, ipa_user):
+        fas_conf = self.config["fas"][fas_name]
+        user_args = user_args.copy()
 
-        if human_name:
-            name = human_name.strip()
-            name_split = name.split(" ")
-            if len(name_split) > 2 or len(name_split) == 1:
-                first_name = "<first-name-unset>"
-                last_name = name
-            else:
-                first_name = name_split[0].strip()
-                last_name = name_split[1].strip()
-        else:
-            name = "<first-name-unset> <last-name-unset>"
-            first_name = "<first-name-unset>"
-            last_name = "<last-name-unset>"
-        try:
-            user_args = {
-                "first_name": first_name,
-                "last_name": last_name,
-                "full_name": name,
-                "gecos": name,
-                "display_name": name,
-                "home_directory": f"/home/fedora/{username}",
-                "disabled": status != "active",
-                "mail": email,
-                "ipasshpubkey": [k.strip() for k in ssh_key.split("\n") if k.strip()] if ssh_key else None,
-                "fasircnick": ircnick.strip() if ircnick else None,
-                "faslocale": locale.strip() if locale else None,
-                "fastimezone": timezone.strip() if timezone else None,
-                "fasgpgkeyid": [gpg_keyid[:16].strip()] if gpg_keyid else None,
-                "fasstatusnote": status.strip(),
-                "fasisprivate": bool(privacy),
-                "fascreationtime": CREATION_TIME_RE.sub(r"\1Z", creation),
-            }
-            try:
-                user_add_args = user_args.copy()
-                # If they haven't synced yet, they must reset their password:
-                user_add_args["random_pass"] = True
-                user_add_args["faslocale"] = user_add_args["faslocale"] or "en_US"
-                user_add_args["fastimezone"] = user_add_args["fastimezone"] or "UTC"
-                self.ipa.user_add(username, **user_add_args)
-                return Status.ADDED
-            except python_freeipa.exceptions.FreeIPAError as e:
-                if e.message == f'user with name "{username}" already exists':
-                    # Don't overwrite first/last/full name with unset placeholders
-                    if user_args["first_name"] == "<first-name-unset>":
-                        del user_args["first_name"]
-                    if user_args["last_name"] == "<last-name-unset>":
-                        del user_args["last_name"]
-                    if user_args["full_name"] == "<first-name-unset> <last-name-unset>":
-                        del user_args["full_name"]
-
-                    # Avoid resetting already set fields
+        # Don't overwrite first/last/full name with unset placeholders
+        if user_args["first_name"] == "<first-name-unset>":
+            del user_args["first_name"]
+        if user_args["last_name"] == "<last-name-unset>":
+            del user_args["last_name"]
+        if user_args["full_name"] == "<first-name-unset> <last-name-unset>":
+            del user_args["full_name"]
+
+        # Avoid resetting already set fields
+        if (
+            not fas_conf.get("users", {}).get("overwrite_data")
+            or user_args["faslocale"] is None
+            or user_args["fastimezone"] is None
+        ):
+            user_mail = user_args["mail"]
+            if user_mail != (ipa_user.get("mail") or [None])[0]:
+                skip_conflicts = set(self.config["users"].get("skip_conflicts", ()))
+                other_email_domains = {
+                    chk_fas_conf["email_domain"]
+                    for chk_fas_name, chk_fas_conf in self.config["fas"].items()
+                    if chk_fas_name != fas_name and "email_domain" in chk_fas_conf
+                }
+                mailbox, domain = user_mail.rsplit("@", 1)
+                if mailbox == username:
                     if (
-                        not fas_conf.get("users", {}).get("overwrite_data")
-                        or user_args["faslocale"] is None
-                        or user_args["fastimezone"] is None
+                        domain == fas_conf["email_domain"]
+                        and "circular_email" not in skip_conflicts
+                        or domain in other_email_domains
+                        and "email_pointing_to_other_fas" not in skip_conflicts
                     ):
-                        ipa_user = self.ipa.user_show(username)
-
-                        user_mail = user_args["mail"]
-                        if user_mail != ipa_user.get("mail")[0]:
-                            skip_conflicts = set(self.config["users"].get("skip_conflicts", ()))
-                            other_email_domains = {
-                                chk_fas_conf["email_domain"]
-                                for chk_fas_name, chk_fas_conf in self.config["fas"].items()
-                                if chk_fas_name != fas_name and "email_domain" in chk_fas_conf
-                            }
-                            mailbox, domain = user_mail.rsplit("@", 1)
-                            if mailbox == username:
-                                if (
-                                    domain == fas_conf["email_domain"]
-                                    and "circular_email" not in skip_conflicts
-                                    or domain in other_email_domains
-                                    and "email_pointing_to_other_fas" not in skip_conflicts
-                                ):
-                                    return Status.SKIPPED
-                                else:
-                                    del user_args["mail"]
-                            else:
-                                return Status.SKIPPED
-
-                        drop_fields = []
-                        for key in user_args:
-                            if ipa_user.get(key):
-                                drop_fields.append(key)
-                        for key in drop_fields:
-                            del user_args[key]
-
-                        if "faslocale" in user_args and not user_args["faslocale"]:
-                            try:
-                                user_args["faslocale"] = ipa_user.get("faslocale", [])[0]
-                            except IndexError:
-                                user_args["faslocale"] = "en_US"
-                        if "fastimezone" in user_args and not user_args["fastimezone"]:
-                            try:
-                                user_args["fastimezone"] = ipa_user.get("fastimezone", [])[0]
-                            except IndexError:
-                                user_args["fastimezone"] = "UTC"
-
-                    user_args = {
-                        k: v
-                        for k, v in user_args.items()
-                        if v is not None and (not isinstance(v, str) or v.strip())
-                    }
-
-                    # Update them instead
-                    if user_args:
-                        self.ipa.user_mod(username, **user_args)
-                        return Status.UPDATED
+                        return Status.SKIPPED
                     else:
-                        return Status.UNMODIFIED
+                        del user_args["mail"]
                 else:
-                    raise
+                    return Status.SKIPPED
+
+            drop_fields = []
+            for key in user_args:
+                if ipa_user.get(key):
+                    drop_fields.append(key)
+            for key in drop_fields:
+                del user_args[key]
+
+            if "faslocale" in user_args and not user_args["faslocale"]:
+                try:
+                    user_args["faslocale"] = ipa_user.get("faslocale", [])[0]
+                except IndexError:
+                    user_args["faslocale"] = "en_US"
+            if "fastimezone" in user_args and not user_args["fastimezone"]:
+                try:
+                    user_args["fastimezone"] = ipa_user.get("fastimezone", [])[0]
+                except IndexError:
+                    user_args["fastimezone"] = "UTC"
+
+        # Only send what differs from the values in IPA
+        params = {
+            attr: value
+            for attr, value in user_args_to_params(user_args).items()
+            if (not isinstance(value, str) or value.strip())
+            and _normalize_attribute(attr, value)
+            != _normalize_attribute(attr, ipa_user.get(attr))
+        }
 
-        except python_freeipa.exceptions.Unauthorized:
-            self.ipa.login(
-                self.config["ipa"]["username"], self.config["ipa"]["password"]
+        # Update them instead
+        if params:
+            return self.batch.add(
+                "user_mod",
+                username,
+                params,
+                callback=partial(self._user_modified, username),
             )
-            return self.migrate_user(fas_name, person_orig)
-        except python_freeipa.exceptions.FreeIPAError as e:
-            if e.message != "no modifications to be performed":
-                print(e)
-                return Status.FAILED
+        else:
             return Status.UNMODIFIED
-        except Exception as e:
-            print(e)
-            return Status.FAILED
+
+    @staticmethod
+    def _membership_errors(result):
+        errors = []
+        for member_type in ("member", "membermanager"):
+            try:
+                errors.extend(result["failed"][member_type]["user"])
+            except KeyError:
+                continue
+        return errors
+
+    def _membership_changes(self, groups_to_users, attribute, add, prefix=""):
+        """Compare wanted memberships with the snapshot of IPA group members.
+
+        Return the users who actually need to be added to (or removed from) each
+        group, and the groups which don't exist in IPA. Groups which couldn't be
+        fetched are passed on unchanged.
+        """
+        changes = {}
+        missing = set()
+        for group, usernames in groups_to_users.items():
+            if not usernames:
+                continue
+            ipa_group = prefix + group
+            if ipa_group in self.missing_groups:
+                missing.add(group)
+                print_status(Status.SKIPPED, f"Group {ipa_group} doesn't exist in IPA")
+                continue
+            snapshot = self.ipa_group_members.get(ipa_group)
+            if snapshot is None:
+                changes[group] = usernames
+                continue
+            existing = set(snapshot.get(attribute, ()))
+            changes[group] = [u for u in usernames if (u in existing) != add]
+        return changes, missing
 
     def add_users_to_groups(self, groups_to_users, category):
         if self.config["skip_user_membership"]:
-            return
+            return None
 
         if category not in ["members", "sponsors"]:
             raise ValueError("title must be eigher member or sponsor")
 
-        click.echo(f"Adding {category} to groups")
+        if category == "members":
+            method = "group_add_member"
+        else:
+            method = "group_add_member_manager"
+
+        echo(f"Adding {category} to groups")
+        groups_to_users = self.not_journaled(category, groups_to_users)
+        groups_to_users, failed = self._membership_changes(
+            groups_to_users,
+            "member_user" if category == "members" else "membermanager_user",
+            add=True,
+        )
         total = sum([len(members) for members in groups_to_users.values()])
         if total == 0:
-            click.echo("Nothing to do.")
-            return
+            echo("Nothing to do.")
+            return failed
         counter = 0
-        with progressbar.ProgressBar(max_value=total, redirect_stdout=True) as bar:
-            for group in sorted(groups_to_users):
-                members = groups_to_users[group]
-                for chunk in self.chunks(members):
-                    counter += len(chunk)
-                    self.check_reauth(counter)
-                    added = set(chunk)
-                    try:
-                        if category == "members":
-                            self.ipa.group_add_member(
-                                group, chunk, no_members=True,
-                            )
-                        elif category == "sponsors":
-                            result = self.ipa._request(
-                                "group_add_member_manager", group, {"user": chunk},
-                            )
-                            if result["failed"]["membermanager"]["user"]:
-                                raise python_freeipa.exceptions.ValidationError(
-                                    result["failed"]
-                                )
-                    except python_freeipa.exceptions.ValidationError as e:
-                        errors = []
-                        for member_type in ("member", "membermanager"):
-                            try:
-                                errors.extend(e.message[member_type]["user"])
-                            except KeyError:
-                                continue
-                        for msg in errors:
-                            if msg[1] == "This entry is already a member":
-                                added.remove(msg[0])
-                            else:
-                                print_status(
-                                    Status.FAILED,
-                                    f"Failed to add {msg[0]} in the {category} of {group}: "
-                                    + msg[1],
-                                )
-                    except python_freeipa.exceptions.NotFound as e:
-                        print_status(
-                            Status.FAILED,
-                            f"Failed to add {chunk} in the {category} of {group}: {e}",
-                        )
-                    except Exception as e:
+        with OUTPUT.progress_bar(total) as bar:
+
+            chunker = self.chunker(method)
+
+            def members_added(group, chunk, result, error):
+                nonlocal counter
+
+                counter += len(chunk)
+                bar.update(counter)
+                chunker.observe(
+                    len(chunk), self.batch.command_seconds, error is not None
+                )
+                if error is not None:
+                    failed.add(group)
+                    print_status(
+                        Status.FAILED,
+                        f"Failed to add {chunk} in the {category} of {group}: {error}",
+                    )
+                    return
+                added = set(chunk)
+                done = set(chunk)
+                for msg in self._membership_errors(result):
+                    if msg[1] == "This entry is already a member":
+                        added.remove(msg[0])
+                    else:
+                        done.discard(msg[0])
+                        failed.add(group)
                         print_status(
                             Status.FAILED,
-                            f"Failed to add {chunk} in the {category} of {group}: {e}",
+                            f"Failed to add {msg[0]} in the {category} of {group}: "
+                            + msg[1],
                         )
-                    else:
-                        if added:
-                            print_status(
-                                Status.ADDED,
-                                f"Added {category} to {group}: {', '.join(sorted(added))}",
-                            )
-                    finally:
-                        bar.update(counter)
+                self.journal.record_users(category, group, done)
+                if added:
+                    print_status(
+                        Status.ADDED,
+                        f"Added {category} to {group}: {', '.join(sorted(added))}",
+                    )
+
+            for group in sorted(groups_to_users):
+                members = groups_to_users[group]
+                for chunk in chunker.chunks(members):
+                    params = {"user": chunk}
+                    if category == "members":
+                        params["no_members"] = True
+                    self.batch.add(
+                        method,
+                        group,
+                        params,
+                        callback=partial(members_added, group, chunk),
+                    )
+            self.batch.flush()
+
+        return failed
 
     def remove_users_from_groups(self, groups_to_users):
         if self.config["skip_user_membership"]:
-            return
-
-        click.echo("Removing unapproved users from groups")
+            return None
+
+        echo("Removing unapproved users from groups")
+        groups_to_users = self.not_journaled("unapproved", groups_to_users)
+        groups_to_users, failed = self._membership_changes(
+            groups_to_users,
+            "member_user",
+            add=False,
+            prefix=self.config["groups"]["prefix"],
+        )
         total = sum([len(members) for members in groups_to_users.values()])
         if total == 0:
-            click.echo("Nothing to do.")
-            return
+            echo("Nothing to do.")
+            return failed
         counter = 0
-        with progressbar.ProgressBar(max_value=total, redirect_stdout=True) as bar:
-            for group in sorted(groups_to_users):
-                members = groups_to_users[group]
-                for chunk in self.chunks(members):
-                    counter += len(chunk)
-                    self.check_reauth(counter)
-                    removed = set(chunk[:])
-                    try:
-                        self.ipa.group_remove_member(
-                            self.config["groups"]["prefix"] + group,
-                            chunk,
-                            no_members=True,
-                        )
-                    except python_freeipa.exceptions.ValidationError as e:
-                        errors = []
-                        for member_type in ("member", "membermanager"):
-                            try:
-                                errors.extend(e.message[member_type]["user"])
-                            except KeyError:
-                                continue
-                        for msg in errors:
-                            if msg[1] == "This entry is not a member":
-                                removed.remove(msg[0])
-                            else:
-                                print_status(
-                                    Status.FAILED,
-                                    f"Failed to remove {msg[0]} from {group}: "
-                                    + msg[1],
-                                )
-                    except python_freeipa.exceptions.NotFound as e:
-                        print_status(
-                            Status.FAILED,
-                            f"Failed to remove {chunk} from {group}: {e}",
-                        )
-                    except Exception as e:
+        with OUTPUT.progress_bar(total) as bar:
+
+            chunker = self.chunker("group_remove_member")
+
+            def members_removed(group, chunk, result, error):
+                nonlocal counter
+
+                counter += len(chunk)
+                bar.update(counter)
+                chunker.observe(
+                    len(chunk), self.batch.command_seconds, error is not None
+                )
+                if error is not None:
+                    failed.add(group)
+                    print_status(
+                        Status.FAILED, f"Failed to remove {chunk} from {group}: {error}",
+                    )
+                    return
+                removed = set(chunk)
+                done = set(chunk)
+                for msg in self._membership_errors(result):
+                    if msg[1] == "This entry is not a member":
+                        removed.remove(msg[0])
+                    else:
+                        done.discard(msg[0])
+                        failed.add(group)
                         print_status(
                             Status.FAILED,
-                            f"Failed to remove {chunk} from {group}: {e}",
+                            f"Failed to remove {msg[0]} from {group}: " + msg[1],
                         )
-                    else:
-                        if removed:
-                            print_status(
-                                Status.REMOVED,
-                                f"Removed from {group}: {', '.join(sorted(removed))}",
-                            )
-                    finally:
-                        bar.update(counter)
+                self.journal.record_users("unapproved", group, done)
+                if removed:
+                    print_status(
+                        Status.REMOVED,
+                        f"Removed from {group}: {', '.join(sorted(removed))}",
+                    )
 
-    def find_user_conflicts(
-        self, fas_users: Dict[str, List[Dict]]
-    ) -> Dict[str, List[str]]:
-        """Compare users from different FAS instances and flag conflicts."""
-        click.echo("Checking for conflicts between users from different FAS instances")
+            for group in sorted(groups_to_users):
+                members = groups_to_users[group]
+                for chunk in chunker.chunks(members):
+                    self.batch.add(
+                        "group_remove_member",
+                        self.config["groups"]["prefix"] + group,
+                        {"user": chunk, "no_members": True},
+                        callback=partial(members_removed, group, chunk),
+                    )
+            self.batch.flush()
 
-        users_to_conflicts = {}
+        return failed
 
-        # email domains per FAS name and reverse
-        fas_email_domains = {
-            fas_name: fas_conf["email_domain"]
+    def find_user_conflicts(
+        self, fas_users: Dict[str, Iterable[User]]
+    ) -> Dict[str, Dict[str, List[Dict[str, Any]]]]:
+        """Compare users from different FAS instances and flag conflicts.
+
+        Users are indexed by name and by (normalized) email address in one pass over
+        all FAS instances, then only usernames existing in several instances are
+        compared, on their email addresses as they are. Users whose normalized email
+        address is already used by a user with another name, in any FAS instance and
+        in the order they'd be pushed, are flagged too: IPA would refuse to add them.
+        """
+        echo("Checking for conflicts between users from different FAS instances")
+
+        users_to_conflicts = defaultdict(lambda: defaultdict(list))
+
+        # FAS names per email domain
+        email_domains_fas = {
+            fas_conf["email_domain"]: fas_name
             for fas_name, fas_conf in self.config["fas"].items()
             if "email_domain" in fas_conf
         }
-        email_domains_fas = {v: k for k, v in fas_email_domains.items()}
 
         # FAS users by instance, by name
         fas_users_by_name = {}
-
-        # Map duplicate usernames to fas instance names
-        usernames_to_check_for_fas = defaultdict(set)
+        # Usernames seen so far, and those seen in several FAS instances
+        all_usernames = set()
+        duplicate_usernames = set()
+        # Users of normalized email addresses seen so far
+        emails_to_username = {}
+
+        def email_user_fas_name(username, address):
+            for fas_name, users_by_name in fas_users_by_name.items():
+                user_obj = users_by_name.get(username)
+                if (
+                    user_obj
+                    and user_obj.email
+                    and normalize_email(user_obj.email) == address
+                ):
+                    return fas_name
+
+        def flag_email_user(fas_name, user_obj, other_fas_name, other_username):
+            users_to_conflicts[user_obj.username]["email_used_by_other_user"].append(
+                {
+                    "fas_name": fas_name,
+                    "email_address": user_obj.email,
+                    "other_fas_name": other_fas_name,
+                    "other_username": other_username,
+                }
+            )
 
         for fas_name, user_objs in fas_users.items():
             users_by_name = fas_users_by_name[fas_name] = {
-                user_obj["username"]: user_obj for user_obj in user_objs
+                user_obj.username: user_obj for user_obj in user_objs
             }
+            duplicate_usernames |= all_usernames.intersection(users_by_name)
+            all_usernames.update(users_by_name)
+
+            users_with_email = [u for u in users_by_name.values() if u.email]
+            # normalize_email(), inlined
+            emails = {u.email.strip().lower(): u.username for u in users_with_email}
+            if len(emails) < len(users_with_email):
+                # Some users of this instance share an address, the first one keeps it
+                emails = {}
+                for user_obj in users_with_email:
+                    address = normalize_email(user_obj.email)
+                    owner = emails.setdefault(address, user_obj.username)
+                    if owner != user_obj.username:
+                        flag_email_user(fas_name, user_obj, fas_name, owner)
+
+            for address in emails_to_username.keys() & emails.keys():
+                username = emails.pop(address)
+                if emails_to_username[address] != username:
+                    flag_email_user(
+                        fas_name,
+                        users_by_name[username],
+                        email_user_fas_name(emails_to_username[address], address),
+                        emails_to_username[address],
+                    )
 
-            for other_fas_name, other_user_objs in fas_users.items():
-                if other_fas_name in fas_users_by_name:
-                    continue
-
-                other_user_names = {uobj["username"] for uobj in other_user_objs}
+            emails_to_username.update(emails)
 
-                usernames_to_check = set(users_by_name) & other_user_names
-                for name in usernames_to_check:
-                    usernames_to_check_for_fas[name] |= {fas_name, other_fas_name}
+        del emails_to_username
 
         # Check users existing in different FAS instances
-        for username, fas_names in sorted(
-            usernames_to_check_for_fas.items(), key=lambda x: x[0]
-        ):
-            user_conflicts = defaultdict(list)
+        for username in duplicate_usernames:
+            fas_emails = [
+                (fas_name, users_by_name[username].email)
+                for fas_name, users_by_name in fas_users_by_name.items()
+                if username in users_by_name
+            ]
+            user_conflicts = self._username_conflicts(
+                username, fas_emails, email_domains_fas
+            )
+            if user_conflicts:
+                users_to_conflicts[username].update(user_conflicts)
 
-            fas_to_user_obj = {
-                fas_name: fas_users_by_name[fas_name][username]
-                for fas_name in fas_names
-            }
+        echo("Done checking user conflicts.")
 
-            email_addresses_to_fas = defaultdict(set)
-            for fas_name, user_obj in fas_to_user_obj.items():
-                email_addresses_to_fas[user_obj["email"]].add(fas_name)
+        return {
+            username: dict(user_conflicts)
+            for username, user_conflicts in sorted(users_to_conflicts.items())
+        }
 
-            for email_address, fas_names in email_addresses_to_fas.items():
-                mailbox, domain = email_address.rsplit("@", 1)
-                domain_fas_name = email_domains_fas.get(domain)
-                if mailbox == username and domain_fas_name:
-                    if domain_fas_name in fas_names:
-                        user_conflicts["circular_email"].append(
-                            {
-                                "fas_name": domain_fas_name,
-                                "email_address": email_address,
-                            }
-                        )
-                        fas_names.remove(domain_fas_name)
-
-                    if fas_names:
-                        user_conflicts["email_pointing_to_other_fas"].append(
-                            {
-                                "tgt_fas_name": domain_fas_name,
-                                "email_address": email_address,
-                                "src_fas_names": set(fas_names),  # make a copy
-                            }
-                        )
-                        fas_names.clear()
+    @staticmethod
+    def _username_conflicts(username, fas_emails, email_domains_fas):
+        """Find conflicts between users of the same name in different FAS instances.
 
-            if (
-                len(
-                    list(
-                        e
-                        for e, fas_names in email_addresses_to_fas.items()
-                        if fas_names
+        Email addresses are compared as they are, like IPA would store them.
+        """
+        user_conflicts = defaultdict(list)
+
+        email_addresses_to_fas = defaultdict(set)
+        for fas_name, email_address in fas_emails:
+            email_addresses_to_fas[email_address].add(fas_name)
+
+        for email_address, fas_names in email_addresses_to_fas.items():
+            if not email_address:
+                continue
+            mailbox, domain = email_address.rsplit("@", 1)
+            domain_fas_name = email_domains_fas.get(domain)
+            if mailbox == username and domain_fas_name:
+                if domain_fas_name in fas_names:
+                    user_conflicts["circular_email"].append(
+                        {"fas_name": domain_fas_name, "email_address": email_address}
                     )
-                )
-                > 1
-            ):
-                for email_address, fas_names in email_addresses_to_fas.items():
-                    user_conflicts["email_address_conflicts"].append(
-                        {"email_address": email_address, "fas_names": fas_names}
+                    fas_names.remove(domain_fas_name)
+
+                if fas_names:
+                    user_conflicts["email_pointing_to_other_fas"].append(
+                        {
+                            "tgt_fas_name": domain_fas_name,
+                            "email_address": email_address,
+                            "src_fas_names": set(fas_names),  # make a copy
+                        }
                     )
+                    fas_names.clear()
 
-            if user_conflicts:
-                users_to_conflicts[username] = user_conflicts
-
-        click.echo("Done checking user conflicts.")
+        if sum(1 for fas_names in email_addresses_to_fas.values() if fas_names) > 1:
+            for email_address, fas_names in email_addresses_to_fas.items():
+                user_conflicts["email_address_conflicts"].append(
+                    {"email_address": email_address, "fas_names": fas_names}
+                )
 
-        return users_to_conflicts
+        return user_conflicts
@@ -1,48 +1,426 @@
+import gzip
 import json
 import pathlib
-import random
+import queue
+import threading
+import time
 from collections import defaultdict
-from typing import Union
+from concurrent.futures import Future
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
 
-import click
+import python_freeipa
 import toml
 
+from .batch import Batch
+from .chunking import AdaptiveChunker
+from .journal import Journal
+from .metrics import METRICS
+from .packfile import PackWriter, is_pack_file, iter_records, scan
+from .plan import is_read_command
+from .records import RECORD_TYPES, Group, User
+from .router import ReplicaRouter, is_replica_failure
+from .sessions import SessionManager
+from .status import echo
+
 
 # def chunks(data, n):
 #     return [data[x : x + n] for x in range(0, len(data), n)]
 
 
-def re_auth(config, instances):
-    click.echo("Re-authenticating")
-    for ipa in instances:
-        ipa.logout()
-        ipa.login(config["ipa"]["username"], config["ipa"]["password"])
+def make_router(config):
+    return ReplicaRouter(
+        config["ipa"]["instances"],
+        config["replica_unhealthy_after"],
+        config["replica_retry_after"],
+    )
 
 
 class ObjectManager:
-    def __init__(self, config, ipa_instances, fas_instances):
+    def __init__(
+        self,
+        config,
+        ipa_instances,
+        fas_instances,
+        journal=None,
+        router=None,
+        sessions=None,
+        plan=None,
+    ):
         self.config = config
         self.ipa_instances = ipa_instances
         self.fas_instances = fas_instances
+        self.journal = journal if journal is not None else Journal()
+        self.router = router if router is not None else make_router(config)
+        self.sessions = sessions if sessions is not None else SessionManager(config)
+        # Commands writing to IPA are only recorded in the plan, if any
+        self.plan = plan
+        self._chunkers = {}
+        # Worker threads log in with their own IPA sessions, see init_worker()
+        self._local = threading.local()
+
+    @property
+    def thread_ipa_instances(self):
+        return getattr(self._local, "ipa_instances", None) or self.ipa_instances
 
     @property
     def ipa(self):
-        return random.choice(self.ipa_instances)
+        return self.ipa_for()
+
+    def ipa_for(self, key=None):
+        """Get the IPA instance to send requests about key (e.g. a user name) to."""
+        return self.thread_ipa_instances[self.router.pick(key)]
+
+    def ipa_call(self, key, method, *args, **kwargs):
+        """Call a method of the IPA instance for key, failing over to other replicas."""
+        if self.plan is not None:
+            command = args[0] if method == "_request" else method
+            if not is_read_command(command):
+                return self.plan.call(method, *args, **kwargs)
+        tried = set()
+        logged_in = False
+        index = self.router.pick(key)
+        while True:
+            ipa = self.thread_ipa_instances[index]
+            self.sessions.renew_marked(ipa)
+            # Raw requests are recorded with the command they send
+            operation = args[0] if method == "_request" else method
+            start = time.monotonic()
+            try:
+                with METRICS.timed("ipa", operation, self.router.hosts[index]):
+                    result = getattr(ipa, method)(*args, **kwargs)
+            except python_freeipa.exceptions.Unauthorized:
+                if logged_in:
+                    raise
+                self.sessions.login(ipa)
+                logged_in = True
+            except Exception as e:
+                if not is_replica_failure(e):
+                    raise
+                self.router.report(index, failed=True)
+                tried.add(index)
+                if len(tried) == len(self.router.hosts):
+                    raise
+                index = self.router.pick(exclude=tried)
+            else:
+                self.router.report(index, time.monotonic() - start)
+                return result
+
+    def thread_fas_instance(self, fas_name):
+        """Get a FAS instance with a session private to the current thread."""
+        fas_instances = self._local.__dict__.setdefault("fas_instances", {})
+        if fas_name not in fas_instances:
+            fas_instances[fas_name] = self.fas_instances[fas_name].clone()
+        return fas_instances[fas_name]
+
+    def init_worker(self):
+        """Log into all IPA instances with sessions private to the current thread."""
+        self._local.ipa_instances = self.sessions.connect_all()
+
+    @property
+    def batch(self):
+        batch = getattr(self._local, "batch", None)
+        if batch is None:
+            batch = self._local.batch = Batch(self, self.config["batch_size"])
+        return batch
+
+    def not_journaled(self, op, names_to_users):
+        """Leave out users processed before resuming an interrupted push."""
+        remaining = {}
+        for name, usernames in names_to_users.items():
+            done = self.journal.users(op, name)
+            remaining[name] = [u for u in usernames if u not in done]
+        return remaining
+
+    def map_batched(self, func, items):
+        """Call func on items and yield (item, result) tuples in order.
+
+        The function may queue IPA commands in self.batch and return futures, these
+        are resolved before being yielded.
+        """
+        items = iter(items)
+        while True:
+            window = [
+                (item, func(item)) for _, item in zip(range(self.batch.window), items)
+            ]
+            if not window:
+                return
+            self.batch.flush()
+            for item, result in window:
+                # Callbacks can return futures of follow-up commands
+                while isinstance(result, Future):
+                    result = result.result()
+                yield item, result
+
+    def fetch_entries(self, method, names, attributes, params=None, not_found=None):
+        """Fetch existing IPA entries in pages of batched show commands.
+
+        :param method:      The command to show an entry, e.g. "user_show".
+        :param names:       The names of the entries to fetch.
+        :param attributes:  The attributes to keep of each entry.
+        :param params:      Additional parameters for the show command.
+        :param not_found:   A set to which names of missing entries are added.
+
+        :return:            A dictionary mapping the names of existing entries to
+                            their attributes.
+        """
+        entries = {}
+        failed = 0
+
+        def fetched(name, result, error):
+            nonlocal failed
+
+            if error is None:
+                entries[name] = {
+                    key: value
+                    for key, value in result["result"].items()
+                    if key in attributes
+                }
+            elif isinstance(error, python_freeipa.exceptions.NotFound):
+                if not_found is not None:
+                    not_found.add(name)
+            else:
+                failed += 1
+
+        batch = Batch(self, self.config["prefetch_page_size"])
+        for name in names:
+            batch.add(method, name, params, callback=partial(fetched, name))
+        batch.flush()
+
+        if failed:
+            echo(f"Couldn't fetch {failed} entries with {method}.")
+
+        return entries
+
+    def chunker(self, method: str) -> AdaptiveChunker:
+        """Get the chunker for members or users passed to an IPA command."""
+        if method not in self._chunkers:
+            self._chunkers[method] = AdaptiveChunker(
+                self.config["chunks"],
+                self.config["chunks_min"],
+                self.config["chunks_max"],
+                self.config["chunks_target_seconds"],
+            )
+        return self._chunkers[method]
+
+    def chunk_stats(self) -> Dict[str, int]:
+        """Count the chunks sent by IPA command and size."""
+        stats = {}
+        for method, chunker in self._chunkers.items():
+            stats.update(chunker.stats(method))
+        return stats
+
+
+def is_jsonl_file(fpath: Union[str, pathlib.Path]) -> bool:
+    """Check whether a file name denotes a (possibly compressed) JSON Lines file."""
+    name = pathlib.Path(fpath).name.lower()
+    return name.endswith(".jsonl") or name.endswith(".jsonl.gz")
+
+
+def is_streamed_file(fpath: Union[str, pathlib.Path]) -> bool:
+    """Check whether datasets in a file are written and read record by record."""
+    return is_jsonl_file(fpath) or is_pack_file(fpath)
+
 
-    def check_reauth(self, counter):
-        if counter % self.config["ipa"]["reauth_every"] == 0:
-            re_auth(self.config, self.ipa_instances)
+def _open_text(fpath: pathlib.Path, mode: str):
+    if fpath.name.lower().endswith(".gz"):
+        return gzip.open(fpath, mode + "t", encoding="utf-8")
+    return fpath.open(mode, encoding="utf-8")
 
-    def chunks(self, items):
-        size = self.config["chunks"]
-        return [items[x : x + size] for x in range(0, len(items), size)]
+
+def _open_binary(fpath: pathlib.Path):
+    if fpath.name.lower().endswith(".gz"):
+        return gzip.open(fpath, "rb")
+    return fpath.open("rb")
+
+
+def _index_jsonl(fpath: pathlib.Path):
+    """Count the records of a JSON Lines dataset and find them in the file.
+
+    Return the number of records and their (start, end) byte ranges in the
+    uncompressed file, by kind and FAS instance. Consecutive records of the same
+    kind and FAS instance share their range.
+    """
+    lengths = defaultdict(int)
+    ranges = defaultdict(list)
+    last_key = None
+    offset = 0
+    with _open_binary(fpath) as fobj:
+        for line in fobj:
+            start = offset
+            offset += len(line)
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = record["type"], record["fas"]
+            lengths[key] += 1
+            if key == last_key:
+                ranges[key][-1][1] = offset
+            else:
+                ranges[key].append([start, offset])
+                last_key = key
+    return lengths, ranges
+
+
+class DatasetRecords:
+    """The records of one kind and FAS instance in a JSON Lines or pack dataset.
+
+    Records are read from the file each time they're iterated over, so they never
+    have to be held in memory all at once. The index tells where they are in the
+    file, so that only their lines or frames are read: the byte ranges of their
+    lines in JSON Lines files, the offsets of their frames in pack files.
+    """
+
+    def __init__(
+        self, fpath: pathlib.Path, kind: str, fas_name: str, length: int, index: list
+    ):
+        self.fpath = fpath
+        self.kind = kind
+        self.fas_name = fas_name
+        self.length = length
+        self.index = index
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        if is_pack_file(self.fpath):
+            yield from iter_records(self.fpath, self.kind, self.fas_name, self.index)
+            return
+        record_type = RECORD_TYPES[self.kind]
+        with _open_binary(self.fpath) as fobj:
+            for start, end in self.index:
+                fobj.seek(start)
+                while start < end:
+                    line = fobj.readline()
+                    start += len(line)
+                    if line.strip():
+                        yield record_type.from_dict(json.loads(line)["data"])
+
+
+class DatasetWriter:
+    """Write a dataset into a JSON Lines file, one user or group per line.
+
+    The file is compressed with gzip if its name ends with ".gz". Pack files are
+    written with a PackWriter.
+    """
+
+    def __init__(self, fpath: Union[str, pathlib.Path], force_overwrite: bool = False):
+        if not isinstance(fpath, pathlib.Path):
+            fpath = pathlib.Path(fpath)
+        mode = "w" if force_overwrite else "x"
+        if is_pack_file(fpath):
+            self.fobj = PackWriter(fpath, mode)
+        else:
+            self.fobj = _open_text(fpath, mode)
+
+    def write(self, kind: str, fas_name: str, records: Iterable[Dict[str, Any]]):
+        if isinstance(self.fobj, PackWriter):
+            self.fobj.write_records(kind, fas_name, records)
+            return
+        for record in records:
+            self.fobj.write(
+                json.dumps(
+                    {"type": kind, "fas": fas_name, "data": record},
+                    cls=CustomJSONEncoder,
+                )
+            )
+            self.fobj.write("\n")
+
+    def close(self):
+        # Closed when the pull completes, and again if it failed
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DatasetQueue:
+    """Hand records pulled in a background thread over to be pushed meanwhile.
+
+    The pull writes records to the queue like to a DatasetWriter, in batches of one
+    kind and FAS instance, and they're also written to the dataset writer, if any.
+    Iterating over the queue yields the batches as (kind, FAS instance, records)
+    tuples. Writing blocks while maxsize batches wait to be taken, so the pull can't
+    run away from the push.
+    """
+
+    _DONE = object()
+
+    def __init__(self, maxsize: int, writer: Optional[DatasetWriter] = None):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._closed = threading.Event()
+        self._thread = None
+        self._error = None
+
+    def start(self, pull: Callable[[], Any]):
+        """Run the pull in a background thread."""
+
+        def run():
+            try:
+                pull()
+            except BaseException as e:
+                self._error = e
+            try:
+                self._put(self._DONE)
+            except RuntimeError:
+                pass
+
+        self._thread = threading.Thread(target=run, name="pull", daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while True:
+            if self._closed.is_set():
+                raise RuntimeError("The dataset queue was closed")
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, kind: str, fas_name: str, records: Iterable[Any]):
+        records = list(records)
+        if self.writer:
+            self.writer.write(kind, fas_name, records)
+        self._put((kind, fas_name, records))
+
+    def __iter__(self) -> Iterator[Tuple[str, str, list]]:
+        while True:
+            item = self._queue.get()
+            if item is self._DONE:
+                break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """Stop the pull if it's still running, and wait for it."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 def load_data(fpath: Union[str, pathlib.Path]) -> dict:
-    """Load dictionary data from a JSON, YAML, or TOML file.
+    """Load dictionary data from a JSON, JSON Lines, pack, YAML, or TOML file.
 
     The file format will be determined from the extension of the file name.
 
+    Datasets in JSON Lines and pack files aren't read into memory, their records
+    are streamed from the file instead, see DatasetRecords.
+
     :param fpath:   The file path from which to load.
 
     :return:        The loaded data as a dictionary.
@@ -52,34 +430,78 @@ def load_data(fpath: Union[str, pathlib.Path]) -> dict:
 
     suffix = fpath.suffix.lower()
 
-    if suffix == ".toml":
+    if is_jsonl_file(fpath):
+        lengths, index = _index_jsonl(fpath)
+        data = defaultdict(dict)
+        for (kind, fas_name), length in lengths.items():
+            data[kind][fas_name] = DatasetRecords(
+                fpath, kind, fas_name, length, index[kind, fas_name]
+            )
+        data = dict(data)
+    elif is_pack_file(fpath):
+        data, lengths, index = scan(fpath)
+        if lengths or data is None:
+            data = defaultdict(dict)
+            for (kind, fas_name), length in lengths.items():
+                data[kind][fas_name] = DatasetRecords(
+                    fpath, kind, fas_name, length, index[kind, fas_name]
+                )
+            data = dict(data)
+    elif suffix == ".toml":
         data = toml.loads(fpath.read_text())
     elif suffix == ".yaml":
         import yaml
 
         with fpath.open("r") as fobj:
-            data = yaml.safe_load(fobj)
+            # libyaml's loader is much faster, if PyYAML was built with it
+            data = yaml.load(fobj, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
     else:
         data = json.loads(fpath.read_text())
 
     return data
 
 
+def load_dataset(fpath: Union[str, pathlib.Path]) -> dict:
+    """Load a dataset, with its users and groups as records."""
+    data = load_data(fpath)
+    for kind, record_type in RECORD_TYPES.items():
+        fas_to_records = data.setdefault(kind, {})
+        for fas_name, records in fas_to_records.items():
+            # Records streamed from JSON Lines files are converted as they're read
+            if isinstance(records, list):
+                fas_to_records[fas_name] = [record_type.from_dict(r) for r in records]
+    return data
+
+
+def dataset_to_dicts(data: dict) -> dict:
+    """Convert the records of a dataset back into dictionaries, e.g. to save it."""
+    return {
+        kind: {
+            fas_name: [record.to_dict() for record in records]
+            for fas_name, records in fas_to_records.items()
+        }
+        for kind, fas_to_records in data.items()
+    }
+
+
 class CustomJSONEncoder(json.JSONEncoder):
-    """JSON encoder which serializes sets as lists"""
+    """JSON encoder which serializes sets as lists, and records as dictionaries"""
 
     def default(self, obj):
         if isinstance(obj, set):
             return list(obj)
+        if isinstance(obj, (User, Group)):
+            return obj.to_dict()
         return super().default(obj)
 
 
 def save_data(
     data: dict, fpath: Union[str, pathlib.Path], force_overwrite: bool = False
 ):
-    """Save a dictionary object to a JSON, YAML, or TOML file.
+    """Save a dictionary object to a JSON, JSON Lines, pack, YAML, or TOML file.
 
-    The file format will be determined from the extension of the file name.
+    The file format will be determined from the extension of the file name. JSON
+    Lines files can only hold datasets, i.e. FAS instances' lists of records by kind.
 
     :param data:            The data to be saved.
     :param fpath:           The file path to be saved into.
@@ -90,79 +512,103 @@ def save_data(
 
     suffix = fpath.suffix.lower()
 
+    if is_jsonl_file(fpath):
+        with DatasetWriter(fpath, force_overwrite=force_overwrite) as writer:
+            for kind, fas_to_records in data.items():
+                for fas_name, records in fas_to_records.items():
+                    writer.write(kind, fas_name, records)
+        return
+
     if force_overwrite:
         mode = "w"
     else:
         mode = "x"
 
+    if is_pack_file(fpath):
+        with PackWriter(fpath, mode) as writer:
+            writer.write_data(data, cls=CustomJSONEncoder)
+        return
+
     with fpath.open(mode) as fobj:
         if suffix == ".toml":
             toml.dump(data, fobj)
         elif suffix == ".yaml":
             import yaml
 
-            yaml.add_representer(set, yaml.representer.SafeRepresenter.represent_list)
+            dumper = getattr(yaml, "CDumper", yaml.Dumper)
+            yaml.add_representer(
+                set, yaml.representer.SafeRepresenter.represent_list, Dumper=dumper
+            )
             yaml.add_representer(
-                defaultdict, yaml.representer.SafeRepresenter.represent_dict
+                defaultdict,
+                yaml.representer.SafeRepresenter.represent_dict,
+                Dumper=dumper,
             )
-            yaml.dump(data, fobj)
+            yaml.dump(data, fobj, Dumper=dumper)
         else:
             json.dump(data, fobj, indent=2, cls=CustomJSONEncoder)
 
 
 def report_conflicts(conflicts):
     if not conflicts and not any((conflicts.get("users"), conflicts.get("groups"))):
-        click.echo("No users or groups with conflicts found.")
+        echo("No users or groups with conflicts found.")
 
     users_to_conflicts = conflicts.get("users")
 
     if users_to_conflicts:
-        click.echo("User conflicts")
-        click.echo("==============")
+        echo("User conflicts")
+        echo("==============")
 
         for user_name, user_conflicts in users_to_conflicts.items():
-            click.echo(f"Conflicts for user '{user_name}':")
+            echo(f"Conflicts for user '{user_name}':")
 
             for key, details in user_conflicts.items():
                 if key == "circular_email":
-                    click.echo("\tCircular email address:")
+                    echo("\tCircular email address:")
                     for item in details:
-                        click.echo(f"\t\t{item['fas_name']}: {item['email_address']}")
+                        echo(f"\t\t{item['fas_name']}: {item['email_address']}")
                 elif key == "email_pointing_to_other_fas":
-                    click.echo("\tEmail address points to other FAS:")
+                    echo("\tEmail address points to other FAS:")
                     for item in details:
-                        click.echo(
+                        echo(
                             f"\t\tEmail address {item['email_address']} for"
                             f" {', '.join(item['src_fas_names'])} points to"
                             f" {item['tgt_fas_name']}."
                         )
                 elif key == "email_address_conflicts":
-                    click.echo("\tConflicting email addresses between FAS instances:")
+                    echo("\tConflicting email addresses between FAS instances:")
                     for item in details:
-                        click.echo(
+                        echo(
                             f"\t\t{item['email_address']}:"
                             f" {', '.join(item['fas_names'])}"
                         )
+                elif key == "email_used_by_other_user":
+                    echo("\tEmail address used by another user:")
+                    for item in details:
+                        echo(
+                            f"\t\t{item['fas_name']}: {item['email_address']} is used by"
+                            f" {item['other_fas_name']}: {item['other_username']}"
+                        )
                 else:
                     raise RuntimeError(f"Unknown conflicts key: {key}")
 
-        click.echo(f"Found {len(users_to_conflicts)} users with conflicts.")
+        echo(f"Found {len(users_to_conflicts)} users with conflicts.")
 
     groups_to_conflicts = conflicts.get("groups")
 
     if groups_to_conflicts:
-        click.echo("Group conflicts")
-        click.echo("===============")
+        echo("Group conflicts")
+        echo("===============")
 
         for group_name, group_conflicts in groups_to_conflicts.items():
-            click.echo(f"Conflicts for group '{group_name}':")
+            echo(f"Conflicts for group '{group_name}':")
 
             for key, details in group_conflicts.items():
                 if key == "same_group_name":
-                    click.echo(
+                    echo(
                         f"\tSame group name between: {', '.join(details['fas_names'])}"
                     )
                 else:
                     raise RuntimeError(f"Unknown conflicts key: {key}")
 
-        click.echo(f"Found {len(groups_to_conflicts)} groups with conflicts.")
+        echo(f"Found {len(groups_to_conflicts)} groups with conflicts.")